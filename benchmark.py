@@ -0,0 +1,568 @@
+"""
+Benchmarks for the stegano.py embedding and extraction backends.
+
+Generates synthetic RGB carriers (100x100 up to 8000x8000) and payloads
+from a few bytes up to the full capacity of the carrier, in text and zip
+mode, and times every backend on them. The payload sizes cover all three
+sub = len % 3 remainder branches, a payload that only needs the pixels the
+mask selects and one large enough for the inverted (second) pass.
+
+    python benchmark.py                                  full grid
+    python benchmark.py --quick                          small carriers only
+    python benchmark.py --save-baseline baseline.json    store the results
+    python benchmark.py --baseline baseline.json         compare against them
+    python benchmark.py --quick --repeat 5 --baseline benchmark_baseline.json
+                                                         the stored baseline
+    python benchmark.py --encode                         output profiles
+
+--encode times the lossless output profiles (stegano.OUTPUT_PROFILES)
+instead: save and load time and file size of an encoded carrier.
+
+Comparing against a baseline exits with status 1 when a case got slower
+than the baseline by more than --tolerance. Cases that took less than
+--min-seconds in the baseline are too short to time reliably and are left
+out of that. A case that doesn't round-trip exits with status 1 with or
+without a baseline.
+"""
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+import stegano
+
+# Cryptography warns about CFB on every cipher it builds
+warnings.filterwarnings("ignore", module="stegano")
+
+SIZES = [(100, 100), (500, 500), (1000, 1000), (2000, 2000), (4000, 4000),
+         (8000, 8000)]
+QUICK_SIZES = [(100, 100), (500, 500), (1000, 1000)]
+
+MODES = ["text", "zip"]
+
+# Local header + central directory entry + end record of a one-member
+# stored archive, without the two copies of the member name
+ZIP_OVERHEAD = 30 + 46 + 22
+ZIP_MEMBER_NAME = "payload.bin"
+
+# Fixed member timestamp, so a zip payload is the same bytes on every run
+# and the cases can be compared against a stored baseline
+ZIP_MEMBER_DATE = (1980, 1, 1, 0, 0, 0)
+
+# The pure Python backend takes minutes on the large carriers
+LEGACY_MAX_PIXELS = 1000 * 1000
+
+BENCHMARK_KEY = "benchmark-key"
+
+# Baseline timings below this are mostly timer and scheduler noise
+MIN_COMPARE_SECONDS = 0.01
+
+
+# Random RGB carrier -- the same pixels for the same size and seed
+def make_carrier(width, height, seed=0):
+    generator = np.random.default_rng(seed + width * 100003 + height)
+    return Image.fromarray(
+        generator.integers(0, 256, (height, width, 3), dtype=np.uint8), "RGB")
+
+
+# Photo-like RGB carrier for the output profiles -- random pixels don't
+# compress at all, so these are smooth gradients with a little noise
+def make_smooth_carrier(width, height, seed=0):
+    generator = np.random.default_rng(seed + width * 100003 + height)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+
+    pixels = np.stack((255 * x / max(width - 1, 1),
+                       255 * y / max(height - 1, 1),
+                       127.5 + 127.5 * np.sin((x + y) / 50)),
+                      axis=-1)
+    pixels += generator.normal(0, 4, pixels.shape)
+
+    return Image.fromarray(
+        np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+
+# Payload of exactly payloadBytes bytes -- random bytes in text mode, a
+# stored zip archive of random bytes in zip mode (so the cipher is exactly
+# that long and the zip magic is real)
+def make_payload(mode, payloadBytes, seed=0):
+    generator = np.random.default_rng(seed + payloadBytes)
+
+    if (mode == "text"):
+        return generator.integers(0, 256, payloadBytes,
+                                  dtype=np.uint8).tobytes()
+
+    memberBytes = payloadBytes - ZIP_OVERHEAD - 2 * len(ZIP_MEMBER_NAME)
+    zipBuffer = io.BytesIO()
+    with zipfile.ZipFile(zipBuffer, "w",
+                         compression=zipfile.ZIP_STORED) as zipFileObject:
+        zipFileObject.writestr(
+            zipfile.ZipInfo(ZIP_MEMBER_NAME, ZIP_MEMBER_DATE),
+            generator.integers(0, 256, memberBytes, dtype=np.uint8).tobytes())
+
+    return zipBuffer.getvalue()
+
+
+def smallest_payload(mode):
+    if (mode == "text"):
+        return 3
+
+    return ZIP_OVERHEAD + 2 * len(ZIP_MEMBER_NAME)
+
+
+# Smallest byte count >= payloadBytes whose 8 * bytes % 3 is remainder
+def with_remainder(payloadBytes, remainder):
+    while ((8 * payloadBytes) % 3 != remainder):
+        payloadBytes += 1
+
+    return payloadBytes
+
+
+# (case name, payload bytes) for one carrier
+def payload_cases(width, height, mode, depth=1):
+    capacityBytes = (width * height - width) * 3 * depth // 8
+    smallest = smallest_payload(mode)
+
+    cases = [("small-sub" + str(remainder),
+              with_remainder(smallest, remainder)) for remainder in range(3)]
+
+    # About half of the pixels are selected by the mask -- a quarter of the
+    # capacity fits in them, three quarters need the inverted pass
+    cases += [("mask-pass", capacityBytes // 4),
+              ("inverted-pass", capacityBytes * 3 // 4),
+              ("full", capacityBytes)]
+
+    return [(name, payloadBytes) for name, payloadBytes in cases
+            if (smallest <= payloadBytes <= capacityBytes)]
+
+
+# Best wall time of repeat runs of function(), each given a fresh copy of
+# the carrier. The schedule cache is cleared first unless warm is set
+def time_runs(function, carrier, repeat, warm):
+    best = None
+
+    for i in range(repeat):
+        imageWorker = carrier.copy()
+        if (warm == False):
+            stegano.scheduleCache.clear()
+
+        startTime = time.perf_counter()
+        result = function(imageWorker)
+        seconds = time.perf_counter() - startTime
+
+        if (best is None or seconds < best):
+            best = seconds
+
+    return best, result
+
+
+# Peak traced allocation (Python and NumPy) of one run, in bytes
+def peak_memory(function, carrier, warm):
+    imageWorker = carrier.copy()
+    if (warm == False):
+        stegano.scheduleCache.clear()
+
+    tracemalloc.start()
+    try:
+        function(imageWorker)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+
+# Times one backend on one case -> result dict
+def run_case(carrier, mode, caseName, payloadBytes, backend, options):
+    width, height = carrier.size
+
+    payload = make_payload(mode, payloadBytes)
+    cipherText, keyHexString = stegano.encrypt_payload(
+        BENCHMARK_KEY, payload)
+    header = stegano.make_header(8 * len(cipherText), "zip" if
+                                 (mode == "zip") else "text", options.depth)
+
+    embedBackend = stegano.EMBED_BACKENDS[backend]
+    extractBackend = stegano.EXTRACT_BACKENDS[backend]
+
+    def embed(imageWorker):
+        embedBackend(imageWorker, cipherText, keyHexString, header)
+        return imageWorker
+
+    embedSeconds, encoded = time_runs(embed, carrier, options.repeat,
+                                      options.warm)
+
+    def extract(imageWorker):
+        return extractBackend(imageWorker, keyHexString)
+
+    extractSeconds, (cipherBytes, foundHeader) = time_runs(
+        extract, encoded, options.repeat, options.warm)
+
+    result = {
+        "size": str(width) + "x" + str(height),
+        "mode": mode,
+        "case": caseName,
+        "backend": backend,
+        "depth": options.depth,
+        "payloadBytes": payloadBytes,
+        "sub": (8 * payloadBytes) % 3,
+        "embedSeconds": embedSeconds,
+        "extractSeconds": extractSeconds,
+        "embedMBps": payloadBytes / 1e6 / embedSeconds,
+        "extractMBps": payloadBytes / 1e6 / extractSeconds,
+        "embedPixelsps": width * height / embedSeconds,
+        "extractPixelsps": width * height / extractSeconds,
+        "roundTrip": (bytes(cipherBytes) == bytes(cipherText)
+                      and foundHeader == header)
+    }
+
+    # Tracing every allocation slows the pure Python loops down ~20x
+    if (options.memory == True
+            and (backend != "legacy" or options.legacy_memory == True)):
+        result["embedPeakBytes"] = peak_memory(embed, carrier, options.warm)
+        result["extractPeakBytes"] = peak_memory(extract, encoded,
+                                                 options.warm)
+
+    return result
+
+
+def case_key(result):
+    if ("profile" in result):
+        return "/".join((result["size"], "encode", result["profile"]))
+
+    key = "/".join((result["size"], result["mode"], result["case"],
+                    result["backend"]))
+
+    if (result.get("depth", 1) != 1):
+        key += "/depth" + str(result["depth"])
+
+    return key
+
+
+# Saves and loads a full carrier with one output profile -> result dict
+def run_encode_case(encoded, profileName, options):
+    width, height = encoded.size
+    imageFormat, saveOptions = stegano.OUTPUT_PROFILES[profileName]
+    encodeSeconds = None
+    decodeSeconds = None
+
+    for i in range(options.repeat):
+        outputBuffer = io.BytesIO()
+        startTime = time.perf_counter()
+        encoded.save(outputBuffer, format=imageFormat, **saveOptions)
+        seconds = time.perf_counter() - startTime
+
+        if (encodeSeconds is None or seconds < encodeSeconds):
+            encodeSeconds = seconds
+
+        startTime = time.perf_counter()
+        decoded = Image.open(io.BytesIO(outputBuffer.getvalue()))
+        decoded.load()
+        seconds = time.perf_counter() - startTime
+
+        if (decodeSeconds is None or seconds < decodeSeconds):
+            decodeSeconds = seconds
+
+    fileBytes = len(outputBuffer.getvalue())
+
+    return {
+        "size": str(width) + "x" + str(height),
+        "profile": profileName,
+        "format": imageFormat,
+        "encodeSeconds": encodeSeconds,
+        "decodeSeconds": decodeSeconds,
+        "fileBytes": fileBytes,
+        "bitsPerPixel": 8 * fileBytes / (width * height),
+        "roundTrip": np.array_equal(np.asarray(decoded), np.asarray(encoded))
+    }
+
+
+def print_encode_result(result, baselineResult=None):
+    line = "{:>11} {:<10} {:>9.3f}s {:>9.3f}s {:>12} {:>6.2f} {:>6}".format(
+        result["size"], result["profile"], result["encodeSeconds"],
+        result["decodeSeconds"], result["fileBytes"], result["bitsPerPixel"],
+        "ok" if result["roundTrip"] else "BAD")
+
+    if (baselineResult is not None):
+        line += " {:>6.2f}x {:>6.2f}x".format(
+            result["encodeSeconds"] / baselineResult["encodeSeconds"],
+            result["decodeSeconds"] / baselineResult["decodeSeconds"])
+
+    print(line, flush=True)
+
+
+def print_encode_header(baseline):
+    line = "{:>11} {:<10} {:>10} {:>10} {:>12} {:>6} {:>6}".format(
+        "size", "profile", "save", "load", "bytes", "bpp", "trip")
+
+    if (baseline is not None):
+        line += " {:>7} {:>7}".format("sav/bl", "lod/bl")
+
+    print(line)
+
+
+def print_result(result, options, baselineResult=None):
+    line = "{:>11} {:>4} {:<14} {:<7} {:>10} {:>9.3f}s {:>9.3f}s " \
+        "{:>9.2f} {:>9.2f} {:>7.1f} {:>6}".format(
+            result["size"], result["mode"], result["case"], result["backend"],
+            result["payloadBytes"], result["embedSeconds"],
+            result["extractSeconds"], result["embedMBps"],
+            result["extractMBps"], result["embedPixelsps"] / 1e6,
+            "ok" if result["roundTrip"] else "BAD")
+
+    if ("embedPeakBytes" in result):
+        line += " {:>8.1f} {:>8.1f}".format(result["embedPeakBytes"] / 2**20,
+                                            result["extractPeakBytes"] / 2**20)
+    elif (options.memory == True):
+        line += " {:>8} {:>8}".format("-", "-")
+
+    if (baselineResult is not None):
+        line += " {:>6.2f}x {:>6.2f}x".format(
+            result["embedSeconds"] / baselineResult["embedSeconds"],
+            result["extractSeconds"] / baselineResult["extractSeconds"])
+
+    print(line, flush=True)
+
+
+def print_header(options, baseline):
+    line = "{:>11} {:>4} {:<14} {:<7} {:>10} {:>10} {:>10} {:>9} {:>9} " \
+        "{:>7} {:>6}".format("size", "mode", "case", "backend", "bytes",
+                             "embed", "extract", "emb MB/s", "ext MB/s",
+                             "Mpx/s", "trip")
+
+    if (options.memory == True):
+        line += " {:>8} {:>8}".format("emb MiB", "ext MiB")
+
+    if (baseline is not None):
+        line += " {:>7} {:>7}".format("emb/bl", "ext/bl")
+
+    print(line)
+
+
+# Slower-than-baseline cases -> list of messages
+def compare(results, baseline, tolerance, minSeconds=MIN_COMPARE_SECONDS):
+    regressions = []
+
+    for result in results:
+        baselineResult = baseline.get(case_key(result))
+        if (baselineResult is None):
+            continue
+
+        if ("profile" in result):
+            fields = ("encodeSeconds", "decodeSeconds")
+        else:
+            fields = ("embedSeconds", "extractSeconds")
+
+        for field in fields:
+            if (baselineResult[field] < minSeconds):
+                continue
+
+            ratio = result[field] / baselineResult[field]
+            if (ratio > 1 + tolerance):
+                regressions.append("{} {}: {:.3f}s vs {:.3f}s ({:.2f}x)".format(
+                    case_key(result), field, result[field],
+                    baselineResult[field], ratio))
+
+    return regressions
+
+
+# The backend table -- every case of every carrier size and mode
+def run_backend_cases(sizes, modes, backends, options, baseline):
+    print_header(options, baseline)
+
+    results = []
+    for width, height in sizes:
+        carrier = make_carrier(width, height)
+
+        for mode in modes:
+            for caseName, payloadBytes in payload_cases(
+                    width, height, mode, options.depth):
+                for backend in backends:
+                    # The legacy backend only embeds 1 bit per channel
+                    if (backend == "legacy"
+                            and (width * height > options.legacy_max_pixels
+                                 or options.depth != 1)):
+                        continue
+
+                    result = run_case(carrier, mode, caseName, payloadBytes,
+                                      backend, options)
+                    results.append(result)
+
+                    print_result(
+                        result, options, None if (baseline is None) else
+                        baseline.get(case_key(result)))
+
+    return results
+
+
+# The --encode table -- every output profile on every carrier size
+def run_encode_cases(sizes, profiles, options, baseline):
+    print_encode_header(baseline)
+
+    results = []
+    for width, height in sizes:
+        # A carrier filled to capacity -- its LSBs are as random as those of
+        # a real encoded image
+        encoded = make_smooth_carrier(width, height)
+        payload = make_payload("text", (width * height - width) * 3 // 8)
+        cipherText, keyHexString = stegano.encrypt_payload(
+            BENCHMARK_KEY, payload)
+        stegano.numpy_embed(encoded, cipherText, keyHexString,
+                            stegano.make_header(8 * len(cipherText)))
+
+        for profileName in profiles:
+            result = run_encode_case(encoded, profileName, options)
+            results.append(result)
+
+            print_encode_result(
+                result, None if (baseline is None) else
+                baseline.get(case_key(result)))
+
+    return results
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stegano.py backends")
+    parser.add_argument("--sizes",
+                        help="comma separated WIDTHxHEIGHT carriers "
+                        "(default: 100x100 up to 8000x8000)")
+    parser.add_argument("--quick",
+                        action="store_true",
+                        help="only the carriers up to 1000x1000")
+    parser.add_argument("--modes",
+                        default=",".join(MODES),
+                        help="comma separated: text, zip")
+    parser.add_argument("--backends",
+                        default=",".join(stegano.EMBED_BACKENDS),
+                        help="comma separated backends to time")
+    parser.add_argument("--legacy-max-pixels",
+                        type=int,
+                        default=LEGACY_MAX_PIXELS,
+                        help="skip the legacy backend on larger carriers")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=1,
+                        help="runs per case, the best time counts")
+    parser.add_argument("--warm",
+                        action="store_true",
+                        help="keep the schedule cache between runs")
+    parser.add_argument("--no-memory",
+                        dest="memory",
+                        action="store_false",
+                        help="skip the (slower) peak memory runs")
+    parser.add_argument("--legacy-memory",
+                        action="store_true",
+                        help="also trace the memory of the legacy backend "
+                        "(very slow)")
+    parser.add_argument("--depth",
+                        type=int,
+                        default=1,
+                        help="low bits per channel to embed into (numpy "
+                        "backend only above 1)")
+    parser.add_argument("--encode",
+                        action="store_true",
+                        help="time the lossless output profiles instead of "
+                        "the backends")
+    parser.add_argument("--profiles",
+                        default=",".join(stegano.OUTPUT_PROFILES),
+                        help="comma separated output profiles for --encode")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against this file")
+    parser.add_argument("--save-baseline",
+                        help="write the results as a baseline file")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.25,
+                        help="allowed slowdown against the baseline "
+                        "(default 0.25 = 25%%)")
+    parser.add_argument("--min-seconds",
+                        type=float,
+                        default=MIN_COMPARE_SECONDS,
+                        help="only compare the times of cases that took at "
+                        "least this long in the baseline (default 0.01)")
+    options = parser.parse_args(argv)
+
+    if (options.sizes):
+        sizes = [parse_size(size) for size in options.sizes.split(",")]
+    elif (options.quick):
+        sizes = QUICK_SIZES
+    else:
+        sizes = SIZES
+
+    modes = options.modes.split(",")
+    backends = options.backends.split(",")
+
+    baseline = None
+    if (options.baseline):
+        with open(options.baseline) as f:
+            baseline = {
+                case_key(result): result
+                for result in json.load(f)["results"]
+            }
+
+    if (options.encode == True):
+        results = run_encode_cases(sizes, options.profiles.split(","),
+                                   options, baseline)
+    else:
+        results = run_backend_cases(sizes, modes, backends, options,
+                                    baseline)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "repeat": options.repeat,
+        "warm": options.warm,
+        "results": results
+    }
+
+    for fileName in (options.json, options.save_baseline):
+        if (fileName):
+            with open(fileName, "w") as f:
+                json.dump(report, f, indent=1)
+
+    # A case that doesn't round-trip fails the run, baseline or not
+    broken = [
+        case_key(result) for result in results
+        if (result["roundTrip"] == False)
+    ]
+
+    if (len(broken) > 0):
+        print()
+        print(str(len(broken)) + " case(s) didn't round-trip:")
+        for caseName in broken:
+            print("  " + caseName)
+
+    if (baseline is not None):
+        regressions = compare(results, baseline, options.tolerance,
+                              options.min_seconds)
+
+        print()
+        if (len(regressions) == 0):
+            print("No regressions against " + options.baseline)
+        else:
+            print(str(len(regressions)) + " regression(s) against " +
+                  options.baseline + ":")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+
+    return 1 if (len(broken) > 0) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
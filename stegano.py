@@ -57,27 +57,394 @@ SOFTWARE.
 
 from pyfiglet import Figlet, FigletFont
 from PIL import Image
-from bitstring import BitArray
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from colorama import init
 from colorama import Fore, Back, Style
 from termcolor import colored
+import numpy as np
 # from progress_bar import ProgressBar, InitBar
 
 import sys
 import os
 import hashlib
+import hmac
 import random
 import zipfile
 import send2trash
 import time
 import shutil
+import collections
+import itertools
+import io
+import struct
+import zlib
+import lzma
+import bz2
+import json
+import sqlite3
+import csv
+import argparse
+import glob
+import concurrent.futures
+import http.server
+import urllib.parse
+import email.parser
+import email.policy
+import contextlib
+import threading
+import tracemalloc
 
 
 # To make termcolor works
 init()
 
+# Which embedding engine hide() uses -- see EMBED_BACKENDS
+DEFAULT_BACKEND = "numpy"
+
+# zip header -> 50 4B 03 04 = first 31 bits, written after the length header
+ZIP_HEADER_BINARY = "1010000010010110000001100000100"
+
+# Low bits per channel hide() can use -- 1 is the original format
+MAX_DEPTH = 4
+
+# Row 0 header -- a stream of bits in the LSBs of the color channels of
+# row 0 (R, G and B of every pixel, or its gray value). In the original
+# layout the 30 bit cipher length comes first, then the zip magic (zip mode
+# only)
+ZIP_HEADER_OFFSET = 30
+
+# Versioned header, written over the same bits when the original layout
+# can't describe the image -- "BPS", the version, the payload kind and
+# codec (4 bits each), depth - 1, the alpha lane flag and the placement
+# (2, 1 and 2 bits), the 64 bit cipher length and the low 16 bits of the
+# CRC-32 of all that. 16 bytes in all
+HEADER_MAGIC = b"BPS"
+HEADER_VERSION = 2
+HEADER_STRUCT = struct.Struct(">3sBBBQH")
+
+# Shard block, right after the versioned header of an image that holds one
+# piece of a payload spread over several carriers (flagged in the layout
+# byte) -- the payload ID, the shard's index and the shard count (16 bits
+# each), the byte offset of the piece in the cipher and the size of the
+# whole cipher (64 bits each), the cipher block in front of the piece and
+# the low 16 bits of their CRC-32. Pieces start on an AES block, so with the
+# block before it as IV every piece decrypts on its own (CFB mode)
+SHARD_STRUCT = struct.Struct(">8sHHQQ16sH")
+SHARD_FLAG = 0x20
+
+# Header codes of the payload kinds, compression codecs and pixel
+# placements -- the index is the code
+PAYLOAD_KINDS = ("text", "zip", "raw")
+PAYLOAD_CODECS = ("none", "zlib", "lzma", "bz2")
+PLACEMENTS = ("scatter", )
+
+# The original layout's length field
+ORIGINAL_MAX_CIPHER_BITS = (1 << 30) - 1
+
+# Codec -> (compress, decompress) of the text and raw payloads. "auto"
+# compresses up to three samples of this many bytes (start, middle, end)
+# with each of them and picks the smallest
+PAYLOAD_COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+    "bz2": (bz2.compress, bz2.decompress)
+}
+CODEC_SAMPLE_BYTES = 64 * 1024
+
+# Codec -> incremental compressor, for payloads that are encrypted as they
+# are read (see CipherSink)
+PAYLOAD_STREAM_COMPRESSORS = {
+    "zlib": zlib.compressobj,
+    "lzma": lzma.LZMACompressor,
+    "bz2": bz2.BZ2Compressor
+}
+
+# Codec -> incremental decompressor, for payloads that are reassembled on
+# disk instead of in memory (see join_shards())
+PAYLOAD_DECOMPRESSORS = {
+    "zlib": zlib.decompressobj,
+    "lzma": lzma.LZMADecompressor,
+    "bz2": bz2.BZ2Decompressor
+}
+
+# Key check block, right after a versioned header when row 0 has room --
+# "BPSK" and the first 4 bytes of an HMAC-SHA256 of the header under the
+# mask key, so find() turns a wrong key away before scanning anything.
+# Readers that don't know it ignore it
+KEY_TAG_MAGIC = b"BPSK"
+KEY_TAG_BYTES = 4
+
+# Color channels of the image modes hide() takes -- they carry the header
+# and the payload, the alpha channel carries payload as well on request
+COLOR_LANES = {"RGB": 3, "RGBA": 3, "L": 1, "LA": 1}
+
+# Memory bound of the pixel schedule cache -- see ScheduleCache
+SCHEDULE_CACHE_BYTES = 256 * 1024 * 1024
+
+# Mersenne Twister words per MaskStream checkpoint (32 mask bits each)
+MASK_CHUNK_WORDS = 65536
+
+# Bytes the AES-CFB cipher and the bit expansion handle at a time -- a
+# multiple of 3 so every chunk's bits fill whole pixels (3 bits each)
+CIPHER_CHUNK_BYTES = 3 * 256 * 1024
+AES_BLOCK_BYTES = 16
+
+# Strip processing (hide/find with a memoryBudget) -- working memory of one
+# band, in bytes per byte of decoded row data (the band, the reader's
+# filtered rows and the writer's filter candidates) plus bytes per pixel
+# (the int64 positions, slot numbers and symbol indices the schedule code
+# builds, as many for an L image as for an RGBA one)
+STRIP_ROW_COST = 24
+STRIP_PIXEL_COST = 80
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_MODES = {0: "L", 2: "RGB", 4: "LA", 6: "RGBA"}
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+
+# Lossless output profiles -- name -> (Pillow format, save options). "png"
+# keeps Pillow's defaults, "png-fast" trades a few percent of file size for
+# a much faster save, TIFF/BMP/PPM aren't compressed at all
+OUTPUT_PROFILES = {
+    "png": ("PNG", {}),
+    "png-fast": ("PNG", {
+        "compress_level": 1
+    }),
+    "png-small": ("PNG", {
+        "compress_level": 9,
+        "optimize": True
+    }),
+    "tiff": ("TIFF", {
+        "compression": "raw"
+    }),
+    "bmp": ("BMP", {}),
+    "ppm": ("PPM", {}),
+    "webp": ("WEBP", {
+        "lossless": True,
+        "exact": True
+    }),
+    "webp-fast": ("WEBP", {
+        "lossless": True,
+        "exact": True,
+        "quality": 0,
+        "method": 0
+    })
+}
+
+# Image file extension -> the output profile it gets by default
+OUTPUT_EXTENSIONS = {
+    ".png": "png",
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".bmp": "bmp",
+    ".ppm": "ppm",
+    ".webp": "webp"
+}
+
+# Image modes each output format stores unchanged -- any other mode would
+# be converted on save (L to RGB in WebP, RGBA to RGB in BMP and PPM) or
+# fail after the embedding, losing the hidden bits
+FORMAT_MODES = {
+    "PNG": ("RGB", "RGBA", "L", "LA"),
+    "TIFF": ("RGB", "RGBA", "L", "LA"),
+    "BMP": ("RGB", "L"),
+    "PPM": ("RGB", "L"),
+    "WEBP": ("RGB", "RGBA")
+}
+
+# Carrier index (see build_carrier_index()) -- one row per carrier with
+# what invalidates it (mtime, size, SHA-256) and what capacity queries need.
+# capacityBits is carrier.capacity_bits() at depth 1, and the capacity at
+# depth N is N times that; alphaCapacityBits the same with the alpha lane.
+# Both are NULL for carriers hide() can't take. The capacities view spells
+# them out in bytes for every depth
+CARRIER_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS carriers (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    channels INTEGER NOT NULL,
+    colorLanes INTEGER,
+    capacityBits INTEGER,
+    alphaCapacityBits INTEGER
+);
+CREATE INDEX IF NOT EXISTS carriersByCapacity ON carriers (capacityBits);
+CREATE INDEX IF NOT EXISTS carriersByAlphaCapacity
+    ON carriers (alphaCapacityBits);
+CREATE VIEW IF NOT EXISTS capacities AS SELECT path, mode, width, height, """ + \
+    ", ".join("capacityBits * " + str(depth) + " / 8 AS depth" + str(depth) +
+              ", alphaCapacityBits * " + str(depth) + " / 8 AS alphaDepth" +
+              str(depth) for depth in range(1, MAX_DEPTH + 1)) + \
+    " FROM carriers;"
+
+# Index rows written per transaction, so an interrupted build keeps what
+# it had done
+CARRIER_INDEX_BATCH = 1000
+
+# HTTP service mode (see serve()) -- it only listens on localhost, refuses
+# bodies over SERVE_MAX_BODY_BYTES with 413 and lets no more than
+# SERVE_QUEUE_JOBS jobs wait for a worker; the next ones get 429
+SERVE_HOST = "127.0.0.1"
+SERVE_MAX_BODY_BYTES = 256 * 1024 * 1024
+SERVE_QUEUE_JOBS = 16
+
+# The StageProfiler profile_stage() reports to, per thread -- see below
+profilerState = threading.local()
+
+
+# Records wall time, CPU time and peak traced memory (tracemalloc) of the
+# named stages hide()/find() go through while it's active:
+#
+#     with StageProfiler() as profiler:
+#         hide(...)
+#     print(profiler.to_json())
+#
+# A stage started inside another one is reported as parent/child, and a
+# stage that runs more than once is added up. peakBytes is the most memory
+# allocated on top of what was allocated when the stage started
+class StageProfiler:
+
+    def __init__(self, traceMemory=True):
+        self.traceMemory = traceMemory
+        self.stages = {}
+        self.openStages = []
+        self.wallSeconds = 0.0
+        self.cpuSeconds = 0.0
+        self.startedTracing = False
+
+    def __enter__(self):
+        self.previous = getattr(profilerState, "profiler", None)
+        profilerState.profiler = self
+
+        if (self.traceMemory == True and not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            self.startedTracing = True
+
+        self.startWall = time.perf_counter()
+        self.startCpu = time.process_time()
+
+        return self
+
+    def __exit__(self, *excInfo):
+        self.wallSeconds += time.perf_counter() - self.startWall
+        self.cpuSeconds += time.process_time() - self.startCpu
+
+        profilerState.profiler = self.previous
+
+        if (self.startedTracing == True):
+            tracemalloc.stop()
+            self.startedTracing = False
+
+        return False
+
+    # Folds the traced peak since the last reset into every open stage
+    def fold_peak(self):
+        if (tracemalloc.is_tracing()):
+            peak = tracemalloc.get_traced_memory()[1]
+
+            for openStage in self.openStages:
+                openStage[1] = max(openStage[1], peak)
+
+            # Python < 3.9 can't reset it -- the peak is then the highest
+            # since tracing started
+            if (hasattr(tracemalloc, "reset_peak")):
+                tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        path = "/".join([openStage[2] for openStage in self.openStages] +
+                        [name])
+
+        self.fold_peak()
+        current = tracemalloc.get_traced_memory()[0] if (
+            tracemalloc.is_tracing()) else 0
+
+        # [allocated at the start, peak so far, name]
+        openStage = [current, current, name]
+        self.openStages.append(openStage)
+
+        startWall = time.perf_counter()
+        startCpu = time.process_time()
+
+        try:
+            yield
+        finally:
+            wallSeconds = time.perf_counter() - startWall
+            cpuSeconds = time.process_time() - startCpu
+
+            self.fold_peak()
+            self.openStages.pop()
+
+            stats = self.stages.setdefault(path, {
+                "calls": 0,
+                "wallSeconds": 0.0,
+                "cpuSeconds": 0.0,
+                "peakBytes": 0
+            })
+            stats["calls"] += 1
+            stats["wallSeconds"] += wallSeconds
+            stats["cpuSeconds"] += cpuSeconds
+            stats["peakBytes"] = max(stats["peakBytes"],
+                                     openStage[1] - openStage[0])
+
+    # Structured report -- stages in the order they first started
+    def report(self):
+        return {
+            "wallSeconds": self.wallSeconds,
+            "cpuSeconds": self.cpuSeconds,
+            "traceMemory": self.traceMemory,
+            "stages": [
+                dict(name=path, **stats)
+                for path, stats in self.stages.items()
+            ]
+        }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=1)
+
+    def format_report(self):
+        lines = [
+            "{:<24} {:>6} {:>10} {:>10} {:>10}".format(
+                "stage", "calls", "wall (s)", "cpu (s)", "peak (MiB)")
+        ]
+
+        for stage in self.report()["stages"]:
+            lines.append("{:<24} {:>6} {:>10.4f} {:>10.4f} {:>10.2f}".format(
+                stage["name"], stage["calls"], stage["wallSeconds"],
+                stage["cpuSeconds"], stage["peakBytes"] / 2**20))
+
+        lines.append("{:<24} {:>6} {:>10.4f} {:>10.4f}".format(
+            "total", "", self.wallSeconds, self.cpuSeconds))
+
+        return "\n".join(lines)
+
+
+NO_PROFILE_STAGE = contextlib.nullcontext()
+
+
+# with profile_stage("name"): ... -- timed by the active StageProfiler, a
+# shared no-op when nothing is being profiled
+def profile_stage(name):
+    profiler = getattr(profilerState, "profiler", None)
+
+    if (profiler is None):
+        return NO_PROFILE_STAGE
+
+    return profiler.stage(name)
+
+
+# Calls function(*args, **kwargs) under a fresh StageProfiler and returns
+# (its result, the profile report)
+def profile_call(function, *args, **kwargs):
+    with StageProfiler() as profiler:
+        result = function(*args, **kwargs)
+
+    return result, profiler.report()
+
 
 def print_current_files(files):
     print()
@@ -90,61 +457,162 @@ def print_current_files(files):
     print()
 
 
-def total_available_space(fileName, files, encryptionKey):
-    # Create zip archive with the files
-
-    zippedFileInput = zipfile.ZipFile("input.zip",
-                                      "w",
-                                      compression=zipfile.ZIP_DEFLATED)
-
-    # Write files to the zipped folder
-    for i in files:
-        zippedFileInput.write(i)
-
-    zippedFileInput.close()
-
-    # Read in as bytes
-    with open("input.zip", "rb") as f:
-        zippedBytes = f.read()
+# Keeps the exact size of the archive hide() will build for a list of files
+# without writing it. Every file is deflated once to learn its compressed
+# size (cached by path, size and mtime), and the zip layout is added up:
+# local header + data per member, a central directory entry per member and
+# the end of central directory record. AES-CFB doesn't pad, so the cipher is
+# 8 bits per archive byte. Adding or removing a file is O(1) after that
+class CapacityTracker:
+
+    def __init__(self, width, height, depth=1, lanes=3):
+        self.capacityBits = (width * height - width) * lanes * depth
+        self.memberSizes = {}
+        self.members = {}
+        self.localBytes = 0
+        self.centralBytes = 0
+
+    # (local header + data + data descriptor bytes, central directory
+    # bytes) of one member. hide() zips straight into a CipherSink, which
+    # can't seek, so ZipFile follows every member with a data descriptor
+    def member_size(self, fileName):
+        fileStat = os.stat(fileName)
+        cacheKey = (fileName, fileStat.st_size, fileStat.st_mtime_ns)
+
+        if (cacheKey not in self.memberSizes):
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -15)
+            compressedSize = 0
+
+            with open(fileName, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    compressedSize += len(compressor.compress(chunk))
+            compressedSize += len(compressor.flush())
+
+            # Same arcname ZipFile.write() picks
+            arcName = os.path.normpath(os.path.splitdrive(fileName)[1])
+            arcName = arcName.lstrip(os.sep + (os.altsep or ""))
+            nameLength = len(arcName.replace(os.sep, "/").encode("utf-8"))
+
+            # Files that may need zip64 get a 20 byte extra field and a
+            # 24 byte data descriptor instead of a 16 byte one
+            zip64 = fileStat.st_size * 1.05 > zipfile.ZIP64_LIMIT
+            localExtra = 20 if (zip64 == True) else 0
+            descriptorSize = 24 if (zip64 == True) else 16
+
+            self.memberSizes[cacheKey] = (30 + nameLength + localExtra +
+                                          compressedSize + descriptorSize,
+                                          46 + nameLength)
+
+        return self.memberSizes[cacheKey]
+
+    def add(self, fileName):
+        localSize, centralSize = self.member_size(fileName)
+
+        self.members[fileName] = (localSize, centralSize)
+        self.localBytes += localSize
+        self.centralBytes += centralSize
+
+    def remove(self, fileName):
+        localSize, centralSize = self.members.pop(fileName)
+
+        self.localBytes -= localSize
+        self.centralBytes -= centralSize
+
+    # Members + central directory + end of central directory record
+    def archive_size(self):
+        return self.localBytes + self.centralBytes + 22
+
+    def cipher_bits(self):
+        return self.archive_size() * 8
+
+    # Positions left to encode -- negative if the files don't fit
+    def remaining(self):
+        return self.capacityBits - self.cipher_bits()
+
+
+# One carrier image for one hide job. The header (size and mode) is read
+# when it's created, the pixels are decoded the first time decode() is called
+# and the same decoded image then goes through every check and the embedding.
+# Key material derived for it is cached, so the key is hashed once per job
+class CarrierImage:
+
+    __slots__ = ("fileName", "image", "decoded", "mode", "width", "height",
+                 "keyMaterial")
+
+    # source -- a path, a file object, bytes-like image data, a PIL Image or
+    # a NumPy array. Images and arrays are copied, the caller's stay as is
+    def __init__(self, source):
+        self.fileName = source if isinstance(source,
+                                             (str, os.PathLike)) else None
+
+        if (isinstance(source, (Image.Image, np.ndarray))):
+            self.image = load_carrier(source, copy=True)
+            self.decoded = True
+        else:
+            if (isinstance(source, (bytes, bytearray, memoryview))):
+                source = io.BytesIO(source)
+            self.image = Image.open(source)
+            self.decoded = False
 
-    # ENCRYPT IT
+        self.mode = self.image.mode
+        self.width, self.height = self.image.size
+        self.keyMaterial = {}
 
-    imageWorker = Image.open(fileName)
+    # Returns source itself if it already is a CarrierImage
+    @classmethod
+    def of(cls, source):
+        return source if isinstance(source, cls) else cls(source)
 
-    backend = default_backend()
+    # The decoded PIL image -- decoded on the first call only
+    def decode(self):
+        if (self.decoded == False):
+            self.image.load()
+            self.decoded = True
 
-    key = bytearray()
-    key.extend(map(ord, encryptionKey))
+        return self.image
 
-    shaAlgo = hashlib.sha256()
-    shaAlgo.update(key)
+    # (keyHexString, keyBytes, initVec) of derive_key(), cached per key
+    def key_material(self, encryptionKey):
+        if (encryptionKey not in self.keyMaterial):
+            self.keyMaterial[encryptionKey] = derive_key(encryptionKey)
 
-    keyHexString = shaAlgo.hexdigest()
+        return self.keyMaterial[encryptionKey]
 
-    initVectorHex = keyHexString[0:32]
-    keyHex = keyHexString[32:64]
-    initVec = bytes.fromhex(initVectorHex)
-    keyBytes = bytes.fromhex(keyHex)
+    # Channels per pixel that take payload bits -- see embedding_lanes()
+    def lanes(self, alphaLane=False):
+        return embedding_lanes(self.mode, alphaLane)
 
-    AESCipher = Cipher(algorithms.AES(keyBytes),
-                       modes.CFB(initVec),
-                       backend=backend)
+    # depth bits in every lane of every pixel after row 0
+    def capacity_bits(self, depth=1, alphaLane=False):
+        return (self.width * self.height -
+                self.width) * self.lanes(alphaLane) * depth
 
-    encryptor = AESCipher.encryptor()
-    cipherText = encryptor.update(zippedBytes)
+    # Raises ValueError if the header and the cipher bits it announces
+    # don't fit -- see check_capacity()
+    def check_capacity(self, header):
+        check_capacity(self.width, self.height, header, self.mode)
 
-    cipherBits = BitArray(bytes=cipherText).bin
+    # Raises ValueError if the encoded image can't be saved as dstImgFile
+    # -- see check_output_mode()
+    def check_output(self, dstImgFile, outputProfile=None):
+        check_output_mode(self.mode, dstImgFile, outputProfile)
 
-    cipherBitsLength = len(cipherBits)
 
-    totalEncodablePixels = (imageWorker.size[0] *
-                            imageWorker.size[1]) - imageWorker.size[0]
+def total_available_space(fileName,
+                          files,
+                          encryptionKey,
+                          depth=1,
+                          alphaLane=False):
+    carrier = CarrierImage.of(fileName)
 
-    difference = (totalEncodablePixels * 3) - cipherBitsLength
+    capacityTracker = CapacityTracker(carrier.width, carrier.height, depth,
+                                      carrier.lanes(alphaLane))
 
-    send2trash.send2trash("input.zip")
+    for i in files:
+        capacityTracker.add(i)
 
-    return cipherBitsLength, difference
+    return capacityTracker.cipher_bits(), capacityTracker.remaining()
 
 
 # Checks if the file exists and can be opened and
@@ -178,36 +646,32 @@ def check_file_exists(fileName, files):
         return 1
 
 
-# Checks the extension of an image file
+# Checks the extension of an image file -- any of the lossless formats
 def check_extension(fileName):
-    extension = fileName[-4:].lower()
+    extension = os.path.splitext(fileName)[1].lower()
 
-    if (extension != '.png'):
+    if (extension not in OUTPUT_EXTENSIONS):
         print()
         print(
             colored(
-                "Invalid file type -- Images must be in PNG format. Try again!",
-                'red'))
+                "Invalid file type -- Images must be in PNG, TIFF, BMP, PPM "
+                "or WebP format. Try again!", 'red'))
         print()
         return 1
     else:
         return 0
 
 
-# Checks if the image has enough space for the zip header
-def check_file_size_zip(fileName):
+# Opens the source image once for the checks and hide() -- None (after an
+# error message) if it can't be read as an image
+def open_carrier(fileName):
     try:
-        imageWorker = Image.open(fileName)
-        length = imageWorker.size[0]
-
-        if (length < 21):
-            return 1
-        else:
-            return 0
-    except:
+        return CarrierImage(fileName)
+    except Exception:
         print()
         print(colored("Invalid file. Try again!", 'red'))
         print()
+        return None
 
 
 # Checks both the file extension and whether or not the file can be opened or not
@@ -230,55 +694,768 @@ def check_file(fileName):
         return 1
 
 
-def check_image_size(fileName, secretMsg, encryptionKey):
-    imageWorker = Image.open(fileName)
+def check_image_size(fileName,
+                     secretMsg,
+                     encryptionKey,
+                     depth=1,
+                     alphaLane=False,
+                     compression=None):
+    carrier = CarrierImage.of(fileName)
 
-    backend = default_backend()  # Default backend for the AES
+    # AES256.CFB doesn't pad -- the cipher is as long as the (compressed)
+    # message, so there's no need to encrypt it just to count its bits
+    codec, plainBytes = compress_payload(secretMsg.encode(), compression)
+    cipherBitsLength = 8 * len(plainBytes)
 
-    key = bytearray()  # Create a byte array to store the
-    key.extend(map(ord, encryptionKey))
+    try:
+        carrier.check_capacity(
+            make_header(cipherBitsLength, "text", depth, alphaLane, codec))
+    except ValueError as e:
+        print()
+        print(colored(str(e) + ". Try again!", 'red'))
+        print()
+        return 1
+    else:
+        return 0
 
-    shaAlgo = hashlib.sha256()
-    shaAlgo.update(key)
 
-    keyHexString = shaAlgo.hexdigest()
+# "0101" -> array([0, 1, 0, 1], dtype=uint8)
+def bitstring_to_array(s):
+    return np.frombuffer(s.encode(), dtype=np.uint8) - ord("0")
 
-    secretMsgBytes = secretMsg.encode()
 
-    # Split hash into initVector and AES key
-    initVectorHex = keyHexString[0:32]
-    keyHex = keyHexString[32:64]
-    initVec = bytes.fromhex(initVectorHex)
-    keyBytes = bytes.fromhex(keyHex)
+# A packed sequence of bits -- 8 per byte of a bytearray, most significant
+# bit first (the np.packbits() order), so bit i lives in data[i >> 3]. Bits
+# past length in the last byte are always 0, which makes tobytes() the same
+# as np.packbits() of the bits. A bytearray passed in is wrapped, not copied
+class BitBuffer:
 
-    # Create the encryption cipher -- AES256.CFB -- no padding required
-    AESCipher = Cipher(algorithms.AES(keyBytes),
-                       modes.CFB(initVec),
-                       backend=backend)
-    encryptor = AESCipher.encryptor()
-    cipherText = encryptor.update(secretMsgBytes)
-    cipherBits = BitArray(bytes=cipherText).bin
-    cipherBitsLength = len(cipherBits)
+    def __init__(self, data=b"", length=None):
+        self.data = data if isinstance(data, bytearray) else bytearray(data)
+        self.length = 8 * len(self.data) if (length is None) else length
 
-    totalEncodablePixels = (imageWorker.size[0] *
-                            imageWorker.size[1]) - imageWorker.size[0]
+    @classmethod
+    def zeros(cls, length):
+        return cls(bytes((length + 7) // 8), length)
 
-    if ((totalEncodablePixels * 3) < cipherBitsLength):
-        print()
-        print(colored("The image is too small. Try again!", 'red'))
-        print()
-        return 1
+    @classmethod
+    def from_array(cls, bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        return cls(np.packbits(bits).tobytes(), bits.size)
+
+    @classmethod
+    def from_bitstring(cls, s):
+        return cls.from_array(bitstring_to_array(s))
+
+    # The bits of bin(value)[2:].zfill(width)[:width] -- a value that is
+    # too long keeps its top width bits
+    @classmethod
+    def from_int(cls, value, width):
+        bitLength = value.bit_length()
+        if (bitLength > width):
+            value >>= bitLength - width
+
+        byteCount = (width + 7) // 8
+        return cls((value << (8 * byteCount - width)).to_bytes(
+            byteCount, "big"), width)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if (isinstance(index, slice)):
+            return BitBuffer.from_array(self.to_array()[index])
+
+        if (index < 0):
+            index += self.length
+        if (index < 0 or index >= self.length):
+            raise IndexError("bit index out of range")
+
+        return (self.data[index >> 3] >> (7 - (index & 7))) & 1
+
+    def __eq__(self, other):
+        return (isinstance(other, BitBuffer) and self.length == other.length
+                and self.view() == other.view())
+
+    def append(self, bit):
+        if (self.length & 7 == 0):
+            self.data.append(0)
+        if (bit):
+            self.data[self.length >> 3] |= 0x80 >> (self.length & 7)
+        self.length += 1
+
+    def extend(self, bits):
+        if (isinstance(bits, BitBuffer) and self.length & 7 == 0):
+            self.data += bits.view()
+            self.length += bits.length
+        else:
+            for bit in bits:
+                self.append(bit)
+
+    # Sets the bits at indices (an array) to values (0's and 1's)
+    def set_bits(self, indices, values):
+        byteArray = np.frombuffer(self.data, dtype=np.uint8)
+        shift = (7 - (indices & 7)).astype(np.uint8)
+
+        np.bitwise_and.at(byteArray, indices >> 3,
+                          ~(np.uint8(1) << shift))
+        np.bitwise_or.at(byteArray, indices >> 3,
+                         np.asarray(values, dtype=np.uint8) << shift)
+
+    # The bits at indices (an array) as an array of 0's and 1's
+    def take(self, indices):
+        byteArray = np.frombuffer(self.data, dtype=np.uint8)
+        return (byteArray[indices >> 3] >> (7 - (indices & 7))) & 1
+
+    # The values of the depth bits (first bit highest) starting at bit
+    # depth * i for every i in indices -- bits past the end read as 0
+    def take_symbols(self, indices, depth):
+        values = np.zeros(indices.size, dtype=np.uint8)
+
+        for plane in range(depth):
+            bitIndex = indices * depth + plane
+            inRange = bitIndex < self.length
+            planeBits = self.take(np.where(inRange, bitIndex, 0)) & inRange
+            values |= (planeBits << (depth - 1 - plane)).astype(np.uint8)
+
+        return values
+
+    # Inverse of take_symbols() -- bits past the end are dropped
+    def set_symbols(self, indices, values, depth):
+        for plane in range(depth):
+            bitIndex = indices * depth + plane
+            inRange = bitIndex < self.length
+            self.set_bits(bitIndex[inRange],
+                          (values[inRange] >> (depth - 1 - plane)) & 1)
+
+    def to_array(self):
+        return np.unpackbits(np.frombuffer(self.data, dtype=np.uint8),
+                             count=self.length)
+
+    def to_int(self):
+        return int.from_bytes(self.view(), "big") >> (-self.length & 7)
+
+    # Zero-copy view of the packed bytes
+    def view(self):
+        return memoryview(self.data)[:(self.length + 7) // 8]
+
+    def tobytes(self):
+        return bytes(self.view())
+
+
+# zip header -> 50 4B 03 04 as bits -- see ZIP_HEADER_BINARY
+ZIP_HEADER_BITS = BitBuffer.from_bitstring(ZIP_HEADER_BINARY)
+
+# What the row 0 header of an image says about its payload -- see
+# make_header(). length is the cipher length in bits
+StegoHeader = collections.namedtuple("StegoHeader",
+                                     ("version", "length", "kind", "codec",
+                                      "depth", "alphaLane", "placement",
+                                      "shard"),
+                                     defaults=(None, ))
+
+# The shard block of a StegoHeader -- see SHARD_STRUCT. offset and
+# cipherBytes count bytes; chainBlock is zeros for the first piece, which
+# decrypts with the key's IV
+ShardInfo = collections.namedtuple("ShardInfo",
+                                   ("payloadId", "index", "count", "offset",
+                                    "cipherBytes", "chainBlock"))
+
+
+# The header hide() writes for a cipher of cipherBitsLength bits -- the
+# original layout (version 1) whenever it can describe the image, so older
+# versions still read it, the versioned header otherwise. shard is the
+# ShardInfo of one piece of a sharded payload
+def make_header(cipherBitsLength,
+                kind="text",
+                depth=1,
+                alphaLane=False,
+                codec="none",
+                placement="scatter",
+                shard=None):
+    if (kind not in PAYLOAD_KINDS):
+        raise ValueError("Unknown payload kind " + str(kind))
+
+    if (codec not in PAYLOAD_CODECS):
+        raise ValueError("Unknown payload codec " + str(codec))
+
+    if (placement not in PLACEMENTS):
+        raise ValueError("Unknown placement " + str(placement))
+
+    original = (kind in ("text", "zip") and codec == "none" and depth == 1
+                and alphaLane == False and placement == "scatter"
+                and shard is None
+                and cipherBitsLength <= ORIGINAL_MAX_CIPHER_BITS)
+
+    return StegoHeader(1 if (original == True) else HEADER_VERSION,
+                       cipherBitsLength, kind, codec, depth, alphaLane,
+                       placement, shard)
+
+
+# Packs fields with a struct whose last field is a CRC-16 -- the low 16
+# bits of the CRC-32 of everything before it
+def pack_checked(structure, *fields):
+    data = structure.pack(*fields, 0)[:-2]
+
+    return data + struct.pack(">H", zlib.crc32(data) & 0xFFFF)
+
+
+# Versioned header -> its HEADER_STRUCT bytes, followed by the SHARD_STRUCT
+# bytes of a shard
+def pack_header(header):
+    data = pack_checked(
+        HEADER_STRUCT, HEADER_MAGIC, header.version,
+        (PAYLOAD_KINDS.index(header.kind) << 4)
+        | PAYLOAD_CODECS.index(header.codec),
+        (header.depth - 1) | (4 if (header.alphaLane == True) else 0)
+        | (PLACEMENTS.index(header.placement) << 3)
+        | (SHARD_FLAG if (header.shard is not None) else 0), header.length)
+
+    if (header.shard is not None):
+        data += pack_checked(SHARD_STRUCT, *header.shard)
+
+    return data
+
+
+# The bytes at the start of row 0 -> the versioned header, or None if they
+# aren't one. Raises ValueError for a header this version can't read or a
+# damaged shard block
+def unpack_header(data):
+    if (len(data) < HEADER_STRUCT.size):
+        return None
+
+    magic, version, kindCodec, layout, length, check = HEADER_STRUCT.unpack(
+        data[:HEADER_STRUCT.size])
+
+    if (magic != HEADER_MAGIC or version < 2 or check !=
+            zlib.crc32(data[:HEADER_STRUCT.size - 2]) & 0xFFFF):
+        return None
+
+    kind = kindCodec >> 4
+    codec = kindCodec & 0x0F
+    placement = (layout >> 3) & 3
+
+    if (version > HEADER_VERSION or kind >= len(PAYLOAD_KINDS)
+            or codec >= len(PAYLOAD_CODECS)
+            or placement >= len(PLACEMENTS) or layout >> 6 != 0):
+        raise ValueError(
+            "The image was written by a newer version of BPS Stegano")
+
+    shard = None
+    if (layout & SHARD_FLAG):
+        block = data[HEADER_STRUCT.size:HEADER_STRUCT.size +
+                     SHARD_STRUCT.size]
+
+        if (len(block) < SHARD_STRUCT.size
+                or SHARD_STRUCT.unpack(block)[-1] !=
+                zlib.crc32(block[:-2]) & 0xFFFF):
+            raise ValueError("The shard block of the image is damaged")
+
+        shard = ShardInfo(*SHARD_STRUCT.unpack(block)[:-1])
+
+        if (shard.index >= shard.count or shard.offset % AES_BLOCK_BYTES != 0
+                or shard.offset + length // 8 > shard.cipherBytes):
+            raise ValueError("The shard block of the image is damaged")
+
+    return StegoHeader(version, length, PAYLOAD_KINDS[kind],
+                       PAYLOAD_CODECS[codec], (layout & 3) + 1,
+                       layout & 4 == 4, PLACEMENTS[placement], shard)
+
+
+# Channels of a pixel that take payload bits -- the color channels, plus
+# the alpha channel with alphaLane
+def embedding_lanes(mode, alphaLane=False):
+    if (mode not in COLOR_LANES):
+        raise ValueError("Unsupported image mode " + mode +
+                         " -- images must be RGB, RGBA, L or LA")
+
+    if (alphaLane == True and mode not in ("RGBA", "LA")):
+        raise ValueError("The alpha lane needs an RGBA or LA image")
+
+    return COLOR_LANES[mode] + (1 if (alphaLane == True) else 0)
+
+
+# Pixels of row 0 the header needs
+def header_width(mode, header):
+    if (header.version != 1):
+        headerBits = 8 * len(pack_header(header))
+    elif (header.kind == "zip"):
+        headerBits = 2 * ZIP_HEADER_OFFSET
     else:
-        return 0
+        headerBits = ZIP_HEADER_OFFSET
+
+    width = -(-headerBits // COLOR_LANES[mode])
+
+    # The original zip header needs pixel (0, 21) too -- see numpy_embed()
+    if (header.version == 1 and header.kind == "zip"
+            and COLOR_LANES[mode] == 3):
+        width = max(width, 21)
+
+    return width
+
+
+# Bit offset of the key check block -- right after the versioned header
+def key_tag_offset(header):
+    return 8 * len(pack_header(header))
+
+
+# Whether a row of rowBits color channels has room for the key check block.
+# Only versioned headers get one: images in the original layout stay
+# exactly what the original hide() wrote
+def key_tag_fits(header, rowBits):
+    return (header.version != 1 and rowBits >= key_tag_offset(header) + 8 *
+            (len(KEY_TAG_MAGIC) + KEY_TAG_BYTES))
+
+
+# The key check tag of a header under keyHexString (see derive_key())
+def key_tag(header, keyHexString):
+    return hmac.new(keyHexString.encode(), KEY_TAG_MAGIC + pack_header(header),
+                    hashlib.sha256).digest()[:KEY_TAG_BYTES]
+
+
+# (bit offset, bits) parts of the row 0 header -- with keyHexString, the
+# key check block as well
+def header_parts(header, keyHexString=None):
+    if (header.version != 1):
+        parts = [(0,
+                  np.unpackbits(
+                      np.frombuffer(pack_header(header), dtype=np.uint8)))]
+    else:
+        parts = [(0, BitBuffer.from_int(header.length, 30).to_array())]
+
+        if (header.kind == "zip"):
+            parts.append(
+                (ZIP_HEADER_OFFSET, ZIP_HEADER_BITS[:30].to_array()))
+
+    if (keyHexString is not None):
+        parts.append((key_tag_offset(header),
+                      np.unpackbits(
+                          np.frombuffer(KEY_TAG_MAGIC +
+                                        key_tag(header, keyHexString),
+                                        dtype=np.uint8))))
+
+    return parts
+
+
+# Writes header_parts() into the LSBs of the color channels of the first
+# pixels of flatPixels (one row per pixel) -> the pixels it touched
+def write_header(flatPixels, colorLanes, parts):
+    touched = []
+
+    for offset, bits in parts:
+        stream = offset + np.arange(bits.size)
+        pixel = stream // colorLanes
+        channel = stream % colorLanes
+
+        flatPixels[pixel, channel] = (flatPixels[pixel, channel]
+                                      & 0xFE) | bits
+        touched.append(np.unique(pixel))
+
+    return touched
+
+
+# Reads the header out of the first pixels of flatPixels (one row per
+# pixel, starting at pixel (0, 0)) in one go -> StegoHeader. Without a
+# versioned header the image is in the original layout
+def read_header(flatPixels, colorLanes, width):
+    headerBits = 8 * (HEADER_STRUCT.size + SHARD_STRUCT.size)
+    headerPixels = max(min(width, -(-headerBits // colorLanes)),
+                       -(-ZIP_HEADER_OFFSET // colorLanes))
+    stream = (flatPixels[:headerPixels, :colorLanes] & 1).ravel()
+
+    # Whole bytes of row 0 only
+    rowBytes = min(width * colorLanes, headerBits) // 8
+    header = unpack_header(np.packbits(stream[:8 * rowBytes]).tobytes())
+
+    if (header is not None):
+        return header
+
+    messageLength = BitBuffer.from_array(stream[:30]).to_int()
+
+    # The 31st zip magic bit sits in pixel (0, 21), which the payload may
+    # overwrite afterwards, so only the 30 bits of row 0 are compared
+    multipleFiles = False
+    if ((width >= 21) if (colorLanes == 3) else
+        (width * colorLanes >= 2 * ZIP_HEADER_OFFSET)):
+        multipleFiles = (BitBuffer.from_array(
+            stream[ZIP_HEADER_OFFSET:2 * ZIP_HEADER_OFFSET]) ==
+                         ZIP_HEADER_BITS[:30])
+
+    return make_header(messageLength, "zip" if
+                       (multipleFiles == True) else "text")
+
+
+# Raises ValueError before any scan if the header can't be what hide()
+# wrote with this key into this image -- a key check block whose tag
+# doesn't match, or more cipher bits than lanes channels of the pixels
+# after row 0 hold. flatPixels as for read_header()
+def verify_header(flatPixels, colorLanes, width, height, lanes, header,
+                  keyHexString):
+    if (key_tag_fits(header, width * colorLanes)):
+        offset = key_tag_offset(header)
+        blockBits = 8 * (len(KEY_TAG_MAGIC) + KEY_TAG_BYTES)
+        stream = (flatPixels[:-(-(offset + blockBits) // colorLanes), :
+                             colorLanes] & 1).ravel()
+        block = np.packbits(stream[offset:offset + blockBits]).tobytes()
+
+        if (block[:len(KEY_TAG_MAGIC)] == KEY_TAG_MAGIC and
+                block[len(KEY_TAG_MAGIC):] != key_tag(header, keyHexString)):
+            raise ValueError("Wrong key -- the key check tag doesn't match")
+
+    if (header.length > (width * height - width) * lanes * header.depth):
+        raise ValueError(
+            "No hidden data found -- the header announces more bits than "
+            "the image holds")
+
+
+# Cipher bytes (a uint8 array) -> one value of depth bits (first bit
+# highest) per channel slot, the last one padded with zeros. Depths that
+# divide 8 are cut straight out of the bytes
+def bytes_to_symbols(data, depth):
+    if (depth == 1):
+        return np.unpackbits(data)
+
+    if (8 % depth == 0):
+        shifts = np.arange(8 - depth, -1, -depth, dtype=np.uint8)
+        return ((data[:, np.newaxis] >> shifts) & ((1 << depth) - 1)).ravel()
+
+    bits = np.unpackbits(data)
+    planes = np.zeros((-(-bits.size // depth), depth), dtype=np.uint8)
+    planes.ravel()[:bits.size] = bits
+
+    symbols = planes[:, 0].copy()
+    for plane in range(1, depth):
+        symbols = (symbols << 1) | planes[:, plane]
+
+    return symbols
+
+
+# Inverse of bytes_to_symbols() -- a BitBuffer of the first bitCount bits
+# of the values
+def symbols_to_bits(symbols, depth, bitCount):
+    symbols = np.ravel(symbols)
+    bitCount = min(bitCount, depth * symbols.size)
+
+    if (depth == 1):
+        return BitBuffer.from_array(symbols[:bitCount])
+
+    if (8 % depth == 0):
+        perByte = 8 // depth
+        grouped = np.zeros((-(-symbols.size // perByte), perByte),
+                           dtype=np.uint8)
+        grouped.ravel()[:symbols.size] = symbols
+
+        data = grouped[:, 0].copy()
+        for i in range(1, perByte):
+            data = (data << depth) | grouped[:, i]
+
+        data = bytearray(data[:(bitCount + 7) // 8].tobytes())
+        if (bitCount & 7):
+            data[-1] &= (0xFF << (8 - (bitCount & 7))) & 0xFF
+
+        return BitBuffer(data, bitCount)
+
+    planes = np.empty((symbols.size, depth), dtype=np.uint8)
+    for plane in range(depth):
+        planes[:, plane] = (symbols >> (depth - 1 - plane)) & 1
+
+    return BitBuffer.from_array(planes.ravel()[:bitCount])
+
+
+# big_rand_bin of legacy_embed() / legacy_extract() -- the bits of the seeded
+# totalEncodableLen-bit number without its leading zeros (as bin() prints
+# it), padded at the end with 0, 1, 0, ... up to the right length
+def legacy_mask(keyHexString, totalEncodableLen):
+    random.seed(keyHexString)
+    bigRand = random.getrandbits(totalEncodableLen)
+
+    mask = BitBuffer.from_int(bigRand, max(bigRand.bit_length(), 1))
+
+    while (len(mask) < totalEncodableLen):
+        mask.append(len(mask) % 2)
+
+    return mask
+
+
+# Streams big_rand_bin from hide()/find() as arrays of 0's and 1's without
+# building the totalEncodableLen-bit number or its bin() string.
+#
+# getrandbits(n) draws n / 32 words from the Mersenne Twister and puts the
+# first word in the lowest 32 bits, so the front of the mask comes from the
+# last words drawn. The twister is therefore run once up front (as a NumPy
+# MT19937 loaded with the state random.seed() produces) keeping only a state
+# checkpoint every chunkWords words, and the words behind any slice of the
+# mask are regenerated from the nearest checkpoint when they are asked for.
+class MaskStream:
+
+    def __init__(self, keyHexString, totalEncodableLen,
+                 chunkWords=MASK_CHUNK_WORDS):
+        self.totalEncodableLen = totalEncodableLen
+        self.chunkWords = chunkWords
+        self.wordCount = (totalEncodableLen + 31) // 32
+
+        seededState = random.Random(keyHexString).getstate()[1]
+        self.generator = np.random.MT19937()
+        self.generator.state = {
+            "bit_generator": "MT19937",
+            "state": {
+                "key": np.array(seededState[:624], dtype=np.uint32),
+                "pos": seededState[624]
+            }
+        }
+
+        self.checkpoints = []
+        topWord = -1
+        topValue = 0
+
+        for firstWord in range(0, self.wordCount, chunkWords):
+            self.checkpoints.append(self.generator.state)
+
+            words = self.finish_words(
+                self.generator.random_raw(
+                    min(chunkWords, self.wordCount - firstWord)), firstWord)
+
+            nonZero = np.flatnonzero(words)
+            if (nonZero.size > 0):
+                topWord = firstWord + int(nonZero[-1])
+                topValue = int(words[nonZero[-1]])
+
+        # Length of bin(big_rand_bin)[2:] -- the leading zeros get dropped
+        self.randLen = 32 * topWord + topValue.bit_length() if (
+            topWord >= 0) else 0
 
+    # getrandbits() keeps only the top bits of the last word it draws
+    def finish_words(self, words, firstWord):
+        lastIndex = self.wordCount - 1 - firstWord
 
-def decimal_to_binary(n):
-    return bin(n).replace("0b", "")
+        if (lastIndex < words.size):
+            lastBits = self.totalEncodableLen - 32 * (self.wordCount - 1)
+            words[lastIndex] >>= 32 - lastBits
 
+        return words.astype(np.uint32)
 
-def bitstring_to_bytes(s):
-    # return int(s, 2).to_bytes((len(s) + 7) // 8, byteorder='big')
-    return bytes(int(s[i:i + 8], 2) for i in range(0, len(s), 8))
+    # Words [firstWord, lastWord) of the random number
+    def words(self, firstWord, lastWord):
+        checkpoint = firstWord // self.chunkWords
+        self.generator.state = self.checkpoints[checkpoint]
+
+        skip = firstWord - checkpoint * self.chunkWords
+        if (skip > 0):
+            self.generator.random_raw(skip, output=False)
+
+        return self.finish_words(
+            self.generator.random_raw(lastWord - firstWord), firstWord)
+
+    # mask[start:stop]
+    def bits(self, start, stop):
+        stop = min(stop, self.totalEncodableLen)
+        mask = np.empty(max(stop - start, 0), dtype=np.uint8)
+
+        # mask[i] is bit randLen - 1 - i of the random number
+        randStop = min(stop, self.randLen)
+        if (start < randStop):
+            highBit = self.randLen - start
+            lowBit = self.randLen - randStop
+
+            firstWord = lowBit // 32
+            lastWord = (highBit + 31) // 32
+
+            # Most significant word first, every word most significant bit
+            # first -- randBits[0] is bit 32 * lastWord - 1
+            words = self.words(firstWord, lastWord)[::-1].astype(">u4")
+            randBits = np.unpackbits(words.view(np.uint8))
+
+            topBit = 32 * lastWord - 1
+            mask[:randStop - start] = randBits[topBit - highBit + 1:topBit -
+                                               lowBit + 1]
+
+        # Tail padding -- str(len(big_rand_bin) % 2)
+        padStart = max(start, self.randLen)
+        mask[padStart - start:] = np.arange(padStart, stop) % 2
+
+        return mask
+
+
+# Flat pixel indices fit in uint32 below 4G pixels
+def schedule_index_type(width, height):
+    return np.uint32 if (width * height < 2**32) else np.uint64
+
+
+# Flat pixel indices in the order hide() fills them -- every pixel after
+# row 0 that maps to a 1, followed by the inverted pass over the 0's.
+# Handed out one mask chunk at a time; with a count, the mask is only
+# walked until that many pixels were found
+def iter_legacy_schedule(keyHexString, width, height, count=None):
+    totalEncodableLen = width * height - width
+
+    if (count is None or count > totalEncodableLen):
+        count = totalEncodableLen
+
+    indexType = schedule_index_type(width, height)
+    mask = MaskStream(keyHexString, totalEncodableLen)
+    chunkBits = 32 * mask.chunkWords
+
+    found = 0
+
+    for wanted in (1, 0):
+        for start in range(0, totalEncodableLen, chunkBits):
+            if (found >= count):
+                return
+
+            # Nothing but the positions handed out outlives the yield
+            positions = np.flatnonzero(
+                mask.bits(start, start + chunkBits) == wanted)[:count - found]
+            found += positions.size
+            positions = (positions + start + width).astype(indexType)
+
+            yield positions
+
+
+# The whole schedule of iter_legacy_schedule() as one array, filled in
+# place so no more than one piece is held besides it
+def legacy_schedule(keyHexString, width, height, count=None):
+    totalEncodableLen = width * height - width
+
+    if (count is None or count > totalEncodableLen):
+        count = totalEncodableLen
+
+    schedule = np.empty(count, dtype=schedule_index_type(width, height))
+    found = 0
+
+    for positions in iter_legacy_schedule(keyHexString, width, height,
+                                          count):
+        schedule[found:found + positions.size] = positions
+        found += positions.size
+
+    return schedule
+
+
+# Reads a schedule front to back in slices of any size, pulling pieces from
+# an iterator of position arrays only as they are needed
+class ScheduleReader:
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.piece = np.empty(0, dtype=np.uint32)
+
+    # The next count positions -- fewer once the schedule runs out
+    def take(self, count):
+        parts = []
+
+        while (count > 0):
+            if (self.piece.size == 0):
+                self.piece = next(self.pieces, None)
+                if (self.piece is None):
+                    self.piece = np.empty(0, dtype=np.uint32)
+                    break
+
+            parts.append(self.piece[:count])
+            self.piece = self.piece[count:]
+            count -= parts[-1].size
+
+        if (len(parts) == 1):
+            return parts[0]
+
+        if (len(parts) == 0):
+            return self.piece[:0]
+
+        return np.concatenate(parts)
+
+
+# LRU cache of pixel schedules keyed by (SHA-256 key digest, (width, height))
+# Entries are uint32 arrays (uint64 for huge images) and evicted oldest first
+# once the total size goes over maxBytes
+class ScheduleCache:
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = collections.OrderedDict()
+
+    # The first count pixels of the schedule (all of them if count is None)
+    # A cached prefix serves any later call that asks for no more than it
+    # holds, otherwise the schedule is rebuilt to the new length
+    def get(self, keyHexString, width, height, count=None):
+        cacheKey = (keyHexString, (width, height))
+
+        totalEncodableLen = width * height - width
+        if (count is None or count > totalEncodableLen):
+            count = totalEncodableLen
+
+        schedule = self.entries.get(cacheKey)
+
+        if (schedule is not None and schedule.size >= count):
+            self.hits += 1
+            self.entries.move_to_end(cacheKey)
+            return schedule[:count]
+
+        self.misses += 1
+
+        schedule = legacy_schedule(keyHexString, width, height, count)
+        schedule.setflags(write=False)
+
+        # Too big to ever fit -- hand it back without caching it
+        if (schedule.nbytes > self.maxBytes):
+            return schedule
+
+        if (cacheKey in self.entries):
+            self.currentBytes -= self.entries.pop(cacheKey).nbytes
+
+        self.entries[cacheKey] = schedule
+        self.currentBytes += schedule.nbytes
+
+        while (self.currentBytes > self.maxBytes):
+            self.evict()
+
+        return schedule
+
+    # A ScheduleReader over the first count pixels of the schedule. One
+    # that fits in maxBytes comes from get(), so it is cached for the next
+    # hide() or find(). A bigger one could never be cached -- it's streamed
+    # from the mask instead, one mask chunk of positions at a time
+    def reader(self, keyHexString, width, height, count):
+        itemBytes = np.dtype(schedule_index_type(width, height)).itemsize
+
+        if (min(count, width * height - width) * itemBytes <= self.maxBytes):
+            return ScheduleReader(
+                iter((self.get(keyHexString, width, height, count), )))
+
+        self.misses += 1
+
+        return ScheduleReader(
+            iter_legacy_schedule(keyHexString, width, height, count))
+
+    # Drops the least recently used schedule
+    def evict(self):
+        cacheKey, schedule = self.entries.popitem(last=False)
+        self.currentBytes -= schedule.nbytes
+        self.evictions += 1
+
+    # Zeroes every cached schedule before dropping it -- the positions are
+    # derived from the key, so they should not linger in memory
+    def clear(self):
+        for schedule in self.entries.values():
+            schedule.setflags(write=True)
+            schedule.fill(0)
+
+        self.entries.clear()
+        self.currentBytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.currentBytes,
+            "maxBytes": self.maxBytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+scheduleCache = ScheduleCache(SCHEDULE_CACHE_BYTES)
 
 
 def show_banner():
@@ -313,7 +1490,12 @@ def hide_menu():
     print()
 
 
-def raw_text_input():
+# depth and alphaLane -- how hide() will embed, for the size check;
+# outputProfile -- how it will save, for the output name check
+def raw_text_input(depth=1,
+                   alphaLane=False,
+                   compression=None,
+                   outputProfile=None):
     # These are flags to check for invalid or no input
     secretMessageInputCheck = False
     secretKeyInputCheck = False
@@ -361,10 +1543,15 @@ def raw_text_input():
 
         # Valid file name
         if (srcImageInputCheck == 0):
-            # Check if the image is big enough
-            srcImageInputCheck = check_image_size(encodeSrcImgPath,
-                                                  encodeInputMsg,
-                                                  encodeInputKey)
+            carrier = open_carrier(encodeSrcImgPath)
+
+            if (carrier is None):
+                srcImageInputCheck = 1
+            else:
+                # Check if the image is big enough
+                srcImageInputCheck = check_image_size(carrier, encodeInputMsg,
+                                                      encodeInputKey, depth,
+                                                      alphaLane, compression)
 
     # Check for destination image name
     while (dstImageInputCheck == False):
@@ -375,6 +1562,16 @@ def raw_text_input():
 
         dstImageFileNameCheck = check_extension(encodeDstImgName)
 
+        # The carrier's channels have to survive the output format
+        if (dstImageFileNameCheck == 0):
+            try:
+                carrier.check_output(encodeDstImgName, outputProfile)
+            except ValueError as e:
+                print()
+                print(colored(str(e) + ". Try again!", 'red'))
+                print()
+                continue
+
         # Valid file name
         if (encodeDstImgName != "" and dstImageFileNameCheck == 0):
             dstImageInputCheck = True
@@ -388,10 +1585,11 @@ def raw_text_input():
 
     print()
 
-    return encodeInputKey, encodeInputMsg, encodeSrcImgPath, encodeDstImgName
+    # The opened carrier goes to hide() instead of the path
+    return encodeInputKey, encodeInputMsg, carrier, encodeDstImgName
 
 
-def file_s_input():
+def file_s_input(depth=1, alphaLane=False, outputProfile=None):
     # Hold all the files
     files = []
 
@@ -433,14 +1631,25 @@ def file_s_input():
 
         # If image exists, check it's horizontal length to see if it matches the header requirements
         if (srcImageInputCheck == 0):
+            carrier = open_carrier(encodeSrcImgPath)
+
+            if (carrier is None):
+                srcImageInputCheck = 1
+                continue
 
-            # 1 -> Image is too small, 0 -> Image is large enough
-            headerCheck = check_file_size_zip(encodeSrcImgPath)
-            if (headerCheck == 1):
+            # Row 0 needs room for the zip header (or the versioned one)
+            try:
+                carrier.check_capacity(make_header(0, "zip", depth,
+                                                   alphaLane))
+            except ValueError as e:
                 srcImageInputCheck = 1
                 print()
-                print(colored("The image is too small. Try again!", 'red'))
+                print(colored(str(e) + ". Try again!", 'red'))
                 print()
+            else:
+                capacityTracker = CapacityTracker(carrier.width,
+                                                  carrier.height, depth,
+                                                  carrier.lanes(alphaLane))
 
     # Check for valid output image name
     while (dstImageInputCheck == False):
@@ -451,6 +1660,16 @@ def file_s_input():
 
         dstImageFileNameCheck = check_extension(encodeDstImgName)
 
+        # The carrier's channels have to survive the output format
+        if (dstImageFileNameCheck == 0):
+            try:
+                carrier.check_output(encodeDstImgName, outputProfile)
+            except ValueError as e:
+                print()
+                print(colored(str(e) + ". Try again!", 'red'))
+                print()
+                continue
+
         # Valid file name
         if (encodeDstImgName != "" and dstImageFileNameCheck == 0):
             dstImageInputCheck = True
@@ -536,6 +1755,7 @@ def file_s_input():
                 print()
 
                 files.remove(fileToDelete)
+                capacityTracker.remove(fileToDelete)
 
                 print_current_files(files)
         else:  # Check if valid file
@@ -623,6 +1843,7 @@ def file_s_input():
                             print()
 
                             files.remove(fileToDelete)
+                            capacityTracker.remove(fileToDelete)
 
                             print_current_files(files)
                     elif (fileName == "-1"):
@@ -636,9 +1857,10 @@ def file_s_input():
             # Temporarily add the filename to the files array to be checked
             if (fileName != "-1"):
                 files.append(fileName)
+                capacityTracker.add(fileName)
 
-            cipherBitsLength, difference = total_available_space(
-                encodeSrcImgPath, files, encodeInputKey)
+            cipherBitsLength = capacityTracker.cipher_bits()
+            difference = capacityTracker.remaining()
 
             if (difference > 0 and fileName != "-1"):
                 print()
@@ -655,9 +1877,11 @@ def file_s_input():
                 print()
                 print(
                     colored(
-                        "The file is too large for this image - Try another file",
-                        'red'))
+                        "The file is too large for this image - Try another file "
+                        "(or spread it over several images with: stegano.py "
+                        "shard)", 'red'))
                 print()
+                capacityTracker.remove(files[-1])
                 files = files[:-1]
             else:
                 print()
@@ -666,8 +1890,8 @@ def file_s_input():
 
             fileExistsCheck = 1
 
-    # Encode it now
-    return files, encodeInputKey, encodeSrcImgPath, encodeDstImgName
+    # Encode it now -- with the opened carrier instead of the path
+    return files, encodeInputKey, carrier, encodeDstImgName
 
 
 def find_input():
@@ -694,74 +1918,25 @@ def find_input():
     return decodeInputKey, decodeSrcImgPath
 
 
-def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
-         multipleInputFlag):
-
-    # prog = InitBar()
-
-    if (multipleInputFlag == True):
-        zippedFileInput = zipfile.ZipFile("input.zip",
-                                          "w",
-                                          compression=zipfile.ZIP_DEFLATED)
-
-        for i in files:
-            zippedFileInput.write(i)
-
-        zippedFileInput.close()
-
-        with open("input.zip", "rb") as f:
-            zippedBytes = f.read()
-
-    backend = default_backend()  # Default backend for the AES Cipher creator
+# The original per-pixel embedding loop -- kept as the "legacy" backend
+def legacy_embed(imageWorker, cipherText, keyHexString, header):
+    if (imageWorker.mode not in ("RGB", "RGBA")):
+        raise ValueError("The legacy backend only handles RGB(A) images")
 
-    key = bytearray()  # Create a byte array to store the
-    key.extend(map(ord, encryptionKey))
-
-    shaAlgo = hashlib.sha256()
-    shaAlgo.update(key)
-
-    keyHexString = shaAlgo.hexdigest()
-
-    if (multipleInputFlag == True):
-        secretFileBytes = zippedBytes
-    else:
-        secretMsgBytes = secretMsg.encode()
-
-    # Converts the initialization vector to bits
-    # Always 128 bits -- os.urandom(16) => 16 bytes = 128 bits
-
-    # Split hash into initVector and AES key
-    initVectorHex = keyHexString[0:32]
-    keyHex = keyHexString[32:64]
-
-    initVec = bytes.fromhex(initVectorHex)
-    keyBytes = bytes.fromhex(keyHex)
-
-    # Create the encryption cipher -- AES256.CFB -- no padding required
-    AESCipher = Cipher(algorithms.AES(keyBytes),
-                       modes.CFB(initVec),
-                       backend=backend)
-    encryptor = AESCipher.encryptor()
+    if (header.version != 1):
+        raise ValueError(
+            "The legacy backend only writes the original layout -- 1 bit "
+            "per color channel, text or zip, up to 128 MiB")
 
-    if (multipleInputFlag == True):
-        cipherText = encryptor.update(secretFileBytes)
-    else:
-        cipherText = encryptor.update(secretMsgBytes)
+    multipleInputFlag = (header.kind == "zip")
 
     # This is going to be encoded into the actual image
-    if (multipleInputFlag == True):
-        cipherBits = BitArray(bytes=cipherText).bin
-    else:
-        cipherBits = BitArray(bytes=cipherText).bin
+    cipherBits = BitBuffer(cipherText)
 
-    # Get the lengthof the cipher bits
-    # The [2:] at the end chops off the 0b part of 0b1000 for example
-    # The zfill 30 will make the 1000 (8) for example into
-    # 00000000000000000000000001000 so we can just write
-    # from the left to write
-    cipherBitsLengthBinary = bin(len(cipherBits))[2:].zfill(30)
-
-    imageWorker = Image.open(srcImgFile)
+    # Get the length of the cipher bits as 30 bits
+    # 8 (1000) for example becomes 000000000000000000000000001000
+    # so we can just write from the left
+    cipherBitsLengthBinary = BitBuffer.from_int(len(cipherBits), 30)
 
     # Gets all the pixels of the image
     pixelManipulator = imageWorker.load()
@@ -785,23 +1960,13 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
             # pixelManipulator[1] = 8-bit g value
             # pixelManipulator[2] = 8-bit b value
 
-            binary_r = decimal_to_binary(
-                pixelManipulator[col, row][0]).zfill(8)
-            binary_g = decimal_to_binary(
-                pixelManipulator[col, row][1]).zfill(8)
-            binary_b = decimal_to_binary(
-                pixelManipulator[col, row][2]).zfill(8)
-
-            binary_r = binary_r[:7] + cipherBitsLengthBinary[cipherLenIterator]
-            binary_g = binary_g[:7] + cipherBitsLengthBinary[cipherLenIterator
-                                                             + 1]
-            binary_b = binary_b[:7] + cipherBitsLengthBinary[cipherLenIterator
-                                                             + 2]
-
-            # Converts from binary to int
-            encoded_r = int(binary_r, 2)
-            encoded_g = int(binary_g, 2)
-            encoded_b = int(binary_b, 2)
+            # Replace the last bit of each value
+            encoded_r = (pixelManipulator[col, row][0] & 0xFE
+                         | cipherBitsLengthBinary[cipherLenIterator])
+            encoded_g = (pixelManipulator[col, row][1] & 0xFE
+                         | cipherBitsLengthBinary[cipherLenIterator + 1])
+            encoded_b = (pixelManipulator[col, row][2] & 0xFE
+                         | cipherBitsLengthBinary[cipherLenIterator + 2])
 
             # Get the bit values of the pixel and change them
 
@@ -814,39 +1979,24 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
     # If it's a zipped file input
     if (multipleInputFlag == True):
         zipHeaderIterator = 0
-        zipHeaderBinary = "1010000010010110000001100000100"
+        zipHeaderBinary = ZIP_HEADER_BITS
 
         # pixel (0,10)
         for row in range(1):
             for col in range(10, 20, 1):
-                binary_r = decimal_to_binary(
-                    pixelManipulator[col, row][0]).zfill(8)
-                binary_g = decimal_to_binary(
-                    pixelManipulator[col, row][1]).zfill(8)
-                binary_b = decimal_to_binary(
-                    pixelManipulator[col, row][2]).zfill(8)
-
-                binary_r = binary_r[:7] + zipHeaderBinary[zipHeaderIterator]
-
-                binary_g = binary_g[:7] + zipHeaderBinary[zipHeaderIterator +
-                                                          1]
-
-                binary_b = binary_b[:7] + zipHeaderBinary[zipHeaderIterator +
-                                                          2]
-
-                encoded_r = int(binary_r, 2)
-                encoded_g = int(binary_g, 2)
-                encoded_b = int(binary_b, 2)
+                encoded_r = (pixelManipulator[col, row][0] & 0xFE
+                             | zipHeaderBinary[zipHeaderIterator])
+                encoded_g = (pixelManipulator[col, row][1] & 0xFE
+                             | zipHeaderBinary[zipHeaderIterator + 1])
+                encoded_b = (pixelManipulator[col, row][2] & 0xFE
+                             | zipHeaderBinary[zipHeaderIterator + 2])
 
                 pixelManipulator[col, row] = (encoded_r, encoded_g, encoded_b)
                 zipHeaderIterator += 3
 
         # Encode pixel # 11 -> # 21
-        binary_r = decimal_to_binary(pixelManipulator[col, row][0]).zfill(8)
-
-        binary_r = binary_r[:7] + zipHeaderBinary[zipHeaderIterator]
-
-        encoded_r = int(binary_r, 2)
+        encoded_r = (pixelManipulator[col, row][0] & 0xFE
+                     | zipHeaderBinary[zipHeaderIterator])
 
         # Write the R value, and the remaining values should be the same
         pixelManipulator[0, 21] = (encoded_r, pixelManipulator[0, 21][1],
@@ -858,18 +2008,9 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
     # Start at the second row -- row 2, pixel 0
 
     # Generate a random number with totalEncodableLen amount of bits that is seeded
-    random.seed(keyHexString)
-
-    # Creates a random seeded number that has is the size of the total encodable length
-    # This is a behemoth of a number -- absolute unit
-    big_rand_bin = random.getrandbits(totalEncodableLen)
-
-    big_rand_bin = bin(big_rand_bin)[2:]
-
-    # If the random number isn't long enough, this will pad it with 0's and 1's until
-    # it reaches the correct length
-    while (len(big_rand_bin) != totalEncodableLen):
-        big_rand_bin += str(len(big_rand_bin) % 2)
+    # This is a behemoth of a number -- absolute unit -- kept packed
+    with profile_stage("mask"):
+        big_rand_bin = legacy_mask(keyHexString, totalEncodableLen)
 
     # Iterators
     cipherTextIterator = 0  # Iterates through the cipher text
@@ -889,29 +2030,17 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
             if (cipherTextIterator < sizeOfCipher - sub
                     and randomNumIterator < totalEncodableLen):
 
-                if (str(big_rand_bin)[randomNumIterator] == "1"):
-                    # 0b10101010
-                    binaryDigit_r = pixelManipulator[col, row][0]
-                    binaryDigit_g = pixelManipulator[col, row][1]
-                    binaryDigit_b = pixelManipulator[col, row][2]
-
-                    # 0b10101010 -> 10101010
-                    binaryDigit_r = bin(binaryDigit_r)[2:].zfill(8)
-                    binaryDigit_g = bin(binaryDigit_g)[2:].zfill(8)
-                    binaryDigit_b = bin(binaryDigit_b)[2:].zfill(8)
-
-                    # 1010101 -> 1010101[cipher_bit]
-                    encodedBinaryDigit_r = binaryDigit_r[:7] + str(
-                        cipherBits)[cipherTextIterator]
-                    encodedBinaryDigit_g = binaryDigit_g[:7] + str(cipherBits)[
-                        cipherTextIterator + 1]
-                    encodedBinaryDigit_b = binaryDigit_b[:7] + str(cipherBits)[
-                        cipherTextIterator + 2]
-
-                    # 10101011 -> 171
-                    encodedDecimal_r = int(encodedBinaryDigit_r, 2)
-                    encodedDecimal_g = int(encodedBinaryDigit_g, 2)
-                    encodedDecimal_b = int(encodedBinaryDigit_b, 2)
+                if (big_rand_bin[randomNumIterator] == 1):
+                    # 10101010 -> 1010101[cipher_bit]
+                    encodedDecimal_r = (
+                        pixelManipulator[col, row][0] & 0xFE
+                        | cipherBits[cipherTextIterator])
+                    encodedDecimal_g = (
+                        pixelManipulator[col, row][1] & 0xFE
+                        | cipherBits[cipherTextIterator + 1])
+                    encodedDecimal_b = (
+                        pixelManipulator[col, row][2] & 0xFE
+                        | cipherBits[cipherTextIterator + 2])
 
                     # R, G, B -> New R, G, B
                     pixelManipulator[col, row] = (encodedDecimal_r,
@@ -921,12 +2050,10 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
                     encodedCount += 3
                     cipherTextIterator += 3
             elif (sub == 1 and randomNumIterator < totalEncodableLen):
-                if (str(big_rand_bin)[randomNumIterator] == "1"):
-                    binaryDigit_r = pixelManipulator[col, row][0]
-                    binaryDigit_r = bin(binaryDigit_r)[2:].zfill(8)
-                    encodedBinaryDigit_r = binaryDigit_r[:7] + str(
-                        cipherBits)[cipherTextIterator]
-                    encodedDecimal_r = int(encodedBinaryDigit_r, 2)
+                if (big_rand_bin[randomNumIterator] == 1):
+                    encodedDecimal_r = (
+                        pixelManipulator[col, row][0] & 0xFE
+                        | cipherBits[cipherTextIterator])
                     pixelManipulator[col, row] = (
                         encodedDecimal_r, pixelManipulator[col, row][1],
                         pixelManipulator[col, row][2])
@@ -934,18 +2061,14 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
                     encodedCount += 1
                     cipherTextIterator += 1
             elif (sub == 2 and randomNumIterator < totalEncodableLen):
-                if (str(big_rand_bin)[randomNumIterator] == "1"):
-                    binaryDigit_r = pixelManipulator[col, row][0]
-                    binaryDigit_r = bin(binaryDigit_r)[2:].zfill(8)
-                    encodedBinaryDigit_r = binaryDigit_r[:7] + str(
-                        cipherBits)[cipherTextIterator]
-                    encodedDecimal_r = int(encodedBinaryDigit_r, 2)
-
-                    binaryDigit_g = pixelManipulator[col, row][1]
-                    binaryDigit_g = bin(binaryDigit_g)[2:].zfill(8)
-                    encodedBinaryDigit_g = binaryDigit_g[:7] + str(cipherBits)[
-                        cipherTextIterator + 1]
-                    encodedDecimal_g = int(encodedBinaryDigit_g, 2)
+                if (big_rand_bin[randomNumIterator] == 1):
+                    encodedDecimal_r = (
+                        pixelManipulator[col, row][0] & 0xFE
+                        | cipherBits[cipherTextIterator])
+
+                    encodedDecimal_g = (
+                        pixelManipulator[col, row][1] & 0xFE
+                        | cipherBits[cipherTextIterator + 1])
                     pixelManipulator[col, row] = (
                         encodedDecimal_r, encodedDecimal_g,
                         pixelManipulator[col, row][2])
@@ -978,25 +2101,17 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
                 # indexLoc = cipherTextIterator % 3
                 if (cipherTextIterator < sizeOfCipher - sub
                         and invertedRandCounter < totalEncodableLen):
-                    if (str(big_rand_bin)[invertedRandCounter] == "0"):
-                        binaryDigit_r = pixelManipulator[col, row][0]
-                        binaryDigit_g = pixelManipulator[col, row][1]
-                        binaryDigit_b = pixelManipulator[col, row][2]
-
-                        binaryDigit_r = bin(binaryDigit_r)[2:].zfill(8)
-                        binaryDigit_g = bin(binaryDigit_g)[2:].zfill(8)
-                        binaryDigit_b = bin(binaryDigit_b)[2:].zfill(8)
-
-                        encodedBinaryDigit_r = binaryDigit_r[:7] + str(
-                            cipherBits)[cipherTextIterator]
-                        encodedBinaryDigit_g = binaryDigit_g[:7] + str(
-                            cipherBits)[cipherTextIterator + 1]
-                        encodedBinaryDigit_b = binaryDigit_b[:7] + str(
-                            cipherBits)[cipherTextIterator + 2]
-
-                        encodedDecimal_r = int(encodedBinaryDigit_r, 2)
-                        encodedDecimal_g = int(encodedBinaryDigit_g, 2)
-                        encodedDecimal_b = int(encodedBinaryDigit_b, 2)
+                    if (big_rand_bin[invertedRandCounter] == 0):
+                        # 10101010 -> 1010101[cipher_bit]
+                        encodedDecimal_r = (
+                            pixelManipulator[col, row][0] & 0xFE
+                            | cipherBits[cipherTextIterator])
+                        encodedDecimal_g = (
+                            pixelManipulator[col, row][1] & 0xFE
+                            | cipherBits[cipherTextIterator + 1])
+                        encodedDecimal_b = (
+                            pixelManipulator[col, row][2] & 0xFE
+                            | cipherBits[cipherTextIterator + 2])
 
                         pixelManipulator[col, row] = (encodedDecimal_r,
                                                       encodedDecimal_g,
@@ -1005,12 +2120,10 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
                         encodedCount += 3
                         cipherTextIterator += 3
                 elif (sub == 1 and invertedRandCounter < totalEncodableLen):
-                    if (str(big_rand_bin)[invertedRandCounter] == "0"):
-                        binaryDigit_r = pixelManipulator[col, row][0]
-                        binaryDigit_r = bin(binaryDigit_r)[2:].zfill(8)
-                        encodedBinaryDigit_r = binaryDigit_r[:7] + str(
-                            cipherBits)[cipherTextIterator]
-                        encodedDecimal_r = int(encodedBinaryDigit_r, 2)
+                    if (big_rand_bin[invertedRandCounter] == 0):
+                        encodedDecimal_r = (
+                            pixelManipulator[col, row][0] & 0xFE
+                            | cipherBits[cipherTextIterator])
                         pixelManipulator[col, row] = (
                             encodedDecimal_r, pixelManipulator[col, row][1],
                             pixelManipulator[col, row][2])
@@ -1018,21 +2131,17 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
                         encodedCount += 1
                         cipherTextIterator += 1
                 elif (sub == 2 and invertedRandCounter < totalEncodableLen):
-                    if (str(big_rand_bin)[invertedRandCounter] == "0"):
-                        binaryDigit_r = pixelManipulator[col, row][0]
-                        binaryDigit_r = bin(binaryDigit_r)[2:].zfill(8)
-                        encodedBinaryDigit_r = binaryDigit_r[:7] + str(
-                            cipherBits)[cipherTextIterator]
-                        encodedDecimal_r = int(encodedBinaryDigit_r, 2)
+                    if (big_rand_bin[invertedRandCounter] == 0):
+                        encodedDecimal_r = (
+                            pixelManipulator[col, row][0] & 0xFE
+                            | cipherBits[cipherTextIterator])
                         pixelManipulator[col, row] = (
                             encodedDecimal_r, pixelManipulator[col, row][1],
                             pixelManipulator[col, row][2])
 
-                        binaryDigit_g = pixelManipulator[col, row][1]
-                        binaryDigit_g = bin(binaryDigit_g)[2:].zfill(8)
-                        encodedBinaryDigit_g = binaryDigit_g[:7] + str(
-                            cipherBits)[cipherTextIterator + 1]
-                        encodedDecimal_g = int(encodedBinaryDigit_g, 2)
+                        encodedDecimal_g = (
+                            pixelManipulator[col, row][1] & 0xFE
+                            | cipherBits[cipherTextIterator + 1])
                         pixelManipulator[col, row] = (
                             pixelManipulator[col, row][0], encodedDecimal_g,
                             pixelManipulator[col, row][2])
@@ -1049,129 +2158,574 @@ def hide(encryptionKey, secretMsg, srcImgFile, dstImgFile, files,
             # progBar = progBar * 100
             # prog(progBar)
 
-    print()
 
-    # Save the image as the requested file name
-    imageWorker.save(dstImgFile)
+# Vectorized version of legacy_embed() -- produces the same pixels
+def numpy_embed(imageWorker, cipherText, keyHexString, header):
+    lanes = embedding_lanes(imageWorker.mode, header.alphaLane)
+    colorLanes = COLOR_LANES[imageWorker.mode]
+    depth = header.depth
 
-    print()
-    print(
-        "\u001b[36;1m#####################################################################\u001b[0m"
-    )
-    print(
-        colored(
-            "DONE -- MODIFIED image saved to current directory as: " +
-            dstImgFile + "", 'green'))
-    print(
-        "\u001b[36;1m#####################################################################\u001b[0m"
-    )
-    print()
+    width, height = imageWorker.size
 
-    if (multipleInputFlag == True):
-        send2trash.send2trash("input.zip")
+    pixels = np.array(imageWorker)
+    flatPixels = pixels.reshape(width * height, -1)
 
+    sizeOfCipher = 8 * len(cipherText)
 
-def find(decryptionKey, srcImgFile):
+    # Header -- 30 bits of length in the R, G and B of pixels 0-9 (the gray
+    # value of pixels 0-29), then the zip magic. Or the versioned header.
+    # Then the key check block, if row 0 is wide enough
+    write_header(
+        flatPixels, colorLanes,
+        header_parts(
+            header, keyHexString if
+            (key_tag_fits(header, width * colorLanes)) else None))
 
-    # decodeProg = InitBar()
-    # prog = InitBar(title = "Finding...", size = 100, offset = 4, )
+    if (header.version == 1 and header.kind == "zip" and colorLanes == 3):
+        # legacy_embed() writes the 31st bit into the R value of pixel (0, 21),
+        # built from the R value of pixel (19, 0)
+        flatPixels[21 * width, 0] = (flatPixels[19, 0]
+                                     & 0xFE) | ZIP_HEADER_BITS[30]
 
-    multipleFiles = False
+    # Every lane of a selected pixel takes depth bits, the last pixel takes
+    # what is left over
+    symbolCount = -(-sizeOfCipher // depth)
+    keepMask = (0xFF << depth) & 0xFF
 
-    # Get the preliminary stuff
-    backend = default_backend()
+    slots = scheduleCache.reader(keyHexString, width, height,
+                                 -(-symbolCount // lanes))
+
+    # The cipher is unpacked one chunk at a time -- each chunk's bits go to
+    # the next (8 * len(chunk)) // (lanes * depth) slots, the last pixel may
+    # be partial. Chunks of depth times the cipher chunk fill whole pixels.
+    # The slots are read from the mask along with them
+    for chunk in iter_chunks(cipherText, CIPHER_CHUNK_BYTES * depth):
+        chunkSymbols = bytes_to_symbols(np.frombuffer(chunk, dtype=np.uint8),
+                                        depth)
+
+        with profile_stage("mask"):
+            chunkSlots = slots.take(-(-chunkSymbols.size // lanes))
+
+        for lane in range(lanes):
+            laneSymbols = chunkSymbols[lane::lanes]
+            target = chunkSlots[:laneSymbols.size]
+
+            flatPixels[target, lane] = (flatPixels[target, lane]
+                                        & keepMask) | laneSymbols
+
+        # Gone before the next chunk is expanded, not after
+        del chunkSymbols, chunkSlots, laneSymbols, target
+
+    imageWorker.frombytes(pixels.tobytes())
+
+
+# Embedding engines selectable through hide(embedBackend=...)
+EMBED_BACKENDS = {
+    "legacy": legacy_embed,
+    "numpy": numpy_embed,
+}
+
+
+# SHA-256 of the key -> (keyHexString, AES key, initialization vector)
+def derive_key(encryptionKey):
     key = bytearray()
-    key.extend(map(ord, decryptionKey))
+    key.extend(map(ord, encryptionKey))
+
+    keyHexString = hashlib.sha256(key).hexdigest()
+
+    # Split hash into initVector and AES key
+    initVec = bytes.fromhex(keyHexString[0:32])
+    keyBytes = bytes.fromhex(keyHexString[32:64])
+
+    return keyHexString, keyBytes, initVec
+
+
+# Yields read-only views of data, chunkBytes at a time
+def iter_chunks(data, chunkBytes=CIPHER_CHUNK_BYTES):
+    dataView = memoryview(data).cast("B")
+
+    for start in range(0, len(dataView), chunkBytes):
+        yield dataView[start:start + chunkBytes]
 
-    shaAlgo = hashlib.sha256()
-    shaAlgo.update(key)
 
-    keyHexString = shaAlgo.hexdigest()
+# Runs data through an AES-CFB encryptor / decryptor chunk by chunk, straight
+# into one preallocated buffer. CFB is a stream mode, so the output is the
+# same as a single update() call, without a second payload-sized temporary
+def cipher_update(cryptor, data, chunkBytes=CIPHER_CHUNK_BYTES):
+    dataLength = len(memoryview(data).cast("B"))
 
-    initVectorHex = keyHexString[0:32]
-    keyHex = keyHexString[32:64]
+    # update_into() wants block size - 1 bytes of slack after every write
+    outputBuffer = bytearray(dataLength + 15)
 
-    # Create the byte arrays of the init vector and the AES key -- 128 bits each
-    initVec = bytes.fromhex(initVectorHex)
-    keyBytes = bytes.fromhex(keyHex)
+    with memoryview(outputBuffer) as outputView:
+        position = 0
+        for chunk in iter_chunks(data, chunkBytes):
+            position += cryptor.update_into(chunk, outputView[position:])
+
+    del outputBuffer[dataLength:]
+
+    return outputBuffer
+
+
+# AES-CFB encrypts the payload the same way hide() does. keyMaterial is
+# derive_key(encryptionKey) if the caller already has it
+def encrypt_payload(encryptionKey, plainBytes, keyMaterial=None):
+    if (keyMaterial is None):
+        keyMaterial = derive_key(encryptionKey)
+    keyHexString, keyBytes, initVec = keyMaterial
 
-    # Create the decryptor
     AESCipher = Cipher(algorithms.AES(keyBytes),
                        modes.CFB(initVec),
-                       backend=backend)
-    decryptor = AESCipher.decryptor()
+                       backend=default_backend())
+    encryptor = AESCipher.encryptor()
 
-    # Open the image and load the pixels
-    imageWorker = Image.open(srcImgFile)
-    pixelManipulator = imageWorker.load()
+    return cipher_update(encryptor, plainBytes), keyHexString
 
-    # This will hold the length of the cipher text in binary string
-    cipherTextLength = ""
 
-    # This is the counter length of the cipher, this will tell the decryptor when to stop
-    # Going through the image
-    for row in range(1):
-        for col in range(10):
-            # Get the binary RGB values
-            binary_r = decimal_to_binary(
-                pixelManipulator[col, row][0]).zfill(8)
-            binary_g = decimal_to_binary(
-                pixelManipulator[col, row][1]).zfill(8)
-            binary_b = decimal_to_binary(
-                pixelManipulator[col, row][2]).zfill(8)
+# Write end of the hide() pipeline -- whatever is written to it is
+# compressed with codec (see PAYLOAD_STREAM_COMPRESSORS) and AES-CFB
+# encrypted right away, so the plaintext is never held whole. The cipher
+# is: it builds up in cipherText until finish(), because the backends
+# scatter every chunk over the whole image (strip mode too, band by band)
+# and need all of it. Memory grows with the payload, capped by limit --
+# ValueError as soon as the cipher grows past limit bytes, before the rest
+# of the source is read
+class CipherSink(io.RawIOBase):
+
+    def __init__(self, keyMaterial, codec="none", limit=None):
+        keyHexString, keyBytes, initVec = keyMaterial
+
+        AESCipher = Cipher(algorithms.AES(keyBytes),
+                           modes.CFB(initVec),
+                           backend=default_backend())
+        self.encryptor = AESCipher.encryptor()
+        self.compressor = PAYLOAD_STREAM_COMPRESSORS[codec]() if (
+            codec != "none") else None
+        self.limit = limit
+        self.cipherText = bytearray()
+        self.plainBytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        with memoryview(data) as dataView:
+            dataLength = dataView.nbytes
+
+        self.plainBytes += dataLength
+
+        if (self.compressor is not None):
+            data = self.compressor.compress(data)
+
+        self.encrypt(data)
+
+        return dataLength
+
+    def encrypt(self, data):
+        self.cipherText += self.encryptor.update(data)
+
+        if (self.limit is not None and len(self.cipherText) > self.limit):
+            raise ValueError("The payload doesn't fit the carrier -- over " +
+                             str(self.limit) + " bytes")
+
+    # The whole cipher, once the payload is written
+    def finish(self):
+        if (self.compressor is not None):
+            self.encrypt(self.compressor.flush())
+
+        self.cipherText += self.encryptor.finalize()
+
+        return self.cipherText
+
+
+# Zips the given files into an in-memory archive (what hide() embeds), or
+# writes the archive into target (a CipherSink) as it is built
+def zip_files(files, target=None):
+    zipBuffer = io.BytesIO() if (target is None) else target
+
+    with zipfile.ZipFile(zipBuffer, "w",
+                         compression=zipfile.ZIP_DEFLATED) as zippedFileInput:
+        for i in files:
+            zippedFileInput.write(i)
+
+    if (target is None):
+        return zipBuffer.getvalue()
+
+
+# The codec "auto" compression picks for plainBytes -- the one that
+# shrinks samples of it the most, "none" if none of them does
+def choose_codec(plainBytes):
+    if (len(plainBytes) <= 3 * CODEC_SAMPLE_BYTES):
+        sample = bytes(plainBytes)
+    else:
+        middle = (len(plainBytes) - CODEC_SAMPLE_BYTES) // 2
+        sample = b"".join(
+            (plainBytes[:CODEC_SAMPLE_BYTES],
+             plainBytes[middle:middle + CODEC_SAMPLE_BYTES],
+             plainBytes[-CODEC_SAMPLE_BYTES:]))
+
+    codec = "none"
+    smallest = len(sample)
+
+    for name, (compress, decompress) in PAYLOAD_COMPRESSORS.items():
+        size = len(compress(sample))
+        if (size < smallest):
+            codec, smallest = name, size
+
+    return codec
+
+
+# Compresses a text or raw payload -> (codec, bytes to encrypt).
+# compression is None / "none", "auto" or one of PAYLOAD_COMPRESSORS; a
+# codec that doesn't shrink the payload isn't used
+def compress_payload(plainBytes, compression=None):
+    if (compression not in (None, "auto") + PAYLOAD_CODECS):
+        raise ValueError("Unknown compression " + str(compression))
+
+    codec = choose_codec(plainBytes) if (compression == "auto") else (
+        compression or "none")
+
+    if (codec == "none"):
+        return "none", plainBytes
+
+    compressed = PAYLOAD_COMPRESSORS[codec][0](plainBytes)
+
+    if (len(compressed) >= len(plainBytes)):
+        return "none", plainBytes
+
+    return codec, compressed
+
+
+# Opens a streaming payload source -- "-" (stdin), a path, or a binary file
+# object, which is left open
+@contextlib.contextmanager
+def open_source(source):
+    if (source == "-"):
+        yield sys.stdin.buffer
+    elif (isinstance(source, (str, os.PathLike))):
+        with open(source, "rb") as sourceFile:
+            yield sourceFile
+    else:
+        yield source
+
+
+# Reads a payload from source (see open_source()) a chunk at a time into a
+# CipherSink -> (codec, cipher, payload bytes). "auto" compression picks
+# the codec from the first chunk, since the rest isn't there yet
+def stream_payload(source, keyMaterial, compression=None, limit=None):
+    if (compression not in (None, "auto") + PAYLOAD_CODECS):
+        raise ValueError("Unknown compression " + str(compression))
+
+    with open_source(source) as sourceFile:
+        firstChunk = sourceFile.read(CIPHER_CHUNK_BYTES)
+
+        codec = choose_codec(firstChunk) if (compression == "auto") else (
+            compression or "none")
+
+        sink = CipherSink(keyMaterial, codec, limit)
+        sink.write(firstChunk)
+        del firstChunk
+
+        shutil.copyfileobj(sourceFile, sink, CIPHER_CHUNK_BYTES)
+
+    return codec, sink.finish(), sink.plainBytes
+
+
+# What the codecs raise on data they didn't compress (a wrong key)
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError)
+
+
+# Inverse of compress_payload()
+def decompress_payload(data, codec):
+    if (codec == "none"):
+        return data
+
+    return PAYLOAD_COMPRESSORS[codec][1](data)
+
 
-            # Get the last digit of the binary RGB value
-            binary_r_last_digit = binary_r[7]
-            binary_g_last_digit = binary_g[7]
-            binary_b_last_digit = binary_b[7]
+# Raises ValueError if the header and the cipher bits it announces don't
+# fit into an image of that size and mode
+def check_capacity(width, height, header, mode="RGB"):
+    lanes = embedding_lanes(mode, header.alphaLane)
 
-            cipherTextLength += binary_r_last_digit + \
-                binary_g_last_digit + binary_b_last_digit
+    if (header.depth not in range(1, MAX_DEPTH + 1)):
+        raise ValueError("The depth must be between 1 and " +
+                         str(MAX_DEPTH))
 
-    #########################################################################################################
-    #########################################################################################################
+    # The original zip header of an RGB(A) image needs pixel (0, 21) as well
+    if (width < header_width(mode, header)
+            or (header.version == 1 and header.kind == "zip"
+                and COLOR_LANES[mode] == 3 and height < 22)):
+        raise ValueError("The image is too small for the header")
 
-    # Check if the header is big enough for a zip
-    # -> If it is, then read the header
-    headerCheck = check_file_size_zip(srcImgFile)
+    if ((width * height - width) * lanes * header.depth < header.length):
+        raise ValueError("The image is too small for the payload")
 
-    if (headerCheck == 0):
 
-        zipHeader = ""
-        actualZipHeader = "1010000010010110000001100000100"
+# (Pillow format, save options) of an output profile -- without one, the
+# profile of dstImgFile's extension. Lossy formats are refused, they would
+# destroy the hidden bits
+def output_profile(dstImgFile, outputProfile=None):
+    if (outputProfile is None):
+        extension = os.path.splitext(str(dstImgFile))[1].lower()
 
-        # Get binary from pixel's 10 -> 20
+        if (extension not in OUTPUT_EXTENSIONS):
+            raise ValueError("No lossless output format for '" + extension +
+                             "' -- use one of " +
+                             ", ".join(sorted(OUTPUT_EXTENSIONS)))
+
+        outputProfile = OUTPUT_EXTENSIONS[extension]
+
+    if (outputProfile not in OUTPUT_PROFILES):
+        raise ValueError("Unknown output profile '" + str(outputProfile) +
+                         "' -- use one of " + ", ".join(OUTPUT_PROFILES))
+
+    return OUTPUT_PROFILES[outputProfile]
+
+
+# Raises ValueError if an image of this mode can't be saved as dstImgFile
+# with outputProfile (see output_profile()) with all of its channels
+# unchanged. Checked before anything is encrypted or embedded
+def check_output_mode(mode, dstImgFile, outputProfile=None):
+    imageFormat = output_profile(dstImgFile, outputProfile)[0]
+
+    if (mode not in FORMAT_MODES[imageFormat]):
+        raise ValueError(mode + " images can't be saved as " + imageFormat +
+                         " without losing channels -- " + imageFormat +
+                         " keeps " + ", ".join(FORMAT_MODES[imageFormat]) +
+                         " images only")
+
+
+# Saves the encoded image with an output profile -- see output_profile()
+def save_image(imageWorker, dstImgFile, outputProfile=None):
+    imageFormat, saveOptions = output_profile(dstImgFile, outputProfile)
+
+    imageWorker.save(dstImgFile, format=imageFormat, **saveOptions)
+
+
+# Embeds the cipher text into srcImgFile (a path or a CarrierImage) and
+# saves it as dstImgFile
+def embed_image(srcImgFile,
+                dstImgFile,
+                cipherText,
+                keyHexString,
+                header,
+                embedBackend=DEFAULT_BACKEND,
+                memoryBudget=None,
+                bandHeight=None,
+                outputProfile=None):
+    carrier = CarrierImage.of(srcImgFile)
+
+    # Strip mode -- the image is streamed band by band from its file (never
+    # decoded as a whole), see strip_embed()
+    if (memoryBudget is not None or bandHeight is not None):
+        if (carrier.fileName is None):
+            raise ValueError("Strip mode needs the carrier as a file path")
+
+        imageFormat, saveOptions = output_profile(dstImgFile, outputProfile)
+        if (imageFormat != "PNG"):
+            raise ValueError("Strip mode only writes PNG images")
+
+        # Decoding, embedding and encoding are interleaved band by band
+        with profile_stage("embed"):
+            strip_embed(carrier.fileName, dstImgFile, cipherText,
+                        keyHexString, header, memoryBudget, bandHeight,
+                        saveOptions.get("compress_level", -1),
+                        saveOptions.get("optimize", False))
+    else:
+        with profile_stage("decode"):
+            imageWorker = carrier.decode()
+
+        with profile_stage("embed"):
+            EMBED_BACKENDS[embedBackend](imageWorker, cipherText,
+                                         keyHexString, header)
+
+        # Save the image as the requested file name
+        with profile_stage("save"):
+            save_image(imageWorker, dstImgFile, outputProfile)
+
+
+def hide(encryptionKey,
+         secretMsg,
+         srcImgFile,
+         dstImgFile,
+         files,
+         multipleInputFlag,
+         embedBackend=DEFAULT_BACKEND,
+         memoryBudget=None,
+         bandHeight=None,
+         outputProfile=None,
+         depth=1,
+         alphaLane=False,
+         compression=None):
+
+    # prog = InitBar()
+
+    carrier = CarrierImage.of(srcImgFile)
+    carrier.check_output(dstImgFile, outputProfile)
+
+    with profile_stage("key"):
+        keyMaterial = carrier.key_material(encryptionKey)
+    keyHexString = keyMaterial[0]
+
+    # The zip archive is deflated already -- see compress_payload() -- and
+    # encrypted as it is written, so the files are never held in memory
+    # unencrypted (see CipherSink)
+    codec = "none"
+    if (multipleInputFlag == True):
+        with profile_stage("zip"):
+            sink = CipherSink(keyMaterial)
+            zip_files(files, sink)
+            cipherText = sink.finish()
+    else:
+        with profile_stage("compress"):
+            codec, secretBytes = compress_payload(secretMsg.encode(),
+                                                  compression)
+
+        # AES256.CFB -- no padding required, encrypted chunk by chunk
+        with profile_stage("encrypt"):
+            cipherText, keyHexString = encrypt_payload(
+                encryptionKey, secretBytes, keyMaterial)
+
+    print()
+
+    header = make_header(8 * len(cipherText), "zip" if
+                         (multipleInputFlag == True) else "text", depth,
+                         alphaLane, codec)
+    carrier.check_capacity(header)
+
+    embed_image(carrier, dstImgFile, cipherText, keyHexString, header,
+                embedBackend, memoryBudget, bandHeight, outputProfile)
+
+    print()
+    print(
+        "\u001b[36;1m#####################################################################\u001b[0m"
+    )
+    print(
+        colored(
+            "DONE -- MODIFIED image saved to current directory as: " +
+            dstImgFile + "", 'green'))
+    print(
+        "\u001b[36;1m#####################################################################\u001b[0m"
+    )
+    print()
+
+
+# Hides a raw payload read from stdin ("-"), a pipe, or a file (see
+# open_source()). The source is compressed and encrypted a chunk at a time
+# as it is read, and reading stops as soon as it outgrows the carrier, so
+# `tar c dir | stegano.py hide --input - ...` holds the whole payload once,
+# as cipher -- O(payload) memory, never more than the carrier's capacity.
+# find() saves it as HIDDEN_DATA.bin. Returns a summary dict
+def hide_stream(encryptionKey,
+                source,
+                srcImgFile,
+                dstImgFile,
+                embedBackend=DEFAULT_BACKEND,
+                memoryBudget=None,
+                bandHeight=None,
+                outputProfile=None,
+                depth=1,
+                alphaLane=False,
+                compression=None):
+    carrier = CarrierImage.of(srcImgFile)
+    carrier.check_output(dstImgFile, outputProfile)
+
+    with profile_stage("key"):
+        keyMaterial = carrier.key_material(encryptionKey)
+
+    with profile_stage("encrypt"):
+        codec, cipherText, payloadBytes = stream_payload(
+            source, keyMaterial, compression,
+            carrier.capacity_bits(depth, alphaLane) // 8)
+
+    header = make_header(8 * len(cipherText), "raw", depth, alphaLane, codec)
+    carrier.check_capacity(header)
+
+    embed_image(carrier, dstImgFile, cipherText, keyMaterial[0], header,
+                embedBackend, memoryBudget, bandHeight, outputProfile)
+
+    return {
+        "payloadBytes": payloadBytes,
+        "codec": codec,
+        "cipherBits": 8 * len(cipherText)
+    }
+
+
+# The original per-bit extraction loop -- kept as the "legacy" backend
+def legacy_extract(imageWorker, keyHexString):
+
+    multipleFiles = False
+
+    pixelManipulator = imageWorker.load()
+
+    if (imageWorker.mode not in ("RGB", "RGBA")):
+        raise ValueError("The legacy backend only handles RGB(A) images")
+
+    # Row 0 in one read -- a versioned header says everything, images in
+    # the original layout go through the loops below
+    rowPixels = np.asarray(imageWorker.crop((0, 0, imageWorker.size[0],
+                                             1)))[0]
+    header = read_header(rowPixels, 3, imageWorker.size[0])
+
+    if (header.depth != 1 or header.alphaLane == True):
+        raise ValueError(
+            "The legacy backend only extracts 1 bit per color channel")
+
+    verify_header(rowPixels, 3, imageWorker.size[0], imageWorker.size[1], 3,
+                  header, keyHexString)
+
+    if (header.version == 1):
+        # This will hold the length of the cipher text in binary
+        cipherTextLength = BitBuffer()
+
+        # This is the counter length of the cipher, this will tell the decryptor when to stop
+        # Going through the image
         for row in range(1):
-            for col in range(10, 20, 1):
-                # Get the binary RGB values
-                binary_r = decimal_to_binary(
-                    pixelManipulator[col, row][0]).zfill(8)
-                binary_g = decimal_to_binary(
-                    pixelManipulator[col, row][1]).zfill(8)
-                binary_b = decimal_to_binary(
-                    pixelManipulator[col, row][2]).zfill(8)
+            for col in range(10):
+                # Get the last bit of the RGB values
+                cipherTextLength.append(pixelManipulator[col, row][0] & 1)
+                cipherTextLength.append(pixelManipulator[col, row][1] & 1)
+                cipherTextLength.append(pixelManipulator[col, row][2] & 1)
+
+        #########################################################################################################
+        #########################################################################################################
+
+        # Check if the header is big enough for a zip
+        # -> If it is, then read the header
+        # (checked on the open image -- it may not have a file name)
+        headerCheck = 1 if (imageWorker.size[0] < 21) else 0
+
+        if (headerCheck == 0):
+
+            zipHeader = BitBuffer()
 
-                # Get the last digit of the binary RGB value
-                binary_r_last_digit = binary_r[7]
-                binary_g_last_digit = binary_g[7]
-                binary_b_last_digit = binary_b[7]
+            # The 31st bit sits in pixel (0, 21), which the payload may
+            # overwrite afterwards, so only the 30 bits of row 0 are compared
+            # -- as read_header() does
+            actualZipHeader = ZIP_HEADER_BITS[:30]
 
-                zipHeader += binary_r_last_digit + binary_g_last_digit + binary_b_last_digit
+            # Get binary from pixel's 10 -> 20
+            for row in range(1):
+                for col in range(10, 20, 1):
+                    # Get the last bit of the RGB values
+                    zipHeader.append(pixelManipulator[col, row][0] & 1)
+                    zipHeader.append(pixelManipulator[col, row][1] & 1)
+                    zipHeader.append(pixelManipulator[col, row][2] & 1)
 
-        # Get pixel 21 binary
-        binary_r = decimal_to_binary(pixelManipulator[0, 21][0]).zfill(8)
-        binary_r_last_digit = binary_r[7]
+            if (zipHeader == actualZipHeader):
+                multipleFiles = True
 
-        zipHeader += binary_r_last_digit
+        #########################################################################################################
+        #########################################################################################################
 
-        if (zipHeader == actualZipHeader):
-            multipleFiles = True
+        # Convert the cipher text length from binary to decimal
+        messageLength = cipherTextLength.to_int()
 
-    #########################################################################################################
-    #########################################################################################################
+        header = make_header(messageLength, "zip" if
+                             (multipleFiles == True) else "text")
 
-    # Convert the cipher text length from binary to decimal
-    messageLength = int(cipherTextLength, 2)
+    messageLength = header.length
 
     # Create the random number
     # Get the total encodable length --> Size in bits of the random number
@@ -1180,18 +2734,13 @@ def find(decryptionKey, srcImgFile):
     # Total encodable length = all pixels - row 0
     totalEncodableLen = totalPixels - imageWorker.size[0]
 
-    random.seed(keyHexString)
-
-    big_rand_bin = decimal_to_binary(random.getrandbits(totalEncodableLen))
-
-    # Padding to make the random number the correct size, if needed
-    while (len(big_rand_bin) != totalEncodableLen):
-        # print("INCORRECT LENGTH GENERATED - FIXING IT")
-        big_rand_bin += str(len(big_rand_bin) % 2)
+    # Padded to the correct size, if needed -- see legacy_mask()
+    with profile_stage("mask"):
+        big_rand_bin = legacy_mask(keyHexString, totalEncodableLen)
 
-    # Get the cipher string -- binary
+    # Get the cipher bits
     # This is going to be the 0's and 1's from the image
-    cipherTextString = ""
+    cipherBits = BitBuffer()
 
     row = 1
     col = 0
@@ -1208,40 +2757,23 @@ def find(decryptionKey, srcImgFile):
             if (cipherTextIterator < messageLength - sub
                     and randomNumberIterator < totalEncodableLen):
                 # If the random number[index] == 1, then there is data encoded
-                if (str(big_rand_bin)[randomNumberIterator] == "1"):
-                    # Get the R, G, or B value - based on the modulo calculation
-                    binaryDigit_r = pixelManipulator[col, row][0]
-                    binaryDigit_g = pixelManipulator[col, row][1]
-                    binaryDigit_b = pixelManipulator[col, row][2]
-
-                    # Turn the R, G, or B value into binary
-                    binaryDigit_r = decimal_to_binary(binaryDigit_r).zfill(8)
-                    binaryDigit_g = decimal_to_binary(binaryDigit_g).zfill(8)
-                    binaryDigit_b = decimal_to_binary(binaryDigit_b).zfill(8)
-
-                    cipherTextString += binaryDigit_r[7]
-                    cipherTextString += binaryDigit_g[7]
-                    cipherTextString += binaryDigit_b[7]
+                if (big_rand_bin[randomNumberIterator] == 1):
+                    # Get the last bit of the R, G and B values
+                    cipherBits.append(pixelManipulator[col, row][0] & 1)
+                    cipherBits.append(pixelManipulator[col, row][1] & 1)
+                    cipherBits.append(pixelManipulator[col, row][2] & 1)
 
                     decodeCount += 3
                     cipherTextIterator += 3
             elif (sub == 1 and randomNumberIterator < totalEncodableLen):
-                if (str(big_rand_bin)[randomNumberIterator] == "1"):
-                    binaryDigit_r = pixelManipulator[col, row][0]
-                    binaryDigit_r = decimal_to_binary(binaryDigit_r).zfill(8)
-                    cipherTextString += binaryDigit_r[7]
-
+                if (big_rand_bin[randomNumberIterator] == 1):
+                    cipherBits.append(pixelManipulator[col, row][0] & 1)
                     decodeCount += 1
                     cipherTextIterator += 1
             elif (sub == 2 and randomNumberIterator < totalEncodableLen):
-                if (str(big_rand_bin)[randomNumberIterator] == "1"):
-                    binaryDigit_r = pixelManipulator[col, row][0]
-                    binaryDigit_r = decimal_to_binary(binaryDigit_r).zfill(8)
-                    cipherTextString += binaryDigit_r[7]
-
-                    binaryDigit_g = pixelManipulator[col, row][1]
-                    binaryDigit_g = decimal_to_binary(binaryDigit_g).zfill(8)
-                    cipherTextString += binaryDigit_g[7]
+                if (big_rand_bin[randomNumberIterator] == 1):
+                    cipherBits.append(pixelManipulator[col, row][0] & 1)
+                    cipherBits.append(pixelManipulator[col, row][1] & 1)
 
                     decodeCount += 2
                     cipherTextIterator += 2
@@ -1270,42 +2802,23 @@ def find(decryptionKey, srcImgFile):
                         and invertedRandCounter < totalEncodableLen):
                     # If the random number[index] == 0, then there is data encoded
                     # overflow data that is.
-                    if (str(big_rand_bin)[invertedRandCounter] == "0"):
-                        # Get the R, G, or B value - based on the modulo calculation
-                        binaryDigit_r = pixelManipulator[col, row][0]
-                        binaryDigit_g = pixelManipulator[col, row][1]
-                        binaryDigit_b = pixelManipulator[col, row][2]
-
-                        # Turn the R, G, or B value into binary
-                        binaryDigit_r = decimal_to_binary(binaryDigit_r).zfill(
-                            8)
-                        binaryDigit_g = decimal_to_binary(binaryDigit_g).zfill(
-                            8)
-                        binaryDigit_b = decimal_to_binary(binaryDigit_b).zfill(
-                            8)
-
-                        cipherTextString += binaryDigit_r[7]
-                        cipherTextString += binaryDigit_g[7]
-                        cipherTextString += binaryDigit_b[7]
+                    if (big_rand_bin[invertedRandCounter] == 0):
+                        # Get the last bit of the R, G and B values
+                        cipherBits.append(pixelManipulator[col, row][0] & 1)
+                        cipherBits.append(pixelManipulator[col, row][1] & 1)
+                        cipherBits.append(pixelManipulator[col, row][2] & 1)
 
                         decodeCount += 3
                         cipherTextIterator += 3
                 elif (sub == 1 and invertedRandCounter < totalEncodableLen):
-                    if (str(big_rand_bin)[invertedRandCounter] == "0"):
-                        binaryDigit_r = pixelManipulator[col, row][0]
-                        binaryDigit_r = decimal_to_binary(binaryDigit_r).zfill(
-                            8)
-                        cipherTextString += binaryDigit_r[7]
-
+                    if (big_rand_bin[invertedRandCounter] == 0):
+                        cipherBits.append(pixelManipulator[col, row][0] & 1)
                         decodeCount += 1
                         cipherTextIterator += 1
                 elif (sub == 2 and invertedRandCounter < totalEncodableLen):
-                    if (str(big_rand_bin)[invertedRandCounter] == "0"):
-                        binaryDigit_r = pixelManipulator[col, row][0]
-                        binaryDigit_r = decimal_to_binary(binaryDigit_r).zfill(
-                            8)
-                        cipherTextString += binaryDigit_r[7]
-
+                    if (big_rand_bin[invertedRandCounter] == 0):
+                        cipherBits.append(pixelManipulator[col, row][0] & 1)
+                        cipherBits.append(pixelManipulator[col, row][1] & 1)
                         decodeCount += 2
                         cipherTextIterator += 2
 
@@ -1318,20 +2831,562 @@ def find(decryptionKey, srcImgFile):
             # progBar = progBar * 100
             # decodeProg(progBar)
 
-    print("\n")
+    return cipherBits.tobytes(), header
+
+
+# Vectorized version of legacy_extract() -- reads every image hide() writes
+def numpy_extract(imageWorker, keyHexString):
+    # Raises ValueError for the modes hide() doesn't take
+    embedding_lanes(imageWorker.mode)
+    colorLanes = COLOR_LANES[imageWorker.mode]
+
+    width, height = imageWorker.size
+
+    pixels = np.asarray(imageWorker)
+    flatPixels = pixels.reshape(width * height, -1)
+
+    header = read_header(flatPixels, colorLanes, width)
+    messageLength, depth = header.length, header.depth
+    lanes = min(colorLanes + (1 if (header.alphaLane == True) else 0),
+                flatPixels.shape[1])
+    verify_header(flatPixels, colorLanes, width, height, lanes, header,
+                  keyHexString)
+    symbolCount = -(-messageLength // depth)
+
+    # Gather the scheduled pixels -- lanes * depth bits each, the last one
+    # partial
+    with profile_stage("mask"):
+        slots = scheduleCache.get(keyHexString, width, height,
+                                  -(-symbolCount // lanes))
+    symbols = flatPixels[slots, :lanes] & ((1 << depth) - 1)
+
+    return symbols_to_bits(symbols, depth, messageLength).tobytes(), header
+
+
+# Extraction engines selectable through find(extractBackend=...)
+EXTRACT_BACKENDS = {
+    "legacy": legacy_extract,
+    "numpy": numpy_extract,
+}
+
+
+def png_chunk(cid, data):
+    return struct.pack(">I", len(data)) + cid + data + struct.pack(
+        ">I", zlib.crc32(data, zlib.crc32(cid)))
+
+
+# Reads a non-interlaced 8-bit RGB(A) PNG a band of rows at a time. Pillow can
+# only decode the whole image, so the IDAT stream is inflated here and each
+# band is unfiltered by Pillow as a small stand-alone PNG
+class PngStripReader:
+
+    def __init__(self, fileName):
+        self.fileObject = open(fileName, "rb")
+
+        if (self.fileObject.read(8) != PNG_SIGNATURE):
+            raise ValueError("Not a PNG file: " + str(fileName))
+
+        self.iccProfile = None
+        self.transparency = None
+
+        while True:
+            cid, data = self.read_chunk()
+
+            if (cid == b"IHDR"):
+                self.width, self.height, bitDepth, colorType, _, _, \
+                    interlace = struct.unpack(">IIBBBBB", data)
+                self.ihdr = data
+            elif (cid == b"iCCP"):
+                self.iccProfile = zlib.decompress(data[data.index(b"\0") +
+                                                       2:])
+            elif (cid == b"tRNS"):
+                # One 16 bit sample per color channel
+                self.transparency = struct.unpack(">" + "H" * (len(data) // 2),
+                                                  data)
+            elif (cid == b"IDAT"):
+                self.pending = data
+                break
+            elif (cid == b"IEND"):
+                raise ValueError("PNG without image data: " + str(fileName))
+
+        if (bitDepth != 8 or colorType not in PNG_COLOR_MODES
+                or interlace != 0):
+            raise ValueError(
+                "Strip processing needs a non-interlaced 8-bit RGB(A) or L(A) "
+                "PNG"
+            )
 
-    cipherBytes = bitstring_to_bytes(cipherTextString)
+        self.mode = PNG_COLOR_MODES[colorType]
+        self.channels = len(self.mode)
+        self.rowBytes = self.width * self.channels
 
-    if (multipleFiles == True):
+        self.inflater = zlib.decompressobj()
+        self.filtered = b""
+        self.previousRow = bytes(self.rowBytes + 1)
+        self.row = 0
 
-        try:
-            plainBytes = decryptor.update(cipherBytes)
+    def read_chunk(self):
+        length, cid = struct.unpack(">I4s", self.fileObject.read(8))
+        data = self.fileObject.read(length)
+        self.fileObject.read(4)  # CRC
 
-            r = open("output.zip", "wb")
-            r.write(plainBytes)
-            r.close()
+        return cid, data
 
-            send2trash.send2trash("output.zip")
+    # Inflates exactly count filtered rows from the IDAT chunks
+    def read_filtered(self, count):
+        needed = count * (self.rowBytes + 1)
+        parts = [self.filtered]
+        have = len(self.filtered)
+
+        while (have < needed):
+            if (self.inflater.unconsumed_tail):
+                data = self.inflater.unconsumed_tail
+            else:
+                while (not self.pending):
+                    cid, self.pending = self.read_chunk()
+                    if (cid != b"IDAT"):
+                        raise ValueError("Truncated PNG image data")
+                data = self.pending
+                self.pending = b""
+
+            part = self.inflater.decompress(data, needed - have)
+            parts.append(part)
+            have += len(part)
+
+        filtered = b"".join(parts)
+        self.filtered = filtered[needed:]
+
+        return filtered[:needed]
+
+    # Returns the next count rows as a (count, width, channels) array
+    def read_rows(self, count):
+        count = min(count, self.height - self.row)
+        filtered = self.read_filtered(count)
+
+        # The previous (already unfiltered) row goes in front with filter
+        # type 0, so Up/Average/Paeth rows see the right prior row
+        ihdr = struct.pack(">IIBBBBB", self.width, count + 1, 8,
+                           PNG_COLOR_TYPES[self.mode], 0, 0, 0)
+        bandPng = PNG_SIGNATURE + png_chunk(b"IHDR", ihdr) + png_chunk(
+            b"IDAT", zlib.compress(self.previousRow + filtered,
+                                   0)) + png_chunk(b"IEND", b"")
+        del filtered
+
+        bandImage = Image.open(io.BytesIO(bandPng))
+        rows = np.array(bandImage)[1:]
+        del bandPng, bandImage
+
+        self.previousRow = b"\0" + rows[-1].tobytes()
+        self.row += count
+
+        return rows
+
+    def close(self):
+        self.fileObject.close()
+
+
+# Writes a PNG a band of rows at a time. Rows are filtered and deflated the
+# same way Pillow's encoder does it (adaptive filter per row, Z_FILTERED,
+# IDAT chunks of max(65536, 4 * width) bytes), so the file matches what
+# imageWorker.save() would have written for the same pixels
+class PngStripWriter:
+
+    def __init__(self, fileName, width, height, mode, iccProfile=None,
+                 transparency=None, compressLevel=-1, optimize=False):
+        self.fileObject = open(fileName, "wb")
+        self.width = width
+        self.mode = mode
+        self.channels = len(mode)
+        self.optimize = optimize
+        self.chunkSize = max(65536, 4 * width)
+        self.pending = b""
+        self.previousRow = np.zeros(width * self.channels, dtype=np.uint8)
+
+        self.deflater = zlib.compressobj(9 if optimize else compressLevel,
+                                         zlib.DEFLATED, 15, 9,
+                                         zlib.Z_FILTERED)
+
+        self.fileObject.write(PNG_SIGNATURE)
+        self.fileObject.write(
+            png_chunk(
+                b"IHDR",
+                struct.pack(">IIBBBBB", width, height, 8,
+                            PNG_COLOR_TYPES[mode], 0, 0, 0)))
+
+        if (iccProfile):
+            self.fileObject.write(
+                png_chunk(b"iCCP",
+                          b"ICC Profile\0\0" + zlib.compress(iccProfile)))
+
+        if (transparency is not None and mode in ("RGB", "L")):
+            self.fileObject.write(
+                png_chunk(
+                    b"tRNS",
+                    struct.pack(">" + "H" * len(transparency),
+                                *transparency)))
+
+    # Picks the filter for every row the way ZipEncode.c does -- the first
+    # of None, Up, Sub, (Average,) Paeth with the smallest sum of |byte|
+    def filter_rows(self, rows):
+        bpp = self.channels
+        current = rows.reshape(rows.shape[0], -1)
+        previous = np.vstack((self.previousRow, current[:-1]))
+
+        left = np.zeros_like(current)
+        left[:, bpp:] = current[:, :-bpp]
+        upperLeft = np.zeros_like(previous)
+        upperLeft[:, bpp:] = previous[:, :-bpp]
+
+        def cost(filtered):
+            signed = filtered.astype(np.int16)
+            return np.minimum(signed, 256 - signed).sum(axis=1)
+
+        output = np.empty((current.shape[0], current.shape[1] + 1),
+                          dtype=np.uint8)
+        output[:, 0] = 0
+        output[:, 1:] = current
+        best = cost(current)
+
+        candidates = [(2, lambda: current - previous),
+                      (1, lambda: current - left)]
+
+        if (self.optimize):
+            candidates.append(
+                (3, lambda: current -
+                 ((left.astype(np.uint16) + previous) // 2).astype(np.uint8)))
+
+        def paeth():
+            a = left.astype(np.int16)
+            b = previous.astype(np.int16)
+            c = upperLeft.astype(np.int16)
+            pa = np.abs(b - c)
+            pb = np.abs(a - c)
+            pc = np.abs(a + b - 2 * c)
+            predictor = np.where((pa <= pb) & (pa <= pc), a,
+                                 np.where(pb <= pc, b, c))
+            return current - predictor.astype(np.uint8)
+
+        candidates.append((4, paeth))
+
+        for filterType, build in candidates:
+            filtered = build()
+            filteredCost = cost(filtered)
+            better = filteredCost < best
+
+            output[better, 0] = filterType
+            output[better, 1:] = filtered[better]
+            best = np.where(better, filteredCost, best)
+
+        self.previousRow = current[-1].copy()
+
+        return output
+
+    def write_rows(self, rows):
+        self.write_compressed(
+            self.deflater.compress(self.filter_rows(rows).tobytes()))
+
+    def write_compressed(self, data):
+        self.pending += data
+
+        while (len(self.pending) >= self.chunkSize):
+            self.fileObject.write(
+                png_chunk(b"IDAT", self.pending[:self.chunkSize]))
+            self.pending = self.pending[self.chunkSize:]
+
+    def close(self):
+        self.write_compressed(self.deflater.flush())
+
+        if (self.pending):
+            self.fileObject.write(png_chunk(b"IDAT", self.pending))
+
+        self.fileObject.write(png_chunk(b"IEND", b""))
+        self.fileObject.close()
+
+
+# Rows per band so that one band's working set stays inside memoryBudget
+def strip_band_height(width, channels, memoryBudget):
+    return max(
+        1, memoryBudget // (width *
+                            (STRIP_ROW_COST * channels + STRIP_PIXEL_COST)))
+
+
+# Splits the rows of an image into bands of bandHeight rows and, for every
+# band, yields (firstRow, lastRow, pass 1 slot offset, pass 2 slot offset)
+# -- the slot number of the band's first 1 and first 0 in the schedule
+def strip_bands(mask, width, height, bandHeight):
+    bandRows = []
+    onesBefore = 0
+    zerosBefore = 0
+
+    for firstRow in range(0, height, bandHeight):
+        lastRow = min(firstRow + bandHeight, height)
+
+        maskStart = max(firstRow - 1, 0) * width
+        maskStop = (lastRow - 1) * width
+        ones = int(mask.bits(maskStart, maskStop).sum())
+
+        bandRows.append((firstRow, lastRow, onesBefore, zerosBefore))
+        onesBefore += ones
+        zerosBefore += (maskStop - maskStart) - ones
+
+    for firstRow, lastRow, ones, zeros in bandRows:
+        yield firstRow, lastRow, ones, onesBefore + zeros
+
+
+# Flat pixel indices (relative to the band) and slot numbers of every
+# scheduled pixel in a band, in schedule order
+def strip_band_slots(mask, width, firstRow, lastRow, onesOffset,
+                     zerosOffset, slotCount):
+    maskStart = max(firstRow - 1, 0) * width
+    bandMask = mask.bits(maskStart, (lastRow - 1) * width)
+
+    # Row 0 is never in the schedule
+    rowOffset = width if (firstRow == 0) else 0
+
+    ones = np.flatnonzero(bandMask)
+    zeros = np.flatnonzero(bandMask == 0)
+
+    positions = np.concatenate((ones, zeros)) + rowOffset
+    slots = np.concatenate((onesOffset + np.arange(ones.size),
+                            zerosOffset + np.arange(zeros.size)))
+
+    inRange = slots < slotCount
+
+    return positions[inRange], slots[inRange]
+
+
+# Band-by-band version of numpy_embed() -- reads srcImgFile and writes
+# dstImgFile without ever holding the whole image in memory.
+#
+# Peak RSS stays under: the interpreter and imported modules + the payload
+# twice (the cipher text and the packed copy the bands pick their bits
+# from) + about 2.5 KB of MaskStream checkpoints per 2M pixels + about
+# 2 MiB for the mask chunk being generated and the zlib streams +
+# memoryBudget for the bands (see strip_band_height())
+def strip_embed(srcImgFile,
+                dstImgFile,
+                cipherText,
+                keyHexString,
+                header,
+                memoryBudget,
+                bandHeight=None,
+                compressLevel=-1,
+                optimize=False):
+    reader = PngStripReader(srcImgFile)
+    width, height, channels = reader.width, reader.height, reader.channels
+    lanes = embedding_lanes(reader.mode, header.alphaLane)
+    colorLanes = COLOR_LANES[reader.mode]
+    depth = header.depth
+
+    if (bandHeight is None):
+        bandHeight = strip_band_height(width, channels, memoryBudget)
+
+    writer = PngStripWriter(dstImgFile, width, height, reader.mode,
+                            reader.iccProfile, reader.transparency,
+                            compressLevel, optimize)
+
+    # The cipher stays packed -- each band picks its own bits out of it
+    cipherBits = BitBuffer(cipherText)
+    sizeOfCipher = len(cipherBits)
+    symbolCount = -(-sizeOfCipher // depth)
+    slotCount = -(-symbolCount // lanes)
+    keepMask = (0xFF << depth) & 0xFF
+
+    with profile_stage("mask"):
+        mask = MaskStream(keyHexString, width * height - width)
+
+    for firstRow, lastRow, onesOffset, zerosOffset in strip_bands(
+            mask, width, height, bandHeight):
+        band = reader.read_rows(lastRow - firstRow)
+        flatPixels = band.reshape(-1, channels)
+
+        if (firstRow == 0):
+            write_header(
+                flatPixels, colorLanes,
+                header_parts(
+                    header, keyHexString if
+                    (key_tag_fits(header, width * colorLanes)) else None))
+            strayRed = flatPixels[19, 0] if (
+                header.version == 1 and header.kind == "zip"
+                and colorLanes == 3) else None
+
+        # The 31st zip magic bit in pixel (0, 21) -- see numpy_embed()
+        if (strayRed is not None and firstRow <= 21 < lastRow):
+            flatPixels[(21 - firstRow) * width,
+                       0] = (strayRed & 0xFE) | ZIP_HEADER_BITS[30]
+
+        positions, slots = strip_band_slots(mask, width, firstRow, lastRow,
+                                            onesOffset, zerosOffset,
+                                            slotCount)
+
+        for lane in range(lanes):
+            symbolIndex = lanes * slots + lane
+            inRange = symbolIndex * depth < sizeOfCipher
+            target = positions[inRange]
+
+            flatPixels[target, lane] = (flatPixels[target, lane]
+                                        & keepMask) | cipherBits.take_symbols(
+                                            symbolIndex[inRange], depth)
+
+        writer.write_rows(band)
+
+    reader.close()
+    writer.close()
+
+
+# Band-by-band version of numpy_extract() -- same memory bound as
+# strip_embed(), and it stops reading once every scheduled pixel was seen
+def strip_extract(srcImgFile, keyHexString, memoryBudget, bandHeight=None):
+    reader = PngStripReader(srcImgFile)
+    width, height, channels = reader.width, reader.height, reader.channels
+
+    # Raises ValueError for the modes hide() doesn't take
+    embedding_lanes(reader.mode)
+    colorLanes = COLOR_LANES[reader.mode]
+
+    if (bandHeight is None):
+        bandHeight = strip_band_height(width, channels, memoryBudget)
+
+    with profile_stage("mask"):
+        mask = MaskStream(keyHexString, width * height - width)
+
+    for firstRow, lastRow, onesOffset, zerosOffset in strip_bands(
+            mask, width, height, bandHeight):
+        flatPixels = reader.read_rows(lastRow - firstRow).reshape(
+            -1, channels)
+
+        if (firstRow == 0):
+            header = read_header(flatPixels, colorLanes, width)
+            messageLength, depth = header.length, header.depth
+            lanes = min(colorLanes + (1 if (header.alphaLane == True) else 0),
+                        channels)
+            verify_header(flatPixels, colorLanes, width, height, lanes,
+                          header, keyHexString)
+            lowMask = (1 << depth) - 1
+
+            # A bogus length can ask for more pixels than the image has
+            symbolCount = -(-messageLength // depth)
+            slotCount = min(-(-symbolCount // lanes), width * height - width)
+            cipherBits = BitBuffer.zeros(
+                min(messageLength, lanes * depth * slotCount))
+            slotsFound = 0
+
+        positions, slots = strip_band_slots(mask, width, firstRow, lastRow,
+                                            onesOffset, zerosOffset,
+                                            slotCount)
+
+        for lane in range(lanes):
+            cipherBits.set_symbols(lanes * slots + lane,
+                                   flatPixels[positions, lane] & lowMask,
+                                   depth)
+
+        slotsFound += slots.size
+        if (slotsFound >= slotCount):
+            break
+
+    reader.close()
+
+    return cipherBits.tobytes(), header
+
+
+# Reads the cipher bytes out of srcImgFile -> (cipherBytes, StegoHeader)
+def extract_image(srcImgFile,
+                  keyHexString,
+                  extractBackend=DEFAULT_BACKEND,
+                  memoryBudget=None,
+                  bandHeight=None):
+    # Strip mode -- see strip_extract()
+    if (memoryBudget is not None or bandHeight is not None):
+        with profile_stage("extract"):
+            return strip_extract(srcImgFile, keyHexString, memoryBudget,
+                                 bandHeight)
+
+    # Open the image
+    with profile_stage("decode"):
+        imageWorker = Image.open(srcImgFile)
+        imageWorker.load()
+
+    with profile_stage("extract"):
+        return EXTRACT_BACKENDS[extractBackend](imageWorker, keyHexString)
+
+
+# Raises ValueError if the header belongs to one shard of a payload spread
+# over several carriers -- the piece can't be decrypted on its own
+def check_single(header):
+    if (header.shard is not None):
+        raise ValueError("The image holds shard " +
+                         str(header.shard.index + 1) + " of " +
+                         str(header.shard.count) +
+                         " of a payload spread over several carriers -- "
+                         "gather them with stegano.py join")
+
+
+# AES-CFB decrypts what extract_image() found
+def decrypt_payload(decryptionKey, cipherBytes):
+    keyHexString, keyBytes, initVec = derive_key(decryptionKey)
+
+    AESCipher = Cipher(algorithms.AES(keyBytes),
+                       modes.CFB(initVec),
+                       backend=default_backend())
+    decryptor = AESCipher.decryptor()
+
+    return cipher_update(decryptor, cipherBytes)
+
+
+# AES-CFB decrypts one piece of a sharded cipher on its own -- the pieces
+# start on a block boundary and carry the cipher block in front of them
+def decrypt_shard(decryptionKey, cipherPiece, shard):
+    keyHexString, keyBytes, initVec = derive_key(decryptionKey)
+
+    AESCipher = Cipher(algorithms.AES(keyBytes),
+                       modes.CFB(initVec if (
+                           shard.offset == 0) else shard.chainBlock),
+                       backend=default_backend())
+    decryptor = AESCipher.decryptor()
+
+    return cipher_update(decryptor, cipherPiece)
+
+
+def find(decryptionKey,
+         srcImgFile,
+         extractBackend=DEFAULT_BACKEND,
+         memoryBudget=None,
+         bandHeight=None):
+
+    # decodeProg = InitBar()
+    # prog = InitBar(title = "Finding...", size = 100, offset = 4, )
+
+    # Get the preliminary stuff
+    with profile_stage("key"):
+        # The init vector and the AES key -- 128 bits each
+        keyHexString, keyBytes, initVec = derive_key(decryptionKey)
+
+        # Create the decryptor
+        AESCipher = Cipher(algorithms.AES(keyBytes),
+                           modes.CFB(initVec),
+                           backend=default_backend())
+        decryptor = AESCipher.decryptor()
+
+    # A wrong key (key check tag) or an empty image (implausible length)
+    # fails here, before the image is scanned
+    try:
+        cipherBytes, header = extract_image(srcImgFile, keyHexString,
+                                            extractBackend, memoryBudget,
+                                            bandHeight)
+        check_single(header)
+    except ValueError as e:
+        print()
+        print(colored(str(e) + ". Try again!", 'red'))
+        print()
+        return
+
+    print("\n")
+
+    if (header.kind == "zip"):
+
+        try:
+            with profile_stage("decrypt"):
+                plainBytes = cipher_update(decryptor, cipherBytes)
 
             overWriteHiddenData = 0
 
@@ -1352,16 +3407,10 @@ def find(decryptionKey, srcImgFile):
 
                 while (hiddenDataFolderCheck == 0):
                     if (str(overWriteHiddenData) == "0"):
-                        r = open("output.zip", "wb")
-                        r.write(plainBytes)
-                        r.close()
-
-                        with zipfile.ZipFile("output.zip",
-                                             "r") as zipFileObject:
+                        with profile_stage("unzip"), zipfile.ZipFile(
+                                io.BytesIO(plainBytes), "r") as zipFileObject:
                             zipFileObject.extractall("HIDDEN_DATA")
 
-                        send2trash.send2trash("output.zip")
-
                         print(
                             "\u001b[36;1m#####################################################################\u001b[0m"
                         )
@@ -1381,16 +3430,10 @@ def find(decryptionKey, srcImgFile):
                         except:
                             print("Failed somewhere. Try again!")
 
-                        r = open("output.zip", "wb")
-                        r.write(plainBytes)
-                        r.close()
-
-                        with zipfile.ZipFile("output.zip",
-                                             "r") as zipFileObject:
+                        with profile_stage("unzip"), zipfile.ZipFile(
+                                io.BytesIO(plainBytes), "r") as zipFileObject:
                             zipFileObject.extractall("HIDDEN_DATA")
 
-                        send2trash.send2trash("output.zip")
-
                         print(
                             "\u001b[36;1m#####################################################################\u001b[0m"
                         )
@@ -1409,15 +3452,10 @@ def find(decryptionKey, srcImgFile):
                         )
                         print()
             else:
-                r = open("output.zip", "wb")
-                r.write(plainBytes)
-                r.close()
-
-                with zipfile.ZipFile("output.zip", "r") as zipFileObject:
+                with profile_stage("unzip"), zipfile.ZipFile(
+                        io.BytesIO(plainBytes), "r") as zipFileObject:
                     zipFileObject.extractall("HIDDEN_DATA")
 
-                send2trash.send2trash("output.zip")
-
                 print(
                     "\u001b[36;1m#####################################################################\u001b[0m"
                 )
@@ -1432,14 +3470,45 @@ def find(decryptionKey, srcImgFile):
             print(
                 colored("Error retrieiving data from the image. Try again!",
                         'red'))
-            send2trash.send2trash("output.zip")
+            print()
+    elif (header.kind == "raw"):
+        # Raw bytes (hidden through hide_bytes()) go to a file as they are
+        try:
+            with profile_stage("decrypt"):
+                plainBytes = cipher_update(decryptor, cipherBytes)
+
+            with profile_stage("decompress"):
+                plainBytes = decompress_payload(plainBytes, header.codec)
+
+            with open("HIDDEN_DATA.bin", "wb") as f:
+                f.write(plainBytes)
+
+            print(
+                "\u001b[36;1m#####################################################################\u001b[0m"
+            )
+            print(
+                colored(
+                    "Embedded data (" + str(len(plainBytes)) +
+                    " bytes) saved as HIDDEN_DATA.bin", 'green'))
+            print(
+                "\u001b[36;1m#####################################################################\u001b[0m"
+            )
+        except:
+            print()
+            print(
+                colored("Error retrieving data from the image. Try again!",
+                        'red'))
             print()
     else:
 
         try:
-            plainText = decryptor.update(cipherBytes)
+            with profile_stage("decrypt"):
+                plainText = cipher_update(decryptor, cipherBytes)
+
+            with profile_stage("decompress"):
+                plainText = decompress_payload(plainText, header.codec)
 
-            plainText = plainText.decode("utf-8")
+                plainText = plainText.decode("utf-8")
 
             print(
                 "\u001b[36;1m#####################################################################\u001b[0m"
@@ -1456,7 +3525,1354 @@ def find(decryptionKey, srcImgFile):
             print()
 
 
-def main():
+# Opens whatever the library API is handed as a carrier -- a PIL Image,
+# a NumPy array (H x W x 3/4, uint8), bytes-like PNG data, a file object or
+# a path. Images are copied when the caller's pixels would be modified
+def load_carrier(carrier, copy=False):
+    if (isinstance(carrier, Image.Image)):
+        return carrier.copy() if (copy == True) else carrier
+
+    if (isinstance(carrier, np.ndarray)):
+        return Image.fromarray(np.ascontiguousarray(carrier, dtype=np.uint8))
+
+    if (isinstance(carrier, (bytes, bytearray, memoryview))):
+        carrier = io.BytesIO(carrier)
+
+    imageWorker = Image.open(carrier)
+    imageWorker.load()
+
+    return imageWorker
+
+
+# Zips name -> bytes pairs into an in-memory archive
+def zip_members(members):
+    zipBuffer = io.BytesIO()
+
+    with zipfile.ZipFile(zipBuffer, "w",
+                         compression=zipfile.ZIP_DEFLATED) as zippedFileInput:
+        for name, data in members.items():
+            zippedFileInput.writestr(name, data)
+
+    return zipBuffer.getvalue()
+
+
+# Library version of hide() -- nothing is written to disk or printed.
+# kind is "text" (payload is a str or bytes), "files" (payload is a dict
+# of archive name -> bytes, or a list of paths to zip) or "raw" (payload is
+# bytes handed back as they are). Text and raw payloads are compressed
+# with compression (see compress_payload()). Returns the encoded
+# image file (PNG unless another OUTPUT_PROFILES entry is picked) as bytes,
+# readable with find() / find_bytes()
+def hide_bytes(carrier,
+               key,
+               payload,
+               kind="text",
+               embedBackend=DEFAULT_BACKEND,
+               outputProfile="png",
+               depth=1,
+               alphaLane=False,
+               compression=None):
+    if (kind == "text"):
+        payloadKind = "text"
+        plainBytes = payload.encode() if isinstance(payload,
+                                                    str) else bytes(payload)
+    elif (kind == "files"):
+        payloadKind = "zip"
+        if (isinstance(payload, dict)):
+            plainBytes = zip_members(payload)
+        else:
+            plainBytes = zip_files(payload)
+    elif (kind == "raw"):
+        payloadKind = "raw"
+        plainBytes = bytes(payload)
+    else:
+        raise ValueError("kind must be 'text', 'files' or 'raw'")
+
+    codec = "none"
+    if (payloadKind != "zip"):
+        with profile_stage("compress"):
+            codec, plainBytes = compress_payload(plainBytes, compression)
+
+    # AES256.CFB doesn't pad -- the cipher is as long as the payload
+    header = make_header(8 * len(plainBytes), payloadKind, depth, alphaLane,
+                         codec)
+
+    carrierImage = CarrierImage(carrier)
+    carrierImage.check_output(None, outputProfile)
+    carrierImage.check_capacity(header)
+
+    with profile_stage("key"):
+        keyMaterial = carrierImage.key_material(key)
+
+    with profile_stage("encrypt"):
+        cipherText, keyHexString = encrypt_payload(key, plainBytes,
+                                                   keyMaterial)
+
+    with profile_stage("decode"):
+        imageWorker = carrierImage.decode()
+
+    with profile_stage("embed"):
+        EMBED_BACKENDS[embedBackend](imageWorker, cipherText, keyHexString,
+                                     header)
+
+    outputBuffer = io.BytesIO()
+    with profile_stage("save"):
+        save_image(imageWorker, outputBuffer, outputProfile)
+
+    return outputBuffer.getvalue()
+
+
+# Library version of find() -- returns ("text", str), ("files", dict of
+# archive name -> bytes) or ("raw", bytes). A wrong key raises ValueError
+def find_bytes(image, key, extractBackend=DEFAULT_BACKEND):
+    with profile_stage("key"):
+        keyHexString = derive_key(key)[0]
+
+    with profile_stage("decode"):
+        imageWorker = load_carrier(image)
+
+    with profile_stage("extract"):
+        cipherBytes, header = EXTRACT_BACKENDS[extractBackend](
+            imageWorker, keyHexString)
+
+    check_single(header)
+
+    with profile_stage("decrypt"):
+        plainBytes = decrypt_payload(key, cipherBytes)
+
+    try:
+        with profile_stage("decompress"):
+            plainBytes = decompress_payload(plainBytes, header.codec)
+
+        if (header.kind == "raw"):
+            return "raw", plainBytes
+
+        if (header.kind == "zip"):
+            with profile_stage("unzip"), zipfile.ZipFile(
+                    io.BytesIO(plainBytes)) as zipFileObject:
+                return "files", {
+                    info.filename: zipFileObject.read(info)
+                    for info in zipFileObject.infolist()
+                    if not info.is_dir()
+                }
+
+        return "text", plainBytes.decode("utf-8")
+    except (zipfile.BadZipFile, UnicodeDecodeError) + DECOMPRESS_ERRORS as e:
+        raise ValueError("No hidden data found -- wrong key?") from e
+
+
+# Reads a batch manifest -- a CSV file with a header row, or JSON lines
+# (.jsonl / .json). Every job has a carrier, an output, a key reference and
+# either a text or a list of files (separated by ; in a CSV file)
+def read_manifest(manifestFile):
+    jobs = []
+
+    with open(manifestFile, newline="") as f:
+        if (manifestFile.lower().endswith((".jsonl", ".json"))):
+            for line in f:
+                if (line.strip() != ""):
+                    jobs.append(json.loads(line))
+        else:
+            for row in csv.DictReader(f):
+                jobs.append(row)
+
+    for job in jobs:
+        if (isinstance(job.get("files"), str)):
+            job["files"] = [i for i in job["files"].split(";") if i != ""]
+
+    return jobs
+
+
+# "env:NAME" -> environment variable NAME, "file:PATH" -> contents of PATH
+# (without the trailing newline), anything else is the key itself
+def resolve_key(keyReference):
+    if (keyReference.startswith("env:")):
+        return os.environ[keyReference[4:]]
+    elif (keyReference.startswith("file:")):
+        with open(keyReference[5:]) as f:
+            return f.read().rstrip("\r\n")
+    else:
+        return keyReference
+
+
+# Runs one manifest job in a worker process. Never raises -- a failed job
+# comes back as a result with "status": "error". With profile set the
+# result carries the job's StageProfiler report under "profile"
+def hide_job(jobIndex,
+             job,
+             embedBackend,
+             memoryBudget,
+             profile=False,
+             outputProfile=None,
+             depth=1,
+             alphaLane=False,
+             compression=None):
+    startTime = time.time()
+    result = {
+        "job": jobIndex,
+        "carrier": job.get("carrier"),
+        "output": job.get("output")
+    }
+
+    profiler = StageProfiler() if (
+        profile == True) else contextlib.nullcontext()
+
+    try:
+        with profiler:
+            encryptionKey = resolve_key(job["key"])
+
+            multipleInputFlag = bool(job.get("files"))
+            with profile_stage("zip"):
+                if (multipleInputFlag == True):
+                    payload = zip_files(job["files"])
+                else:
+                    payload = job["text"].encode()
+
+            payloadBytes = len(payload)
+            codec = "none"
+            if (multipleInputFlag == False):
+                with profile_stage("compress"):
+                    codec, payload = compress_payload(payload, compression)
+
+            # Opened once for the capacity check and the embedding -- the
+            # cipher is as long as the payload, so it's checked before
+            # encrypting
+            header = make_header(8 * len(payload), "zip" if
+                                 (multipleInputFlag == True) else "text",
+                                 depth, alphaLane, codec)
+            carrier = CarrierImage(job["carrier"])
+            carrier.check_output(job["output"], outputProfile)
+            carrier.check_capacity(header)
+
+            with profile_stage("key"):
+                keyMaterial = carrier.key_material(encryptionKey)
+
+            with profile_stage("encrypt"):
+                cipherText, keyHexString = encrypt_payload(
+                    encryptionKey, payload, keyMaterial)
+
+            embed_image(carrier,
+                        job["output"],
+                        cipherText,
+                        keyHexString,
+                        header,
+                        embedBackend,
+                        memoryBudget,
+                        outputProfile=outputProfile)
+
+        result["status"] = "ok"
+        result["payloadBytes"] = payloadBytes
+        result["codec"] = codec
+        result["cipherBits"] = 8 * len(cipherText)
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = type(e).__name__ + ": " + str(e)
+
+    result["seconds"] = round(time.time() - startTime, 6)
+
+    if (profile == True):
+        result["profile"] = profiler.report()
+
+    return result
+
+
+# Fans the jobs of a manifest out over a process pool and prints one JSON
+# line per finished job, then a summary line on stderr
+def batch_hide(manifestFile,
+               workers=None,
+               embedBackend=DEFAULT_BACKEND,
+               memoryBudget=None,
+               profile=False,
+               outputProfile=None,
+               depth=1,
+               alphaLane=False,
+               compression=None):
+    jobs = read_manifest(manifestFile)
+    failed = 0
+    startTime = time.time()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(hide_job, jobIndex, job, embedBackend, memoryBudget,
+                        profile, outputProfile, depth, alphaLane,
+                        compression):
+            jobIndex
+            for jobIndex, job in enumerate(jobs)
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker itself died (e.g. killed for running out of memory)
+                result = {
+                    "job": futures[future],
+                    "status": "error",
+                    "error": type(e).__name__ + ": " + str(e)
+                }
+
+            if (result["status"] != "ok"):
+                failed += 1
+
+            print(json.dumps(result), flush=True)
+
+    totalTime = time.time() - startTime
+    print(json.dumps({
+        "jobs": len(jobs),
+        "failed": failed,
+        "seconds": round(totalTime, 6),
+        "jobsPerSecond": round(len(jobs) / totalTime, 3) if totalTime else None
+    }),
+          file=sys.stderr)
+
+    return failed
+
+
+# Stego images under a directory (recursively) or matching a glob pattern
+def collect_images(inputPath):
+    if (os.path.isdir(inputPath)):
+        images = []
+        for folder, _, fileNames in os.walk(inputPath):
+            for fileName in fileNames:
+                if (os.path.splitext(fileName)[1].lower()
+                        in OUTPUT_EXTENSIONS):
+                    images.append(os.path.join(folder, fileName))
+    else:
+        images = [
+            i for i in glob.glob(inputPath, recursive=True)
+            if os.path.isfile(i)
+        ]
+
+    return sorted(images)
+
+
+# Where the outputs for the images found under inputPath go -- outputDir
+# joined with each image's path relative to the input, without extension.
+# Images that would share a name (a.png and a.bmp) keep their extension,
+# and a name that is still taken gets a -2, -3, ... suffix
+def output_bases(inputPath, images, outputDir):
+    if (os.path.isdir(inputPath)):
+        baseDir = inputPath
+    elif (len(images) > 0):
+        baseDir = os.path.commonpath(
+            [os.path.dirname(os.path.abspath(i)) for i in images])
+    else:
+        baseDir = "."
+
+    relativeNames = [
+        os.path.relpath(os.path.abspath(imageFile), os.path.abspath(baseDir))
+        for imageFile in images
+    ]
+    stemCounts = collections.Counter(
+        os.path.normcase(os.path.splitext(i)[0]) for i in relativeNames)
+
+    outputBases = []
+    takenNames = set()
+    for relativeName in relativeNames:
+        outputName = os.path.splitext(relativeName)[0]
+        if (stemCounts[os.path.normcase(outputName)] > 1):
+            outputName = relativeName
+
+        uniqueName, suffix = outputName, 1
+        while (os.path.normcase(uniqueName) in takenNames):
+            suffix += 1
+            uniqueName = outputName + "-" + str(suffix)
+
+        takenNames.add(os.path.normcase(uniqueName))
+        outputBases.append(os.path.join(outputDir, uniqueName))
+
+    return outputBases
+
+
+# Extracts one image in a worker process into outputBase + ".txt" (raw
+# text), outputBase + ".bin" (raw bytes) or the outputBase directory
+# (files). Never raises. With profile set
+# the result carries the job's StageProfiler report under "profile"
+def find_job(imageFile,
+             decryptionKey,
+             outputBase,
+             extractBackend,
+             memoryBudget,
+             profile=False):
+    startTime = time.time()
+    result = {"image": imageFile}
+
+    profiler = StageProfiler() if (
+        profile == True) else contextlib.nullcontext()
+
+    try:
+        with profiler:
+            with profile_stage("key"):
+                keyHexString = derive_key(decryptionKey)[0]
+
+            cipherBytes, header = extract_image(imageFile, keyHexString,
+                                                extractBackend, memoryBudget)
+            check_single(header)
+
+            with profile_stage("decrypt"):
+                plainBytes = decrypt_payload(decryptionKey, cipherBytes)
+
+            with profile_stage("decompress"):
+                plainBytes = decompress_payload(plainBytes, header.codec)
+
+            if (header.kind == "zip"):
+                with profile_stage("unzip"), zipfile.ZipFile(
+                        io.BytesIO(plainBytes)) as zipFileObject:
+                    zipFileObject.extractall(outputBase)
+                    result["files"] = zipFileObject.namelist()
+
+                result["kind"] = "files"
+                result["output"] = outputBase
+            else:
+                # Fails on a wrong key the same way find() does
+                if (header.kind == "text"):
+                    plainBytes.decode("utf-8")
+
+                extension = ".txt" if (header.kind == "text") else ".bin"
+
+                os.makedirs(os.path.dirname(outputBase) or ".",
+                            exist_ok=True)
+                with open(outputBase + extension, "wb") as f:
+                    f.write(plainBytes)
+
+                result["kind"] = header.kind
+                result["output"] = outputBase + extension
+
+        result["status"] = "ok"
+        result["payloadBytes"] = len(plainBytes)
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = type(e).__name__ + ": " + str(e)
+
+    result["seconds"] = round(time.time() - startTime, 6)
+
+    if (profile == True):
+        result["profile"] = profiler.report()
+
+    return result
+
+
+# Extracts every image under inputPath with the same key, spread over a
+# process pool. Each image gets its own output location under outputDir
+# named after its path relative to the input; one JSON line per image is
+# printed as it finishes and a summary with images/sec goes to stderr
+def batch_find(inputPath,
+               decryptionKey,
+               outputDir,
+               workers=None,
+               extractBackend=DEFAULT_BACKEND,
+               memoryBudget=None,
+               profile=False):
+    images = collect_images(inputPath)
+    failed = 0
+    startTime = time.time()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+
+        for imageFile, outputBase in zip(
+                images, output_bases(inputPath, images, outputDir)):
+            futures[pool.submit(find_job, imageFile, decryptionKey,
+                                outputBase, extractBackend, memoryBudget,
+                                profile)] = imageFile
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "image": futures[future],
+                    "status": "error",
+                    "error": type(e).__name__ + ": " + str(e)
+                }
+
+            if (result["status"] != "ok"):
+                failed += 1
+
+            print(json.dumps(result), flush=True)
+
+    totalTime = time.time() - startTime
+    print(json.dumps({
+        "images": len(images),
+        "failed": failed,
+        "seconds": round(totalTime, 6),
+        "imagesPerSecond":
+        round(len(images) / totalTime, 3) if totalTime else None
+    }),
+          file=sys.stderr)
+
+    return failed
+
+
+# Cuts a cipher of cipherBytes bytes into one piece per carrier, in
+# proportion to the carriers' capacities (in bytes) so they all fill up
+# alike -> (offset, size) per carrier. Pieces are cut in whole AES blocks
+# (the last one excepted) so each can be decrypted on its own
+def split_shards(cipherBytes, capacities):
+    blocks = -(-cipherBytes // AES_BLOCK_BYTES)
+    blockCapacities = [capacity // AES_BLOCK_BYTES for capacity in capacities]
+    totalCapacity = sum(blockCapacities)
+
+    if (totalCapacity < blocks):
+        raise ValueError("The carriers are too small for the payload -- " +
+                         str(cipherBytes) + " bytes, " +
+                         str(AES_BLOCK_BYTES * totalCapacity) +
+                         " bytes of room")
+
+    sizes = [
+        blocks * capacity // totalCapacity for capacity in blockCapacities
+    ]
+
+    # Rounding down leaves less than a block per carrier behind -- it goes
+    # to the carriers with the most room left
+    leftover = blocks - sum(sizes)
+    for i in sorted(range(len(sizes)),
+                    key=lambda i: blockCapacities[i] - sizes[i],
+                    reverse=True)[:leftover]:
+        sizes[i] += 1
+
+    shards = []
+    offset = 0
+    for size in sizes:
+        end = min(offset + AES_BLOCK_BYTES * size, cipherBytes)
+        shards.append((offset, end - offset))
+        offset = end
+
+    return shards
+
+
+# The extension of the files an output profile writes -- ".png" without one
+def profile_extension(outputProfile=None):
+    imageFormat = OUTPUT_PROFILES[outputProfile or "png"][0]
+
+    return next(extension for extension, name in OUTPUT_EXTENSIONS.items()
+                if OUTPUT_PROFILES[name][0] == imageFormat)
+
+
+# Embeds one piece of a sharded cipher in a worker process. Never raises --
+# a failed shard comes back with "status": "error"
+def shard_job(carrierFile,
+              outputFile,
+              cipherPiece,
+              keyHexString,
+              header,
+              memoryBudget=None,
+              outputProfile=None):
+    startTime = time.time()
+    result = {
+        "shard": header.shard.index,
+        "carrier": carrierFile,
+        "output": outputFile,
+        "offset": header.shard.offset,
+        "cipherBytes": len(cipherPiece)
+    }
+
+    try:
+        os.makedirs(os.path.dirname(outputFile) or ".", exist_ok=True)
+        embed_image(carrierFile,
+                    outputFile,
+                    cipherPiece,
+                    keyHexString,
+                    header,
+                    memoryBudget=memoryBudget,
+                    outputProfile=outputProfile)
+
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = type(e).__name__ + ": " + str(e)
+
+    result["seconds"] = round(time.time() - startTime, 6)
+
+    return result
+
+
+# Spreads one payload (a text, or files zipped together) over several
+# carriers -- the cipher is cut in proportion to the carriers' capacities
+# and every carrier is embedded in its own worker process, so the slowest
+# carrier sets the wall time. Carriers that can't take a shard (too small
+# for the shard header, or a mode the output format can't keep) are
+# skipped with a JSON line, and so are carriers left with nothing to carry;
+# only the room of all the others together has to be enough. Prints one
+# JSON line per shard as it finishes and a summary with the payload ID on
+# stderr; returns the number of failed shards
+def shard_hide(encryptionKey,
+               secretMsg,
+               carrierFiles,
+               outputFiles,
+               files,
+               multipleInputFlag,
+               workers=None,
+               memoryBudget=None,
+               outputProfile=None,
+               depth=1,
+               alphaLane=False,
+               compression=None):
+    startTime = time.time()
+
+    if (multipleInputFlag == True):
+        secretBytes = zip_files(files)
+    else:
+        secretBytes = secretMsg.encode()
+
+    codec = "none"
+    if (multipleInputFlag == False):
+        codec, secretBytes = compress_payload(secretBytes, compression)
+
+    kind = "zip" if (multipleInputFlag == True) else "text"
+
+    if (len(carrierFiles) > 0xFFFF):
+        raise ValueError("A payload can be spread over at most " +
+                         str(0xFFFF) + " carriers")
+
+    # Every carrier needs room for the longer header of a shard
+    probeHeader = make_header(0, kind, depth, alphaLane, codec, "scatter",
+                              ShardInfo(bytes(8), 0, 1, 0, 0,
+                                        bytes(AES_BLOCK_BYTES)))
+    usable = []
+    capacities = []
+    for carrierFile, outputFile in zip(carrierFiles, outputFiles):
+        try:
+            carrier = CarrierImage(carrierFile)
+            carrier.check_output(outputFile, outputProfile)
+            carrier.check_capacity(probeHeader)
+        except (ValueError, OSError) as e:
+            print(json.dumps({
+                "carrier": carrierFile,
+                "status": "skipped",
+                "error": str(e)
+            }),
+                  flush=True)
+            continue
+
+        usable.append((carrierFile, outputFile))
+        capacities.append(carrier.capacity_bits(depth, alphaLane) // 8)
+
+    cipherText, keyHexString = encrypt_payload(encryptionKey, secretBytes)
+    cipherView = memoryview(cipherText)
+
+    shards = [(carrierFile, outputFile, offset, size)
+              for (carrierFile, outputFile), (offset, size) in zip(
+                  usable, split_shards(len(cipherText), capacities))
+              if size > 0]
+    payloadId = os.urandom(8)
+    failed = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+
+        for index, (carrierFile, outputFile, offset,
+                    size) in enumerate(shards):
+            header = make_header(
+                8 * size, kind, depth, alphaLane, codec, "scatter",
+                ShardInfo(
+                    payloadId, index, len(shards), offset, len(cipherText),
+                    bytes(cipherView[offset - AES_BLOCK_BYTES:offset]) if
+                    (offset > 0) else bytes(AES_BLOCK_BYTES)))
+
+            futures[pool.submit(shard_job, carrierFile, outputFile,
+                                bytes(cipherView[offset:offset + size]),
+                                keyHexString, header, memoryBudget,
+                                outputProfile)] = index
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "shard": futures[future],
+                    "status": "error",
+                    "error": type(e).__name__ + ": " + str(e)
+                }
+
+            if (result["status"] != "ok"):
+                failed += 1
+
+            print(json.dumps(result), flush=True)
+
+    print(json.dumps({
+        "shards": len(shards),
+        "failed": failed,
+        "payloadId": payloadId.hex(),
+        "cipherBytes": len(cipherText),
+        "codec": codec,
+        "seconds": round(time.time() - startTime, 6)
+    }),
+          file=sys.stderr)
+
+    return failed
+
+
+# Reads and checks the header of imageFile (see verify_header()) ->
+# StegoHeader. Only row 0 is decoded where strip processing can read the
+# image, so a whole set of images is surveyed before any payload is
+def read_image_header(imageFile, keyHexString):
+    try:
+        reader = PngStripReader(imageFile)
+    except ValueError:
+        reader = None
+
+    if (reader is not None):
+        mode, width, height = reader.mode, reader.width, reader.height
+        rowPixels = reader.read_rows(1)
+        reader.close()
+    else:
+        with Image.open(imageFile) as imageWorker:
+            mode = imageWorker.mode
+            width, height = imageWorker.size
+            rowPixels = np.asarray(imageWorker.crop((0, 0, width, 1)))
+
+    # Raises ValueError for the modes hide() doesn't take
+    embedding_lanes(mode)
+    colorLanes = COLOR_LANES[mode]
+    flatPixels = rowPixels.reshape(width, -1)
+
+    header = read_header(flatPixels, colorLanes, width)
+    lanes = min(colorLanes + (1 if (header.alphaLane == True) else 0),
+                len(mode))
+    verify_header(flatPixels, colorLanes, width, height, lanes, header,
+                  keyHexString)
+
+    return header
+
+
+# Extracts and decrypts one shard in a worker process -> (result, plain
+# piece). Never raises -- a failed shard comes back with "status": "error"
+# and no piece
+def join_job(imageFile, decryptionKey, extractBackend, memoryBudget=None):
+    startTime = time.time()
+    result = {"image": imageFile}
+    plainPiece = None
+
+    try:
+        keyHexString = derive_key(decryptionKey)[0]
+        cipherPiece, header = extract_image(imageFile, keyHexString,
+                                            extractBackend, memoryBudget)
+
+        if (header.shard is None):
+            raise ValueError("The image holds no shard")
+
+        plainPiece = decrypt_shard(decryptionKey, cipherPiece, header.shard)
+
+        result["shard"] = header.shard.index
+        result["offset"] = header.shard.offset
+        result["cipherBytes"] = len(cipherPiece)
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = type(e).__name__ + ": " + str(e)
+
+    result["seconds"] = round(time.time() - startTime, 6)
+
+    return result, plainPiece
+
+
+# Decompresses the file at sourcePath into outputPath a chunk at a time
+def decompress_file(sourcePath, outputPath, codec):
+    decompressor = PAYLOAD_DECOMPRESSORS[codec]()
+
+    with open(sourcePath, "rb") as source, open(outputPath, "wb") as output:
+        for chunk in iter(lambda: source.read(CIPHER_CHUNK_BYTES), b""):
+            output.write(decompressor.decompress(chunk))
+
+        if (codec == "zlib"):
+            output.write(decompressor.flush())
+
+
+# Reassembles a payload spread over several carriers by shard_hide() from
+# the images under inputPath (a directory or glob). The headers of all
+# images are surveyed first, so missing shards are reported before anything
+# is decoded; then the shards are extracted and decrypted in a process pool
+# and every piece is written at its offset of the output as it comes in,
+# whatever the order. No more than two pieces per worker are in flight at a
+# time, so memory follows the shard size rather than the payload size.
+# Text and raw payloads are written to output, files are unzipped into the
+# output directory. Prints one JSON line per image and a summary on stderr;
+# returns the number of missing and failed shards
+def join_shards(inputPath,
+                decryptionKey,
+                output,
+                workers=None,
+                extractBackend=DEFAULT_BACKEND,
+                memoryBudget=None):
+    startTime = time.time()
+    images = collect_images(inputPath)
+    keyHexString = derive_key(decryptionKey)[0]
+    shards = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        surveys = [
+            pool.submit(read_image_header, imageFile, keyHexString)
+            for imageFile in images
+        ]
+
+        for imageFile, future in zip(images, surveys):
+            try:
+                header = future.result()
+
+                if (header.shard is None):
+                    raise ValueError("The image holds no shard")
+            except Exception as e:
+                print(json.dumps({
+                    "image": imageFile,
+                    "status": "skipped",
+                    "error": type(e).__name__ + ": " + str(e)
+                }),
+                      flush=True)
+                continue
+
+            shards.setdefault(header.shard.payloadId,
+                              {}).setdefault(header.shard.index,
+                                             (imageFile, header))
+
+        if (len(shards) != 1):
+            raise ValueError(
+                "No shards found under " + str(inputPath) if
+                (len(shards) == 0) else "The images hold shards of " +
+                str(len(shards)) + " payloads -- " +
+                ", ".join(sorted(i.hex() for i in shards)))
+
+        payloadId, pieces = shards.popitem()
+        firstHeader = next(iter(pieces.values()))[1]
+        kind, codec = firstHeader.kind, firstHeader.codec
+        cipherBytes = firstHeader.shard.cipherBytes
+
+        missing = [
+            i for i in range(firstHeader.shard.count) if i not in pieces
+        ]
+        if (len(missing) > 0):
+            print(json.dumps({
+                "payloadId": payloadId.hex(),
+                "status": "missing",
+                "missing": missing
+            }),
+                  flush=True)
+
+            return len(missing)
+
+        # Spooled next to the output, then renamed / unpacked into it
+        spoolFile = output + ".part"
+        os.makedirs(os.path.dirname(os.path.abspath(spoolFile)),
+                    exist_ok=True)
+        failed = 0
+
+        with open(spoolFile, "wb") as spool:
+            spool.truncate(cipherBytes)
+
+            pending = iter(sorted(pieces.values(),
+                                  key=lambda i: i[1].shard.index))
+            inFlight = {}
+            maxInFlight = 2 * (workers or os.cpu_count() or 1)
+
+            while True:
+                for imageFile, header in itertools.islice(
+                        pending, maxInFlight - len(inFlight)):
+                    inFlight[pool.submit(join_job, imageFile, decryptionKey,
+                                         extractBackend,
+                                         memoryBudget)] = (imageFile, header)
+
+                if (len(inFlight) == 0):
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    inFlight, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    imageFile, header = inFlight.pop(future)
+
+                    try:
+                        result, plainPiece = future.result()
+                    except Exception as e:
+                        result, plainPiece = {
+                            "image": imageFile,
+                            "status": "error",
+                            "error": type(e).__name__ + ": " + str(e)
+                        }, None
+
+                    if (result["status"] == "ok"):
+                        spool.seek(header.shard.offset)
+                        spool.write(plainPiece)
+                    else:
+                        failed += 1
+
+                    del plainPiece
+                    print(json.dumps(result), flush=True)
+
+    try:
+        if (failed == 0):
+            if (kind == "zip"):
+                with zipfile.ZipFile(spoolFile) as zipFileObject:
+                    zipFileObject.extractall(output)
+            elif (codec != "none"):
+                decompress_file(spoolFile, output, codec)
+            else:
+                os.replace(spoolFile, output)
+    finally:
+        if (os.path.exists(spoolFile)):
+            os.remove(spoolFile)
+
+    print(json.dumps({
+        "shards": len(pieces),
+        "failed": failed,
+        "payloadId": payloadId.hex(),
+        "kind": kind,
+        "codec": codec,
+        "cipherBytes": cipherBytes,
+        "output": output if (failed == 0) else None,
+        "seconds": round(time.time() - startTime, 6)
+    }),
+          file=sys.stderr)
+
+    return failed
+
+
+# Opens (and creates) the carrier index at indexFile
+def open_carrier_index(indexFile):
+    connection = sqlite3.connect(indexFile)
+    connection.executescript(CARRIER_INDEX_SCHEMA)
+
+    return connection
+
+
+# Hashes and measures one carrier in a worker process -> its index row, or
+# (carrierFile, error) if it can't be read. Only the image header is
+# decoded
+def index_job(carrierFile):
+    try:
+        stat = os.stat(carrierFile)
+
+        digest = hashlib.sha256()
+        with open(carrierFile, "rb") as f:
+            for chunk in iter(lambda: f.read(CIPHER_CHUNK_BYTES), b""):
+                digest.update(chunk)
+
+        carrier = CarrierImage(carrierFile)
+        channels = len(carrier.image.getbands())
+        carrier.image.close()
+
+        colorLanes = capacityBits = alphaCapacityBits = None
+        if (carrier.mode in COLOR_LANES):
+            colorLanes = COLOR_LANES[carrier.mode]
+            capacityBits = carrier.capacity_bits()
+
+            if (carrier.mode in ("RGBA", "LA")):
+                alphaCapacityBits = carrier.capacity_bits(alphaLane=True)
+
+        return (carrierFile, stat.st_mtime, stat.st_size, digest.hexdigest(),
+                carrier.mode, carrier.width, carrier.height, channels,
+                colorLanes, capacityBits, alphaCapacityBits)
+    except Exception as e:
+        return (carrierFile, type(e).__name__ + ": " + str(e))
+
+
+# Adds the carriers under inputPath (a directory or glob) to the index at
+# indexFile, in a process pool. Incremental -- only carriers that are new
+# or whose mtime or size changed are hashed and measured again (all of them
+# with rehash), a carrier whose content hash didn't change keeps its row,
+# and rows of files that are gone are dropped. Prints a summary on stderr
+# and returns the number of carriers that couldn't be read
+def build_carrier_index(indexFile, inputPath, workers=None, rehash=False):
+    startTime = time.time()
+    carrierFiles = [os.path.abspath(i) for i in collect_images(inputPath)]
+    connection = open_carrier_index(indexFile)
+
+    known = {
+        path: (mtime, size, sha256)
+        for path, mtime, size, sha256 in connection.execute(
+            "SELECT path, mtime, size, sha256 FROM carriers")
+    }
+
+    removed = [(path, ) for path in known if not os.path.exists(path)]
+    connection.executemany("DELETE FROM carriers WHERE path = ?", removed)
+    connection.commit()
+
+    staleFiles = []
+    for carrierFile in carrierFiles:
+        stat = os.stat(carrierFile)
+
+        if (rehash == True or known.get(carrierFile, (None, None))[:2] !=
+                (stat.st_mtime, stat.st_size)):
+            staleFiles.append(carrierFile)
+
+    counts = {"added": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    rows = []
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for row in pool.map(index_job, staleFiles, chunksize=16):
+            if (len(row) == 2):
+                counts["failed"] += 1
+                print(json.dumps({
+                    "carrier": row[0],
+                    "status": "error",
+                    "error": row[1]
+                }),
+                      flush=True)
+                continue
+
+            if (row[0] not in known):
+                counts["added"] += 1
+            elif (known[row[0]][2] != row[3]):
+                counts["updated"] += 1
+            else:
+                counts["unchanged"] += 1
+
+            rows.append(row)
+            if (len(rows) >= CARRIER_INDEX_BATCH):
+                connection.executemany(
+                    "INSERT OR REPLACE INTO carriers VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                connection.commit()
+                rows = []
+
+    connection.executemany(
+        "INSERT OR REPLACE INTO carriers VALUES "
+        "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    connection.commit()
+    connection.close()
+
+    counts["unchanged"] += len(carrierFiles) - len(staleFiles)
+    print(json.dumps(
+        dict(carriers=len(carrierFiles),
+             removed=len(removed),
+             seconds=round(time.time() - startTime, 6),
+             **counts)),
+          file=sys.stderr)
+
+    return counts["failed"]
+
+
+# The indexed carriers that can take payloadBytes bytes of the given kind
+# and layout, smallest first -> up to limit dicts with path, mode, size and
+# capacity in bytes. Answered from the index alone; the carriers aren't
+# opened, so hide() still checks the one picked
+def query_carrier_index(indexFile,
+                        payloadBytes,
+                        depth=1,
+                        alphaLane=False,
+                        kind="text",
+                        codec="none",
+                        limit=1):
+    header = make_header(8 * payloadBytes, kind, depth, alphaLane, codec)
+    column = "alphaCapacityBits" if (alphaLane == True) else "capacityBits"
+
+    # The original zip header needs pixel (0, 21) of RGB(A) images as well
+    # -- see check_capacity()
+    minHeight = 22 if (header.version == 1 and header.kind == "zip") else 0
+
+    connection = open_carrier_index(indexFile)
+    rows = connection.execute(
+        "SELECT path, mode, width, height, " + column + " FROM carriers "
+        "WHERE " + column + " >= ? AND width >= CASE colorLanes WHEN 3 "
+        "THEN ? ELSE ? END AND (colorLanes = 1 OR height >= ?) "
+        "ORDER BY " + column + " LIMIT ?",
+        (-(-header.length // depth), header_width("RGB", header),
+         header_width("L", header), minHeight, limit)).fetchall()
+    connection.close()
+
+    return [{
+        "path": path,
+        "mode": mode,
+        "width": width,
+        "height": height,
+        "capacityBytes": capacityBits * depth // 8
+    } for path, mode, width, height, capacityBits in rows]
+
+
+# POST /hide of the HTTP service, in a worker process -> (content type,
+# encoded image)
+def serve_hide_job(carrierBytes, key, payload, kind, depth, alphaLane,
+                   compression, outputProfile):
+    imageBytes = hide_bytes(carrierBytes, key, payload, kind,
+                            outputProfile=outputProfile, depth=depth,
+                            alphaLane=alphaLane, compression=compression)
+
+    return Image.MIME.get(OUTPUT_PROFILES[outputProfile][0],
+                          "application/octet-stream"), imageBytes
+
+
+# POST /find of the HTTP service, in a worker process -> (content type,
+# payload). Files come back zipped together
+def serve_find_job(imageBytes, key):
+    kind, payload = find_bytes(imageBytes, key)
+
+    if (kind == "files"):
+        return "application/zip", zip_members(payload)
+    elif (kind == "text"):
+        return "text/plain; charset=utf-8", payload.encode()
+
+    return "application/octet-stream", payload
+
+
+# POST /capacity of the HTTP service, in a worker process -> (content type,
+# JSON with the payload bytes the image takes at every depth). Only the
+# image header is decoded
+def serve_capacity_job(imageBytes):
+    carrier = CarrierImage(imageBytes)
+    alphaLane = carrier.mode in ("RGBA", "LA")
+
+    report = {
+        "mode": carrier.mode,
+        "width": carrier.width,
+        "height": carrier.height,
+        "capacityBytes": {
+            depth: carrier.capacity_bits(depth) // 8
+            for depth in range(1, MAX_DEPTH + 1)
+        },
+        "alphaCapacityBytes": {
+            depth: carrier.capacity_bits(depth, True) // 8
+            for depth in range(1, MAX_DEPTH + 1)
+        } if (alphaLane == True) else None
+    }
+
+    return "application/json", json.dumps(report).encode()
+
+
+# The fields of a multipart/form-data body -> [(name, file name, bytes)]
+def parse_form(contentType, body):
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + contentType.encode() + b"\r\n\r\n" + body)
+
+    if (message.is_multipart() == False):
+        raise ValueError("Expected a multipart/form-data body")
+
+    return [(part.get_param("name", header="content-disposition"),
+             part.get_filename(), part.get_payload(decode=True))
+            for part in message.iter_parts()]
+
+
+# Requests of the HTTP service. Every job runs in the server's process
+# pool; a request that finds all worker and queue slots taken gets 429
+# with Retry-After right away instead of waiting. Results are streamed
+# back with chunked transfer encoding
+class StegoRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # A GET body is never read -- it mustn't pass for the next request
+        if ("Content-Length" in self.headers
+                or "Transfer-Encoding" in self.headers):
+            self.close_connection = True
+
+        if (urllib.parse.urlsplit(self.path).path != "/health"):
+            self.send_json(404, {"error": "Unknown endpoint"})
+            return
+
+        self.send_json(
+            200, {
+                "status": "ok",
+                "workers": self.server.workers,
+                "queueJobs": self.server.queueJobs
+            })
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+
+        if (url.path not in ("/hide", "/find", "/capacity")):
+            self.reject(404, "Unknown endpoint")
+            return
+
+        bodyLength = self.headers.get("Content-Length", "")
+        if (bodyLength.isascii() == False or bodyLength.isdigit() == False):
+            self.reject(411, "A Content-Length of 0 or more bytes is "
+                        "required")
+            return
+
+        bodyLength = int(bodyLength)
+        if (bodyLength > self.server.maxBodyBytes):
+            self.reject(413,
+                        "Body over " + str(self.server.maxBodyBytes) +
+                        " bytes")
+            return
+
+        # Backpressure before the body is even read
+        if (self.server.jobSlots.acquire(blocking=False) == False):
+            self.reject(429, "Too many jobs -- try again",
+                        {"Retry-After": "1"})
+            return
+
+        # The slot is free again before anything is answered, so a client
+        # that sends its next request right away doesn't get 429
+        try:
+            body = self.rfile.read(bodyLength)
+
+            try:
+                job = self.parse_job(url.path,
+                                     dict(urllib.parse.parse_qsl(url.query)),
+                                     body)
+            except ValueError as e:
+                status, error = 400, str(e)
+            else:
+                del body
+
+                try:
+                    contentType, result = self.server.pool.submit(
+                        *job).result()
+                    status = 200
+                except ValueError as e:
+                    status, error = 422, str(e)
+                # The jobs only read in-memory buffers, so these come from
+                # a body Pillow can't decode (UnidentifiedImageError is an
+                # OSError, truncated data a SyntaxError or OSError)
+                except (OSError, SyntaxError,
+                        Image.DecompressionBombError) as e:
+                    status, error = 422, "Not a readable image -- " + str(e)
+                except Exception as e:
+                    status, error = 500, type(e).__name__ + ": " + str(e)
+        finally:
+            self.server.jobSlots.release()
+
+        if (status == 200):
+            self.send_stream(200, contentType, result)
+        else:
+            self.send_json(status, {"error": error})
+
+    # The job of a request -> (worker function, arguments...). Raises
+    # ValueError for a malformed request
+    def parse_job(self, path, query, body):
+        if (path == "/capacity"):
+            return serve_capacity_job, body
+
+        key = self.headers.get("X-Stegano-Key")
+        if (not key):
+            raise ValueError("The key goes in the X-Stegano-Key header")
+
+        if (path == "/find"):
+            return serve_find_job, body, key
+
+        kind = query.get("kind", "text")
+        depth = int(query.get("depth", 1))
+        compression = query.get("compress", "none")
+        outputProfile = query.get("profile", "png")
+
+        if (kind not in ("text", "files", "raw")
+                or depth not in range(1, MAX_DEPTH + 1)
+                or compression not in ("auto", ) + PAYLOAD_CODECS
+                or outputProfile not in OUTPUT_PROFILES):
+            raise ValueError("Bad kind, depth, compress or profile")
+
+        fields = parse_form(self.headers.get("Content-Type", ""), body)
+        carrierBytes = next(
+            (data for name, _, data in fields if name == "carrier"), None)
+
+        if (kind == "files"):
+            payload = {
+                fileName or name: data
+                for name, fileName, data in fields if name == "files"
+            }
+        else:
+            payload = next(
+                (data for name, _, data in fields if name == "payload"), None)
+
+        if (carrierBytes is None or not payload):
+            raise ValueError("The body needs a carrier field and a payload "
+                             "field (files fields with kind=files)")
+
+        return (serve_hide_job, carrierBytes, key, payload, kind, depth,
+                query.get("alpha") in ("1", "true"), compression,
+                outputProfile)
+
+    # Answers a request whose body is left unread -- the connection is
+    # closed afterwards, so the body is never taken for the next request
+    def reject(self, status, error, headers={}):
+        self.close_connection = True
+        self.send_json(status, {"error": error},
+                       dict(headers, Connection="close"))
+
+    def send_json(self, status, document, headers={}):
+        data = json.dumps(document).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, status, contentType, data):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for chunk in iter_chunks(data):
+            self.wfile.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+# Runs the HTTP service on localhost:port until interrupted -- POST /hide
+# (multipart: a carrier field and a payload field, or files fields with
+# ?kind=files; ?kind, ?depth, ?alpha, ?compress and ?profile as for hide),
+# POST /find and POST /capacity (the image as the body) and GET /health.
+# The key goes in the X-Stegano-Key header. Jobs run on a pool of workers
+# processes with queueJobs more waiting at most. ready(server) is called
+# once the server listens (port 0 picks a free one, see server.server_port);
+# server.shutdown() from another thread stops it
+def serve(port,
+          workers=None,
+          queueJobs=SERVE_QUEUE_JOBS,
+          maxBodyBytes=SERVE_MAX_BODY_BYTES,
+          ready=None):
+    workers = workers or os.cpu_count() or 1
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        server = http.server.ThreadingHTTPServer((SERVE_HOST, port),
+                                                 StegoRequestHandler)
+        server.pool = pool
+        server.workers = workers
+        server.queueJobs = queueJobs
+        server.maxBodyBytes = maxBodyBytes
+        server.jobSlots = threading.BoundedSemaphore(workers + queueJobs)
+
+        print(json.dumps({
+            "listening":
+            "http://" + SERVE_HOST + ":" + str(server.server_port),
+            "workers": workers,
+            "queueJobs": queueJobs
+        }),
+              file=sys.stderr,
+              flush=True)
+
+        if (ready is not None):
+            ready(server)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+# Runs a menu action -- under a StageProfiler when profiling, printing its
+# stage table afterwards and appending its report as one JSON line to
+# profileFile when one was given
+def run_menu_action(profile, profileFile, function, *args):
+    if (profile == False):
+        return function(*args)
+
+    with StageProfiler() as profiler:
+        result = function(*args)
+
+    print(colored(profiler.format_report(), 'magenta'))
+    print()
+
+    if (profileFile is not None):
+        with open(profileFile, "a") as f:
+            f.write(
+                json.dumps(dict(action=function.__name__,
+                                **profiler.report())) + "\n")
+
+    return result
+
+
+def main(profile=False,
+         profileFile=None,
+         outputProfile=None,
+         depth=1,
+         alphaLane=False,
+         compression=None):
     userMenuInput = 0
     hideMenuInput = 0
 
@@ -1501,18 +4917,23 @@ def main():
                             print()
                         elif (hideMenuInput == 1):  # Option 1 --> Raw String
                             encodeInputKey, encodeInputMsg, encodeSrcImgPath, encodeDstImgName = raw_text_input(
-                            )
+                                depth, alphaLane, compression, outputProfile)
 
                             print(colored("Encoding...", "green"))
                             print()
 
-                            hide(encodeInputKey, encodeInputMsg,
-                                 encodeSrcImgPath, encodeDstImgName, [], False)
+                            run_menu_action(profile, profileFile, hide,
+                                            encodeInputKey, encodeInputMsg,
+                                            encodeSrcImgPath,
+                                            encodeDstImgName, [], False,
+                                            DEFAULT_BACKEND, None, None,
+                                            outputProfile, depth,
+                                            alphaLane, compression)
 
                             hideMenuInput = 3
                         elif (hideMenuInput == 2):  # Option 2 --> File(s)
                             files, encodeInputKey, encodeSrcImgPath, encodeDstImgName = file_s_input(
-                            )
+                                depth, alphaLane, outputProfile)
 
                             if (len(files) == 0):
                                 hideMenuInput = 3
@@ -1528,8 +4949,13 @@ def main():
 
                                 startTime = time.time()
 
-                                hide(encodeInputKey, "", encodeSrcImgPath,
-                                     encodeDstImgName, files, True)
+                                run_menu_action(profile, profileFile, hide,
+                                                encodeInputKey, "",
+                                                encodeSrcImgPath,
+                                                encodeDstImgName, files,
+                                                True, DEFAULT_BACKEND, None,
+                                                None, outputProfile, depth,
+                                                alphaLane)
 
                                 endTime = time.time()
 
@@ -1553,7 +4979,8 @@ def main():
                 startTime = time.time()
                 print(colored("Decoding...", "green"))
                 print()
-                find(decodeInputKey, decodeSrcImgPath)
+                run_menu_action(profile, profileFile, find,
+                                decodeInputKey, decodeSrcImgPath)
                 print()
 
                 endTime = time.time()
@@ -1570,5 +4997,350 @@ def main():
     print()
 
 
+# Non-interactive entry point -- python stegano.py <command> ...
+def cli(argv):
+    parser = argparse.ArgumentParser(
+        prog="stegano.py",
+        description="BPS Stegano -- run without arguments for the menu")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="print wall time, CPU time and peak memory of "
+                        "every stage of hide/find")
+    parser.add_argument("--profile-json",
+                        metavar="FILE",
+                        default=None,
+                        help="menu mode: also append each profile report to "
+                        "FILE as a JSON line")
+    parser.add_argument("--output-profile",
+                        choices=list(OUTPUT_PROFILES),
+                        default=None,
+                        help="menu mode: how the encoded image is saved "
+                        "(default: from its file extension)")
+    parser.add_argument("--depth",
+                        type=int,
+                        choices=range(1, MAX_DEPTH + 1),
+                        default=1,
+                        help="menu mode: low bits per channel to embed into "
+                        "(default: 1)")
+    parser.add_argument("--alpha",
+                        action="store_true",
+                        help="menu mode: embed into the alpha channel of "
+                        "RGBA and LA images as well")
+    parser.add_argument("--compress",
+                        choices=("auto", ) + PAYLOAD_CODECS,
+                        default="none",
+                        help="menu mode: compress text messages before "
+                        "encrypting them (default: none)")
+    commands = parser.add_subparsers(dest="command")
+
+    hideParser = commands.add_parser(
+        "hide",
+        help="embed a batch of payloads listed in a manifest, or one "
+        "payload read from a file or stdin")
+    hideSource = hideParser.add_mutually_exclusive_group(required=True)
+    hideSource.add_argument(
+        "--manifest",
+        help="CSV or JSON lines file with carrier, output, key and text or "
+        "files columns")
+    hideSource.add_argument(
+        "--input",
+        help="file to hide as raw bytes, - for stdin (needs --carrier, "
+        "--output and --key). Read and encrypted in chunks, but the cipher "
+        "is held whole until it is embedded: memory grows with the "
+        "payload, up to the carrier's capacity")
+    hideParser.add_argument("--carrier", help="--input: the carrier image")
+    hideParser.add_argument("--output", help="--input: the encoded image")
+    hideParser.add_argument("--key",
+                            help="--input: key reference: env:NAME, "
+                            "file:PATH or the key itself")
+    hideParser.add_argument("--workers",
+                            type=int,
+                            default=None,
+                            help="worker processes (default: CPU count)")
+    hideParser.add_argument("--backend",
+                            choices=sorted(EMBED_BACKENDS),
+                            default=DEFAULT_BACKEND)
+    hideParser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="process carriers in strips within this many bytes")
+    hideParser.add_argument("--profile",
+                            action="store_true",
+                            default=argparse.SUPPRESS,
+                            help="add a per-stage profile to every job line")
+    hideParser.add_argument(
+        "--output-profile",
+        choices=list(OUTPUT_PROFILES),
+        default=argparse.SUPPRESS,
+        help="how the encoded images are saved (default: from the "
+        "extension of each output)")
+    hideParser.add_argument("--depth",
+                            type=int,
+                            choices=range(1, MAX_DEPTH + 1),
+                            default=argparse.SUPPRESS,
+                            help="low bits per channel to embed into")
+    hideParser.add_argument("--alpha",
+                            action="store_true",
+                            default=argparse.SUPPRESS,
+                            help="embed into the alpha channel of RGBA and "
+                            "LA carriers as well")
+    hideParser.add_argument("--compress",
+                            choices=("auto", ) + PAYLOAD_CODECS,
+                            default=argparse.SUPPRESS,
+                            help="compress text payloads before encrypting "
+                            "them")
+
+    shardParser = commands.add_parser(
+        "shard", help="spread one payload over several carriers")
+    shardParser.add_argument("--carriers",
+                             required=True,
+                             help="directory (searched recursively) or glob")
+    shardParser.add_argument("--key",
+                             required=True,
+                             help="key reference: env:NAME, file:PATH or "
+                             "the key itself")
+    shardParser.add_argument("--output-dir",
+                             required=True,
+                             help="where the encoded carriers are written")
+    shardPayload = shardParser.add_mutually_exclusive_group(required=True)
+    shardPayload.add_argument("--text", help="the message to hide")
+    shardPayload.add_argument("--files",
+                              nargs="+",
+                              help="files to zip together and hide")
+    shardParser.add_argument("--workers",
+                             type=int,
+                             default=None,
+                             help="worker processes (default: CPU count)")
+    shardParser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="process carriers in strips within this many bytes")
+    shardParser.add_argument(
+        "--output-profile",
+        choices=list(OUTPUT_PROFILES),
+        default=argparse.SUPPRESS,
+        help="how the encoded carriers are saved (default: png)")
+    shardParser.add_argument("--depth",
+                             type=int,
+                             choices=range(1, MAX_DEPTH + 1),
+                             default=argparse.SUPPRESS,
+                             help="low bits per channel to embed into")
+    shardParser.add_argument("--alpha",
+                             action="store_true",
+                             default=argparse.SUPPRESS,
+                             help="embed into the alpha channel of RGBA and "
+                             "LA carriers as well")
+    shardParser.add_argument("--compress",
+                             choices=("auto", ) + PAYLOAD_CODECS,
+                             default=argparse.SUPPRESS,
+                             help="compress a text payload before "
+                             "encrypting it")
+
+    joinParser = commands.add_parser(
+        "join", help="reassemble a payload spread over several carriers")
+    joinParser.add_argument("--input",
+                            required=True,
+                            help="directory (searched recursively) or glob")
+    joinParser.add_argument("--key",
+                            required=True,
+                            help="key reference: env:NAME, file:PATH or the "
+                            "key itself")
+    joinParser.add_argument("--output",
+                            required=True,
+                            help="file the text or bytes are written to, or "
+                            "directory the files are unzipped into")
+    joinParser.add_argument("--workers",
+                            type=int,
+                            default=None,
+                            help="worker processes (default: CPU count)")
+    joinParser.add_argument("--backend",
+                            choices=sorted(EXTRACT_BACKENDS),
+                            default=DEFAULT_BACKEND)
+    joinParser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="process images in strips within this many bytes")
+
+    indexParser = commands.add_parser(
+        "index", help="add a pool of carriers to a carrier index")
+    indexParser.add_argument("--carriers",
+                             required=True,
+                             help="directory (searched recursively) or glob")
+    indexParser.add_argument("--index",
+                             required=True,
+                             help="the SQLite index file (created if needed)")
+    indexParser.add_argument("--workers",
+                             type=int,
+                             default=None,
+                             help="worker processes (default: CPU count)")
+    indexParser.add_argument("--rehash",
+                             action="store_true",
+                             help="hash every carrier again, not just the "
+                             "ones whose mtime or size changed")
+
+    pickParser = commands.add_parser(
+        "pick", help="find the smallest indexed carriers that fit a payload")
+    pickParser.add_argument("--index",
+                            required=True,
+                            help="the SQLite index file")
+    pickParser.add_argument("--bytes",
+                            type=int,
+                            required=True,
+                            help="payload size in bytes")
+    pickParser.add_argument("--kind",
+                            choices=PAYLOAD_KINDS,
+                            default="text")
+    pickParser.add_argument("--depth",
+                            type=int,
+                            choices=range(1, MAX_DEPTH + 1),
+                            default=argparse.SUPPRESS,
+                            help="low bits per channel to embed into")
+    pickParser.add_argument("--alpha",
+                            action="store_true",
+                            default=argparse.SUPPRESS,
+                            help="embed into the alpha channel as well")
+    pickParser.add_argument("--limit",
+                            type=int,
+                            default=1,
+                            help="carriers to list (default: 1)")
+
+    serveParser = commands.add_parser(
+        "serve", help="run the HTTP service on localhost")
+    serveParser.add_argument("--port",
+                             type=int,
+                             default=8765,
+                             help="port to listen on (default: 8765, 0 for "
+                             "any free one)")
+    serveParser.add_argument("--workers",
+                             type=int,
+                             default=None,
+                             help="worker processes (default: CPU count)")
+    serveParser.add_argument(
+        "--queue",
+        type=int,
+        default=SERVE_QUEUE_JOBS,
+        help="jobs that may wait for a worker before requests get 429 "
+        "(default: " + str(SERVE_QUEUE_JOBS) + ")")
+    serveParser.add_argument(
+        "--max-body",
+        type=int,
+        default=SERVE_MAX_BODY_BYTES,
+        help="largest request body in bytes (default: " +
+        str(SERVE_MAX_BODY_BYTES) + ")")
+
+    findParser = commands.add_parser(
+        "find", help="extract every stego image in a directory or glob")
+    findParser.add_argument("--input",
+                            required=True,
+                            help="directory (searched recursively) or glob")
+    findParser.add_argument("--key",
+                            required=True,
+                            help="key reference: env:NAME, file:PATH or the "
+                            "key itself")
+    findParser.add_argument("--output-dir",
+                            required=True,
+                            help="where the per-image outputs are written")
+    findParser.add_argument("--workers",
+                            type=int,
+                            default=None,
+                            help="worker processes (default: CPU count)")
+    findParser.add_argument("--backend",
+                            choices=sorted(EXTRACT_BACKENDS),
+                            default=DEFAULT_BACKEND)
+    findParser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="process images in strips within this many bytes")
+    findParser.add_argument("--profile",
+                            action="store_true",
+                            default=argparse.SUPPRESS,
+                            help="add a per-stage profile to every image line")
+
+    args = parser.parse_args(argv)
+    profile = args.profile or args.profile_json is not None
+
+    if (args.command == "hide" and args.input is not None):
+        if (None in (args.carrier, args.output, args.key)):
+            hideParser.error("--input needs --carrier, --output and --key")
+
+        try:
+            result = hide_stream(resolve_key(args.key), args.input,
+                                 args.carrier, args.output, args.backend,
+                                 args.memory_budget, None,
+                                 args.output_profile, args.depth, args.alpha,
+                                 args.compress)
+        except (ValueError, OSError) as e:
+            print(json.dumps({"error": str(e)}), file=sys.stderr)
+            return 1
+
+        print(json.dumps(dict(output=args.output, **result)))
+        return 0
+    elif (args.command == "hide"):
+        failed = batch_hide(args.manifest, args.workers, args.backend,
+                            args.memory_budget, profile, args.output_profile,
+                            args.depth, args.alpha, args.compress)
+        return 1 if failed else 0
+    elif (args.command == "shard"):
+        carrierFiles = collect_images(args.carriers)
+        outputFiles = [
+            i + profile_extension(args.output_profile) for i in output_bases(
+                args.carriers, carrierFiles, args.output_dir)
+        ]
+
+        try:
+            failed = shard_hide(resolve_key(args.key), args.text or "",
+                                carrierFiles, outputFiles, args.files or [],
+                                args.files is not None, args.workers,
+                                args.memory_budget, args.output_profile,
+                                args.depth, args.alpha, args.compress)
+        except ValueError as e:
+            print(json.dumps({"error": str(e)}), file=sys.stderr)
+            return 1
+
+        return 1 if failed else 0
+    elif (args.command == "join"):
+        try:
+            failed = join_shards(args.input, resolve_key(args.key),
+                                 args.output, args.workers, args.backend,
+                                 args.memory_budget)
+        except ValueError as e:
+            print(json.dumps({"error": str(e)}), file=sys.stderr)
+            return 1
+
+        return 1 if failed else 0
+    elif (args.command == "index"):
+        failed = build_carrier_index(args.index, args.carriers, args.workers,
+                                     args.rehash)
+        return 1 if failed else 0
+    elif (args.command == "pick"):
+        carriers = query_carrier_index(args.index, args.bytes, args.depth,
+                                       args.alpha, args.kind,
+                                       limit=args.limit)
+
+        for carrier in carriers:
+            print(json.dumps(carrier))
+
+        return 0 if carriers else 1
+    elif (args.command == "serve"):
+        serve(args.port, args.workers, args.queue, args.max_body)
+        return 0
+    elif (args.command == "find"):
+        failed = batch_find(args.input, resolve_key(args.key),
+                            args.output_dir, args.workers, args.backend,
+                            args.memory_budget, profile)
+        return 1 if failed else 0
+    else:
+        main(profile, args.profile_json, args.output_profile, args.depth,
+             args.alpha, args.compress)
+        return 0
+
+
 if __name__ == "__main__":
-    main()
+    if (len(sys.argv) > 1):
+        sys.exit(cli(sys.argv[1:]))
+    else:
+        main()
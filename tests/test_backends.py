@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import stegano
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+KEY = "backend-key"
+
+# A small carrier and a realistic one, wide enough for a key check block
+# behind a versioned header. Images in the original layout never get one,
+# so both backends must give the very same pixels on either. The cipher
+# lengths cover 0, 1 and 2 bits modulo 3 (sub in legacy_embed()), once in
+# the pixels the mask selects and once spilling over into the inverted pass
+CARRIERS = [
+    ((40, 30), [9, 10, 11, 300, 301, 302]),
+    ((200, 150), [9, 10, 11, 6000, 6001, 6002]),
+]
+
+
+def carrier(mode, size, seed):
+    width, height = size
+    pixels = np.random.default_rng(seed).integers(0,
+                                                  256,
+                                                  (height, width, len(mode)),
+                                                  dtype=np.uint8)
+
+    # The legacy backend always sets alpha to 255
+    if (mode == "RGBA"):
+        pixels[..., 3] = 255
+
+    # A copy -- images made from arrays are read-only
+    return Image.fromarray(pixels).copy()
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+@pytest.mark.parametrize("kind", ["text", "zip"])
+@pytest.mark.parametrize("size, cipherBytes",
+                         [(size, cipherBytes)
+                          for size, lengths in CARRIERS
+                          for cipherBytes in lengths])
+def test_numpy_embed_matches_legacy(mode, kind, size, cipherBytes):
+    cipherText = bytearray(
+        np.random.default_rng(cipherBytes).integers(0,
+                                                    256,
+                                                    cipherBytes,
+                                                    dtype=np.uint8))
+
+    # The last bit set, so a dropped last bit can't go unnoticed
+    cipherText[-1] |= 1
+    cipherText = bytes(cipherText)
+
+    keyHexString = stegano.derive_key(KEY)[0]
+    header = stegano.make_header(8 * cipherBytes, kind)
+    assert header.version == 1
+    assert not stegano.key_tag_fits(header, size[0] * 3)
+
+    legacyImage = carrier(mode, size, cipherBytes)
+    numpyImage = legacyImage.copy()
+
+    stegano.legacy_embed(legacyImage, cipherText, keyHexString, header)
+    stegano.numpy_embed(numpyImage, cipherText, keyHexString, header)
+
+    assert np.array_equal(np.array(legacyImage), np.array(numpyImage))
+
+    for extract in (stegano.legacy_extract, stegano.numpy_extract):
+        foundCipher, foundHeader = extract(numpyImage.copy(), keyHexString)
+
+        assert bytes(foundCipher) == cipherText
+        assert foundHeader == header
+
+
+# Images written by hide() before any of the backends changed
+@pytest.mark.parametrize("imageName, message", [
+    ("baseline_text.png", "The quick brown fox jumps over the lazy dog"),
+    ("baseline_text_rgba.png", "RGBA carrier, alpha set to 255"),
+])
+@pytest.mark.parametrize("backend", sorted(stegano.EXTRACT_BACKENDS))
+def test_baseline_text_images(imageName, message, backend):
+    with open(os.path.join(DATA_DIR, imageName), "rb") as f:
+        assert stegano.find_bytes(f.read(), "baseline-key",
+                                  backend) == ("text", message)
+
+
+@pytest.mark.parametrize("backend", sorted(stegano.EXTRACT_BACKENDS))
+def test_baseline_files_image(backend):
+    with open(os.path.join(DATA_DIR, "baseline_files.png"), "rb") as f:
+        kind, files = stegano.find_bytes(f.read(), "baseline-key", backend)
+
+    assert kind == "files"
+    assert files == {
+        "notes.txt": b"Meeting moved to Thursday, 10:00.\n",
+        "data.bin": bytes(range(256)) * 4
+    }
+
+
+def test_baseline_image_in_strip_mode(tmp_path):
+    cipherBytes, header = stegano.extract_image(
+        os.path.join(DATA_DIR, "baseline_text.png"),
+        stegano.derive_key("baseline-key")[0],
+        memoryBudget=1 << 20)
+
+    assert header.kind == "text"
+    assert bytes(stegano.decrypt_payload(
+        "baseline-key",
+        cipherBytes)) == b"The quick brown fox jumps over the lazy dog"
+
+
+
+def embed_with_cache(monkeypatch, cache, source, cipherText, header):
+    monkeypatch.setattr(stegano, "scheduleCache", cache)
+
+    imageWorker = source.copy()
+    stegano.numpy_embed(imageWorker, cipherText,
+                        stegano.derive_key(KEY)[0], header)
+
+    return np.array(imageWorker)
+
+
+# A schedule that fits in the cache is kept for the next hide() with the
+# same key and size, one too big for it is streamed -- same pixels either way
+def test_schedule_cache(monkeypatch):
+    cipherText = bytes(range(256)) * 40
+    header = stegano.make_header(8 * len(cipherText), "text")
+    source = carrier("RGB", (200, 150), 1)
+
+    cache = stegano.ScheduleCache(1 << 20)
+    first = embed_with_cache(monkeypatch, cache, source, cipherText, header)
+    second = embed_with_cache(monkeypatch, cache, source, cipherText, header)
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.stats()["entries"] == 1
+
+    tinyCache = stegano.ScheduleCache(1000)
+    streamed = embed_with_cache(monkeypatch, tinyCache, source, cipherText,
+                                header)
+
+    assert tinyCache.stats()["entries"] == 0
+    assert np.array_equal(first, second)
+    assert np.array_equal(first, streamed)
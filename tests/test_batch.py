@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import stegano
+
+KEY = "batch-key"
+
+
+@pytest.mark.parametrize("images, expected", [
+    (["in/a.png", "in/b.bmp", "in/sub/a.png"], ["a", "b", "sub/a"]),
+    (["in/a.png", "in/a.bmp", "in/b.png"], ["a.png", "a.bmp", "b"]),
+    (["in/a.png", "in/a.bmp", "in/a.png.bmp"],
+     ["a.png", "a.bmp", "a.png-2"]),
+])
+def test_output_bases_are_unique(tmp_path, images, expected):
+    images = [str(tmp_path / i) for i in images]
+
+    assert stegano.output_bases(str(tmp_path / "in"), images, "out") == [
+        os.path.join("out", *i.split("/")) for i in expected
+    ]
+
+
+# a.png and a.bmp in one directory used to both go to out/a.txt
+def test_batch_find_keeps_every_result(tmp_path):
+    inputDir = tmp_path / "in"
+    inputDir.mkdir()
+    pixels = np.random.default_rng(0).integers(0,
+                                               256, (40, 60, 3),
+                                               dtype=np.uint8)
+
+    for name, outputProfile in (("a.png", "png"), ("a.bmp", "bmp")):
+        (inputDir / name).write_bytes(
+            stegano.hide_bytes(Image.fromarray(pixels), KEY,
+                               "from " + name,
+                               outputProfile=outputProfile))
+
+    failed = stegano.batch_find(str(inputDir), KEY, str(tmp_path / "out"),
+                                workers=1)
+
+    assert failed == 0
+    for name in ("a.png", "a.bmp"):
+        assert (tmp_path / "out" /
+                (name + ".txt")).read_text() == "from " + name
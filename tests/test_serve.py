@@ -0,0 +1,260 @@
+import io
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+import uuid
+import zipfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import stegano
+
+
+# One service for the whole module -- one worker and no queue, so a single
+# job in flight is enough for backpressure
+@pytest.fixture(scope="module")
+def service():
+    started = threading.Event()
+    servers = []
+
+    def ready(server):
+        servers.append(server)
+        started.set()
+
+    thread = threading.Thread(target=stegano.serve,
+                              args=(0, 1, 0),
+                              kwargs={"ready": ready},
+                              daemon=True)
+    thread.start()
+    assert started.wait(30)
+
+    server = servers[0]
+    yield server, "http://127.0.0.1:" + str(server.server_port)
+
+    server.shutdown()
+    thread.join(30)
+
+
+@pytest.fixture(scope="module")
+def carrier():
+    pixels = np.random.default_rng(1).integers(0,
+                                               256, (120, 160, 3),
+                                               dtype=np.uint8)
+    imageBuffer = io.BytesIO()
+    Image.fromarray(pixels).save(imageBuffer, "PNG")
+
+    return imageBuffer.getvalue()
+
+
+def form(fields):
+    boundary = uuid.uuid4().hex
+    body = b""
+
+    for name, fileName, data in fields:
+        disposition = 'form-data; name="' + name + '"'
+        if (fileName is not None):
+            disposition += '; filename="' + fileName + '"'
+
+        body += ("--" + boundary + "\r\nContent-Disposition: " +
+                 disposition + "\r\n\r\n").encode() + data + b"\r\n"
+
+    return ("multipart/form-data; boundary=" + boundary,
+            body + ("--" + boundary + "--\r\n").encode())
+
+
+def request(baseUrl, path, body=None, contentType=None, key="k1"):
+    headers = {"X-Stegano-Key": key} if (key is not None) else {}
+    if (contentType is not None):
+        headers["Content-Type"] = contentType
+
+    httpRequest = urllib.request.Request(baseUrl + path,
+                                         data=body,
+                                         headers=headers,
+                                         method="GET" if
+                                         (body is None) else "POST")
+
+    try:
+        with urllib.request.urlopen(httpRequest, timeout=60) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def raw_exchange(server, data):
+    with socket.create_connection(("127.0.0.1", server.server_port),
+                                  timeout=10) as connection:
+        connection.sendall(data)
+        received = b""
+        while True:
+            chunk = connection.recv(65536)
+            if (not chunk):
+                return received
+            received += chunk
+
+
+def test_binds_localhost_only(service):
+    server, baseUrl = service
+
+    assert server.server_address[0] == "127.0.0.1"
+
+
+def test_health(service):
+    server, baseUrl = service
+    status, headers, body = request(baseUrl, "/health")
+
+    assert status == 200
+    assert json.loads(body) == {"status": "ok", "workers": 1, "queueJobs": 0}
+
+
+def test_capacity(service, carrier):
+    server, baseUrl = service
+    status, headers, body = request(baseUrl, "/capacity", carrier, key=None)
+    report = json.loads(body)
+
+    assert status == 200
+    assert (report["mode"], report["width"], report["height"]) == ("RGB",
+                                                                   160, 120)
+    assert report["capacityBytes"]["1"] == (160 * 120 - 160) * 3 // 8
+    assert report["capacityBytes"]["4"] == (160 * 120 - 160) * 3 * 4 // 8
+    assert report["alphaCapacityBytes"] is None
+
+
+@pytest.mark.parametrize("query, payload", [
+    ("", "héllo wörld".encode()),
+    ("?kind=raw&compress=auto", bytes(range(256)) * 20 + b"\r\n--x\r\n"),
+    ("?kind=raw&depth=2&profile=tiff", bytes(3000)),
+])
+def test_hide_find_round_trip(service, carrier, query, payload):
+    server, baseUrl = service
+    contentType, body = form([("carrier", "carrier.png", carrier),
+                              ("payload", None, payload)])
+
+    status, headers, image = request(baseUrl, "/hide" + query, body,
+                                     contentType)
+    assert status == 200
+    assert headers["Transfer-Encoding"] == "chunked"
+    assert headers["Content-Type"].startswith("image/")
+
+    status, headers, found = request(baseUrl, "/find", image)
+    assert status == 200
+    assert found == payload
+
+
+def test_hide_find_files(service, carrier):
+    server, baseUrl = service
+    contentType, body = form([("carrier", "carrier.png", carrier),
+                              ("files", "a.txt", b"hello"),
+                              ("files", "b.bin", bytes(500))])
+
+    status, headers, image = request(baseUrl, "/hide?kind=files", body,
+                                     contentType)
+    assert status == 200
+
+    status, headers, found = request(baseUrl, "/find", image)
+    assert status == 200
+    assert headers["Content-Type"] == "application/zip"
+
+    with zipfile.ZipFile(io.BytesIO(found)) as zipFileObject:
+        assert zipFileObject.read("a.txt") == b"hello"
+        assert zipFileObject.read("b.bin") == bytes(500)
+
+
+# Raw payloads get the versioned header and the key check block, short
+# text keeps the original layout and fails to decrypt instead
+@pytest.mark.parametrize("query, error", [
+    ("?kind=raw", "Wrong key"),
+    ("", "wrong key?"),
+])
+def test_wrong_key(service, carrier, query, error):
+    server, baseUrl = service
+    contentType, body = form([("carrier", "carrier.png", carrier),
+                              ("payload", None, b"secret")])
+    image = request(baseUrl, "/hide" + query, body, contentType)[2]
+
+    status, headers, found = request(baseUrl, "/find", image, key="k2")
+
+    assert status == 422
+    assert error in json.loads(found)["error"]
+
+
+def test_bad_requests(service, carrier):
+    server, baseUrl = service
+    contentType, body = form([("carrier", "carrier.png", carrier),
+                              ("payload", None, b"x")])
+
+    assert request(baseUrl, "/hide?depth=9", body, contentType)[0] == 400
+    assert request(baseUrl, "/hide", b"x", "text/plain")[0] == 400
+    assert request(baseUrl, "/find", carrier, key=None)[0] == 400
+    assert request(baseUrl, "/nope", b"x")[0] == 404
+
+
+@pytest.mark.parametrize("path, fields", [
+    ("/capacity", None),
+    ("/find", None),
+    ("/hide", [("payload", None, b"x")]),
+])
+def test_not_an_image(service, path, fields):
+    server, baseUrl = service
+
+    if (fields is None):
+        status, headers, body = request(baseUrl, path, b"not an image")
+    else:
+        contentType, formBody = form([("carrier", "carrier.png",
+                                       b"not an image")] + fields)
+        status, headers, body = request(baseUrl, path, formBody,
+                                        contentType)
+
+    assert status == 422
+    assert "Not a readable image" in json.loads(body)["error"]
+
+
+# /capacity only reads the image header, /find needs every pixel
+def test_truncated_image(service, carrier):
+    server, baseUrl = service
+    status, headers, body = request(baseUrl, "/find",
+                                    carrier[:len(carrier) // 2])
+
+    assert status == 422
+    assert "Not a readable image" in json.loads(body)["error"]
+
+
+def test_full_queue_gets_429(service, carrier):
+    server, baseUrl = service
+
+    # Take the only worker slot, as a running job would
+    assert server.jobSlots.acquire(blocking=False)
+    try:
+        status, headers, body = request(baseUrl, "/capacity", carrier)
+    finally:
+        server.jobSlots.release()
+
+    assert status == 429
+    assert headers["Retry-After"] == "1"
+    assert request(baseUrl, "/capacity", carrier)[0] == 200
+
+
+def test_rejected_body_is_not_a_request(service):
+    server, baseUrl = service
+    smuggled = b"GET /health HTTP/1.1\r\nHost: x\r\n\r\n"
+
+    received = raw_exchange(
+        server, b"POST /nope HTTP/1.1\r\nHost: x\r\nContent-Length: " +
+        str(len(smuggled)).encode() + b"\r\n\r\n" + smuggled)
+
+    assert received.startswith(b"HTTP/1.1 404")
+    assert received.count(b"HTTP/1.1 ") == 1
+
+
+@pytest.mark.parametrize("contentLength", [b"abc", b"-1"])
+def test_bad_content_length(service, contentLength):
+    server, baseUrl = service
+
+    received = raw_exchange(
+        server, b"POST /find HTTP/1.1\r\nHost: x\r\nContent-Length: " +
+        contentLength + b"\r\n\r\n")
+
+    assert received.startswith(b"HTTP/1.1 411")
@@ -0,0 +1,72 @@
+import os
+import tracemalloc
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import stegano
+
+KEY = "strip-key"
+WIDTH, HEIGHT = 2000, 400
+BUDGET = 4 * 2**20
+
+
+def traced_peak(function, *args):
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture(scope="module")
+def carriers(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("strip")
+    paths = {}
+
+    for mode in ("L", "RGB", "RGBA"):
+        pixels = np.random.default_rng(len(mode)).integers(
+            0, 256, (HEIGHT, WIDTH, len(mode)), dtype=np.uint8)
+        paths[mode] = str(directory / (mode + ".png"))
+        Image.fromarray(pixels.squeeze(), mode).save(paths[mode],
+                                                     compress_level=1)
+
+    # Pillow loads its PNG plugin and the mask code its NumPy parts on first
+    # use -- once here, so no measurement pays for it
+    keyHexString = stegano.derive_key(KEY)[0]
+    stegano.strip_embed(paths["L"], str(directory / "warm.png"), b"x",
+                        keyHexString, stegano.make_header(8), None, 1)
+    stegano.strip_extract(str(directory / "warm.png"), keyHexString, None, 1)
+
+    return directory, paths
+
+
+# The bands take no more than memoryBudget on top of what a run with a
+# tiny budget needs (the payload, the mask chunk being generated and the
+# zlib streams) -- whatever the channel count
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def test_bands_stay_inside_the_budget(carriers, mode):
+    directory, paths = carriers
+    keyHexString = stegano.derive_key(KEY)[0]
+    cipherText = os.urandom((WIDTH * HEIGHT - WIDTH) *
+                            stegano.COLOR_LANES[mode] // 8 - 1)
+    header = stegano.make_header(8 * len(cipherText), "raw")
+    output = str(directory / ("out_" + mode + ".png"))
+
+    assert stegano.strip_band_height(WIDTH, len(mode), BUDGET) > 1
+
+    peaks = []
+    for memoryBudget in (BUDGET // 4, BUDGET):
+        embedPeak = traced_peak(stegano.strip_embed, paths[mode], output,
+                                cipherText, keyHexString, header,
+                                memoryBudget)[1]
+        (cipherBytes, foundHeader), extractPeak = traced_peak(
+            stegano.strip_extract, output, keyHexString, memoryBudget)
+
+        assert cipherBytes == cipherText
+        peaks.append((embedPeak, extractPeak))
+
+    assert peaks[1][0] - peaks[0][0] <= BUDGET
+    assert peaks[1][1] - peaks[0][1] <= BUDGET